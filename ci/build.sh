@@ -21,6 +21,10 @@ echo "-----------------------------------------------------------------------"
 
 python -m pip install -r requirements/build.txt
 python -m pip install --editable .
+
+# The standalone is built from src, which build_py does not write the manifest
+# of the bundled salt files to
+python setup.py salt_manifest
 python -m pip list
 
 # creates standalone
@@ -4,8 +4,57 @@
 from __future__ import (absolute_import, division, print_function,
                         unicode_literals, with_statement)
 
-from setuptools import setup
+import os
+import runpy
+
+from setuptools import Command, setup
+from setuptools.command.build_py import build_py
+
+
+def write_salt_manifest(package_root):
+    """Write the manifest of the bundled salt files under a package root."""
+    # Load the module by path, the watchmaker package and its requirements
+    # are not importable while it is being built
+    manifest_utils = runpy.run_path(
+        os.path.join('src', 'watchmaker', 'utils', 'manifest.py'))
+    salt_dir = os.path.join(package_root, 'watchmaker', 'static', 'salt')
+    if os.path.isdir(salt_dir):
+        path = os.path.join(salt_dir, manifest_utils['MANIFEST_NAME'])
+        manifest_utils['write_manifest'](
+            manifest_utils['build_manifest'](salt_dir), path)
+        # Read by whichever user runs watchmaker
+        os.chmod(path, 0o644)
+
+
+class BuildPy(build_py):
+    """Build the package, including the manifest of the bundled salt files."""
+
+    def run(self):
+        """Run build_py, then write the salt manifest into the build tree."""
+        build_py.run(self)
+        write_salt_manifest(self.build_lib)
+
+
+class SaltManifest(Command):
+    """Write the manifest of the bundled salt files into the source tree."""
+
+    description = (
+        'write the manifest of the bundled salt files into src, for builds '
+        'that package the source tree, e.g. the standalone')
+    user_options = []
+
+    def initialize_options(self):
+        """Set the default options, there are none."""
+
+    def finalize_options(self):
+        """Finalize the options, there are none."""
+
+    def run(self):
+        """Write the salt manifest into the source tree."""
+        write_salt_manifest('src')
+
 
 setup(
-    package_dir={'': str('src')}
+    package_dir={'': str('src')},
+    cmdclass={'build_py': BuildPy, 'salt_manifest': SaltManifest}
 )
@@ -10,3 +10,11 @@ class WatchmakerException(Exception):
 
 class InvalidValue(WatchmakerException):
     """Passed an invalid value."""
+
+
+class CommandTimeout(WatchmakerException):
+    """A command ran out of time and was terminated."""
+
+    def __init__(self, msg, result=None):
+        super(CommandTimeout, self).__init__(msg)
+        self.result = result
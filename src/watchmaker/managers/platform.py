@@ -3,19 +3,28 @@
 from __future__ import (absolute_import, division, print_function,
                         unicode_literals, with_statement)
 
-import concurrent.futures
+import itertools
 import logging
 import os
 import shutil
-import subprocess
+import stat
+import struct
 import tarfile
 import tempfile
+import threading
 import zipfile
 
+import backoff
+
 import watchmaker.utils
-from watchmaker.exceptions import WatchmakerException
+import watchmaker.utils.process
+import watchmaker.utils.trash
+from watchmaker.exceptions import CommandTimeout, WatchmakerException
 from watchmaker.utils import urllib
 
+# Number of bytes of the output of a timed out command that are logged
+TIMEOUT_OUTPUT_TAIL = 4096
+
 
 class PlatformManagerBase(object):
     """
@@ -45,10 +54,112 @@ class PlatformManagerBase(object):
             shutdown_path:
                 (Windows-only) Path to the Windows ``shutdown.exe`` command.
 
+    Attributes:
+        extract_cache_dir: (:obj:`str`)
+            Directory where extracted archives are cached, keyed by the
+            digest of the archive. When set, :meth:`extract_contents` only
+            decompresses an archive it has not seen before, and otherwise
+            hardlinks the cached tree into place. When ``None``, archives are
+            always decompressed.
+            (*Default*: ``None``)
+
+        extract_cache_max_age: (:obj:`int`)
+            Number of seconds since its last use that an extracted archive
+            is kept in ``extract_cache_dir``. :meth:`cleanup` evicts the
+            others, as it purges the trash. When ``None``, they are kept
+            indefinitely.
+            (*Default*: ``None``)
+
+        extract_cache_max_size: (:obj:`int`)
+            Number of bytes the extracted archives kept in
+            ``extract_cache_dir`` may take up. The most recently used are
+            kept. When ``None``, their size is not bounded.
+            (*Default*: ``None``)
+
+        ram_dir: (:obj:`str`)
+            Directory on a memory-backed filesystem, e.g. ``tmpfs``, where
+            :meth:`create_working_dir` creates working directories instead
+            of ``basedir``. Downloads and extractions that would take the
+            files in ``ram_dir`` beyond ``ram_budget`` are spilled to a
+            matching directory in ``basedir``, and linked into place. It must
+            be a directory of the current user, accessible to that user only,
+            or working directories are created in ``basedir``. When
+            ``None``, working directories are created in ``basedir``.
+            (*Default*: ``None``)
+
+        ram_budget: (:obj:`int`)
+            Number of bytes the files in ``ram_dir`` may take up. Room is
+            reserved before each download or extraction is written, so
+            concurrent ones stay within the budget together.
+            (*Default*: ``0``)
+
+        trash_max_age: (:obj:`int`)
+            Number of seconds the working directory of an earlier run is kept
+            in the trash directory. :meth:`cleanup` moves the working
+            directory to the trash, next to it, and the trash is purged in
+            the background.
+            (*Default*: ``0``)
+
+        trash_max_size: (:obj:`int`)
+            Number of bytes the working directories kept in the trash
+            directory may take up. The newest are kept.
+            (*Default*: ``0``)
+
+        command_timeout: (:obj:`float`)
+            Number of seconds a command started by :meth:`call_process` may
+            run before it is terminated, along with every process it
+            started. When ``None``, commands may run indefinitely.
+            (*Default*: ``None``)
+
+        command_inactivity_timeout: (:obj:`float`)
+            Number of seconds a command started by :meth:`call_process` may
+            run without writing any output before it is terminated. When
+            ``None``, commands may be silent indefinitely.
+            (*Default*: ``None``)
+
+        command_output_dir: (:obj:`str`)
+            Directory where the raw output of each command run by
+            :meth:`call_process` is written, one file per command and pipe,
+            with only a summary of it logged, see
+            :class:`watchmaker.utils.process.Command`. When ``None``, every
+            line of output is logged.
+            (*Default*: ``None``)
+
+        command_usage: (:obj:`list`)
+            Resources used by each command run by :meth:`call_process`, as
+            :obj:`dict` with the ``worker`` (the class name of the manager),
+            the ``cmd``, its ``retcode``, and the
+            :data:`watchmaker.utils.process.USAGE_FIELDS`. Each attempt of a
+            retried command is a separate entry.
+            (*Default*: ``None``)
+
     """
 
     boto3 = None
     boto_client = None
+    extract_cache_dir = None
+    extract_cache_max_age = None
+    extract_cache_max_size = None
+    ram_dir = None
+    ram_budget = 0
+    ram_spill_dir = None
+    _ram_reserved = 0
+    _ram_lock = threading.Lock()
+    trash_max_age = 0
+    trash_max_size = 0
+    command_timeout = None
+    command_inactivity_timeout = None
+    command_usage = None
+    command_output_dir = None
+    command_output_count = 0
+
+    # Memory-backed filesystem that may hold ``ram_dir``, if the platform has
+    # one
+    RAM_FS = None
+
+    # Expected ratio of the extracted size of an archive to its size, when
+    # the archive does not record the extracted size
+    ARCHIVE_EXPANSION_ESTIMATE = 5
 
     def __init__(self, system_params, *args, **kwargs):
         self.log = logging.getLogger(
@@ -81,10 +192,13 @@ class PlatformManagerBase(object):
         try:
             self.log.debug('Establishing connection to the host, %s', url)
             response = watchmaker.utils.urlopen_retry(url)
-            self.log.debug('Opening the file handle, %s', filename)
-            with open(filename, 'wb') as outfile:
-                self.log.debug('Saving file to local filesystem...')
-                shutil.copyfileobj(response, outfile)
+            if self._in_ram_dir(filename):
+                self._save_to_ram_dir(response, filename)
+            else:
+                self.log.debug('Opening the file handle, %s', filename)
+                with open(filename, 'wb') as outfile:
+                    self.log.debug('Saving file to local filesystem...')
+                    shutil.copyfileobj(response, outfile)
         except (ValueError, urllib.error.URLError):
             self.log.critical(
                 'Failed to retrieve the file. url = %s. filename = %s',
@@ -112,31 +226,192 @@ class PlatformManagerBase(object):
 
         """
         self.log.info('Creating a working directory.')
-        original_umask = os.umask(0)
         try:
+            if self.ram_dir and not self._in_ram_dir(basedir):
+                try:
+                    self._create_ram_dir()
+                except (OSError, WatchmakerException) as exc:
+                    self.log.warning(
+                        'Unable to use the RAM dir, keeping the working dir '
+                        'on disk: %s', exc)
+                    self.ram_dir = None
+                else:
+                    # Files that do not fit in memory are spilled to basedir
+                    self.ram_spill_dir = basedir
+                    basedir = self.ram_dir
             working_dir = tempfile.mkdtemp(prefix=prefix, dir=basedir)
+            # Set the mode explicitly instead of clearing the umask, as the
+            # umask is process-wide and working dirs may be created from
+            # several threads at once
+            os.chmod(working_dir, stat.S_IRWXU)
         except Exception:
             msg = 'Could not create a working dir in {0}'.format(basedir)
             self.log.critical(msg)
             raise
+
+        # Purge what an earlier run left in the trash, e.g. when it exited
+        # before its cleanup finished
+        for trash_base in (basedir, self.ram_spill_dir):
+            trash_dir = trash_base and os.path.join(
+                trash_base, watchmaker.utils.trash.TRASH_DIR_NAME)
+            if trash_dir and os.path.isdir(trash_dir):
+                self._purge_trash(trash_dir)
         self.log.debug('Created working directory: %s', working_dir)
-        os.umask(original_umask)
         return working_dir
 
-    @staticmethod
-    def _pipe_handler(pipe, logger=None, prefix_msg=''):
-        ret = b''
+    def _create_ram_dir(self):
         try:
-            for line in iter(pipe.readline, b''):
-                if logger:
-                    logger('%s%s', prefix_msg, line.rstrip())
-                ret += line
-        finally:
-            pipe.close()
+            os.makedirs(self.ram_dir, stat.S_IRWXU)
+        except OSError:
+            if not os.path.lexists(self.ram_dir):
+                raise
+        # The RAM dir is in a world-writable location, so it may have been
+        # created, or replaced by a link, by another user
+        ram_stat = os.lstat(self.ram_dir)
+        if (
+            not stat.S_ISDIR(ram_stat.st_mode) or
+            ram_stat.st_uid != os.geteuid() or
+            stat.S_IMODE(ram_stat.st_mode) != stat.S_IRWXU
+        ):
+            raise WatchmakerException(
+                'RAM dir is not a directory private to the current user: '
+                '{0}'.format(self.ram_dir))
+
+    def _is_spill_link(self, path):
+        return (
+            self._in_ram_dir(path) and bool(self.ram_spill_dir) and
+            os.path.islink(path) and
+            os.path.realpath(path).startswith(
+                os.path.realpath(self.ram_spill_dir) + os.sep)
+        )
+
+    def _in_ram_dir(self, path):
+        return bool(self.ram_dir) and os.path.abspath(path).startswith(
+            os.path.abspath(self.ram_dir) + os.sep)
+
+    def _reserve_ram(self, size):
+        # Files are written to the RAM dir from several threads at once, so
+        # room is reserved before writing, against a single count
+        with self._ram_lock:
+            if size > self._ram_available():
+                return False
+            self._ram_reserved += size
+            return True
+
+    def _release_ram(self, size):
+        with self._ram_lock:
+            self._ram_reserved = max(self._ram_reserved - size, 0)
+
+    def _ram_available(self):
+        available = self.ram_budget - self._ram_reserved
+        if hasattr(os, 'statvfs'):
+            ram_stat = os.statvfs(self.ram_dir)
+            available = min(available, ram_stat.f_bavail * ram_stat.f_frsize)
+        return max(available, 0)
+
+    def _spill(self, path, directory=False):
+        # Move the path to the matching location in the spill dir, and link
+        # it back, so it is used the same way whether it was spilled or not
+        spill_path = os.path.join(
+            self.ram_spill_dir, os.path.relpath(path, self.ram_dir))
+        spill_parent = os.path.dirname(spill_path)
+        if not os.path.isdir(spill_parent):
+            os.makedirs(spill_parent)
+        if os.path.isdir(spill_path) and not os.path.islink(spill_path):
+            shutil.rmtree(spill_path)
+        elif os.path.lexists(spill_path):
+            os.remove(spill_path)
+        if os.path.lexists(path):
+            shutil.move(path, spill_path)
+        elif directory:
+            os.makedirs(spill_path)
+        os.symlink(spill_path, path)
+        self.log.info(
+            'RAM budget exceeded, spilled to disk. path=%s, spill_path=%s',
+            path, spill_path)
+        return spill_path
+
+    def _save_to_ram_dir(self, response, filename, blocksize=1048576):
+        try:
+            length = int(response.info().get('Content-Length'))
+        except (AttributeError, TypeError, ValueError):
+            length = None
+
+        if os.path.lexists(filename):
+            os.remove(filename)
+
+        blocks = iter(lambda: response.read(blocksize), b'')
+        if length is None or self._reserve_ram(length):
+            blocks = self._write_to_ram_dir(blocks, filename, length or 0)
+            if blocks is None:
+                return
+        else:
+            self._spill(filename)
+        with open(filename, 'ab') as outfile:
+            for block in blocks:
+                outfile.write(block)
+
+    def _write_to_ram_dir(self, blocks, filename, reserved):
+        # Write the blocks while they fit in the RAM budget. Once they do not,
+        # spill the file and return the blocks left to append to it
+        written = 0
+        overflow = None
+        with open(filename, 'wb') as outfile:
+            for block in blocks:
+                written += len(block)
+                if written > reserved:
+                    # Larger than announced, or the size was not announced
+                    if not self._reserve_ram(written - reserved):
+                        overflow = block
+                        break
+                    reserved = written
+                outfile.write(block)
+        if overflow is None:
+            self._release_ram(reserved - written)
+            return None
+        self._spill(filename)
+        self._release_ram(reserved)
+        return itertools.chain([overflow], blocks)
+
+    def _estimate_extracted_size(self, opener, mode, filepath):
+        if opener is zipfile.ZipFile:
+            with zipfile.ZipFile(filepath, mode) as zip_:
+                return sum(x.file_size for x in zip_.infolist())
+        if mode == 'r:gz':
+            # The gzip trailer records the uncompressed size, modulo 2**32
+            with open(filepath, 'rb') as fh_:
+                fh_.seek(-4, os.SEEK_END)
+                return struct.unpack(str('<I'), fh_.read(4))[0]
+        return os.path.getsize(filepath) * self.ARCHIVE_EXPANSION_ESTIMATE
+
+    @staticmethod
+    def _get_process_env():
+        # If running as a standalone, PyInstaller will have modified the
+        # LD_LIBRARY_PATH to point to standalone libraries. If there were a
+        # value at runtime, PyInstaller will create LD_LIBRARY_PATH_ORIG. In
+        # order for salt to run correctly, LD_LIBRARY_PATH has to be fixed.
+        env = dict(os.environ)
+        lib_path_key = 'LD_LIBRARY_PATH'
+
+        if env.get(lib_path_key) is None:
+            return None
 
-        return ret
+        lib_path_orig_value = env.get(lib_path_key + '_ORIG')
+        if lib_path_orig_value is None:
+
+            # you can have lib_path and no orig, if:
+            # 1. none was set and pyinstaller set one, or
+            # 2. one was set and we're not in standalone package
+            env.pop(lib_path_key, None)
+
+        else:
 
-    def call_process(self, cmd, log_pipe='all', raise_error=True):
+            # put original lib_path back
+            env[lib_path_key] = lib_path_orig_value
+
+        return env
+
+    def call_process(self, cmd, log_pipe='all', raise_error=True, **kwargs):
         """
         Execute a shell command.
 
@@ -154,90 +429,308 @@ class PlatformManagerBase(object):
                 is non-zero.
                 (*Default*: ``True``)
 
+            output: (:obj:`str`)
+                How the command output is returned. With ``bytes``, as
+                :obj:`bytes`. With ``buffer``, as a
+                :obj:`watchmaker.utils.process.OutputBuffer`, which spills
+                large output to a temporary file instead of holding it in
+                memory.
+                (*Default*: ``bytes``)
+
+            timeout: (:obj:`float`)
+                Number of seconds the command may run before it is
+                terminated, along with every process it started. When
+                ``None``, :attr:`command_timeout` applies.
+                (*Default*: ``None``)
+
+            inactivity_timeout: (:obj:`float`)
+                Number of seconds the command may run without writing any
+                output before it is terminated. When ``None``,
+                :attr:`command_inactivity_timeout` applies.
+                (*Default*: ``None``)
+
+            retry: (:obj:`watchmaker.utils.process.RetryPolicy`)
+                Policy for retrying transient failures of the command, e.g.
+                :data:`watchmaker.utils.process.PACKAGE_LOCK_RETRY`. When
+                ``None``, the command is run once.
+                (*Default*: ``None``)
+
         Returns:
             :obj:`dict`:
                 Dictionary containing three keys: ``retcode`` (:obj:`int`),
                 ``stdout`` (:obj:`bytes`), and ``stderr`` (:obj:`bytes`).
 
+        Raises:
+            :obj:`watchmaker.exceptions.CommandTimeout`:
+                The command was terminated for running out of time, whatever
+                the value of ``raise_error``. Its ``result`` holds the output
+                captured until then.
+
         """
-        ret = {
-            'retcode': 0,
-            'stdout': b'',
-            'stderr': b''
-        }
+        return self.call_processes([cmd], log_pipe, raise_error, **kwargs)[0]
 
-        if not isinstance(cmd, list):
-            msg = 'Command is not a list: {0}'.format(cmd)
-            self.log.critical(msg)
-            raise WatchmakerException(msg)
+    def call_processes(self, cmds, log_pipe='all', raise_error=True,
+                       **kwargs):
+        """
+        Execute several independent shell commands concurrently.
 
-        self.log.debug('Command: %s', ' '.join(cmd))
+        Each command runs on a thread of a pool, and its stdout and stderr
+        are read by a thread each, see :mod:`watchmaker.utils.process`.
 
-        # If running as a standalone, PyInstaller will have modified the
-        # LD_LIBRARY_PATH to point to standalone libraries. If there were a
-        # value at runtime, PyInstaller will create LD_LIBRARY_PATH_ORIG. In
-        # order for salt to run correctly, LD_LIBRARY_PATH has to be fixed.
-        kwargs = {}
-        env = dict(os.environ)
-        lib_path_key = 'LD_LIBRARY_PATH'
+        Args:
+            cmds: (:obj:`list`)
+                Commands to execute, each a :obj:`list`.
 
-        if env.get(lib_path_key) is not None:
+            log_pipe: (:obj:`str`)
+                Controls what to log from the command output. Supports three
+                values: ``stdout``, ``stderr``, ``all``.
+                (*Default*: ``all``)
 
-            lib_path_orig_value = env.get(lib_path_key + '_ORIG')
-            if lib_path_orig_value is None:
+            raise_error: (:obj:`bool`)
+                Switch to control whether to raise if the return code of any
+                command is non-zero. Every command has exited when it raises.
+                (*Default*: ``True``)
 
-                # you can have lib_path and no orig, if:
-                # 1. none was set and pyinstaller set one, or
-                # 2. one was set and we're not in standalone package
-                env.pop(lib_path_key, None)
+            max_concurrency: (:obj:`int`)
+                Number of commands that may run at the same time. When
+                ``None``, every command is started at once.
+                (*Default*: ``None``)
 
-            else:
+            output: (:obj:`str`)
+                How the command output is returned, see :meth:`call_process`.
+                (*Default*: ``bytes``)
 
-                # put original lib_path back
-                env[lib_path_key] = lib_path_orig_value
-
-            kwargs['env'] = env
-
-        with subprocess.Popen(
-            cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, **kwargs
-        ) as process, concurrent.futures.ThreadPoolExecutor(
-            max_workers=2
-        ) as executor:
-            stdout_future = executor.submit(
-                self._pipe_handler,
-                process.stdout,
-                self.log.debug if log_pipe in ['stdout', 'all'] else None,
-                'Command stdout: '
-            )
+            timeout: (:obj:`float`)
+                Number of seconds each command may run, see
+                :meth:`call_process`.
+                (*Default*: ``None``)
 
-            stderr_future = executor.submit(
-                self._pipe_handler,
-                process.stderr,
-                self.log.error if log_pipe in ['stderr', 'all'] else None,
-                'Command stderr: ')
+            inactivity_timeout: (:obj:`float`)
+                Number of seconds each command may run without writing any
+                output, see :meth:`call_process`.
+                (*Default*: ``None``)
 
-            ret['stdout'] = stdout_future.result()
-            ret['stderr'] = stderr_future.result()
+            retry: (:obj:`watchmaker.utils.process.RetryPolicy`)
+                Policy for retrying transient failures of each command, see
+                :meth:`call_process`. Only the commands that failed are run
+                again.
+                (*Default*: ``None``)
 
-            ret['retcode'] = process.wait()
+        Returns:
+            :obj:`list`:
+                One :obj:`dict` per command, in the order of ``cmds``, as
+                returned by :meth:`call_process`.
 
-        self.log.debug('Command retcode: %s', ret['retcode'])
+        Raises:
+            :obj:`watchmaker.exceptions.CommandTimeout`:
+                A command was terminated for running out of time. Every
+                command has exited when it raises.
 
-        if raise_error and ret['retcode'] != 0:
+        """
+        for cmd in cmds:
+            if not isinstance(cmd, list):
+                msg = 'Command is not a list: {0}'.format(cmd)
+                self.log.critical(msg)
+                raise WatchmakerException(msg)
+
+        max_concurrency = kwargs.pop('max_concurrency', None)
+        retry = kwargs.pop('retry', None)
+        commands = self._get_commands(cmds, log_pipe, kwargs)
+        results = self._run_commands(commands, max_concurrency, retry)
+        self._check_results(commands, results, raise_error)
+        return results
+
+    def _get_commands(self, cmds, log_pipe, kwargs):
+        output = kwargs.pop('output', None) or 'bytes'
+        timeouts = watchmaker.utils.process.Timeouts(
+            total=float(
+                kwargs.pop('timeout', None) or self.command_timeout or 0),
+            inactivity=float(
+                kwargs.pop('inactivity_timeout', None) or
+                self.command_inactivity_timeout or 0))
+        if kwargs:
+            raise TypeError('Unexpected keyword arguments: {0}'.format(
+                ', '.join(sorted(kwargs))))
+        popen_kwargs = {}
+        env = self._get_process_env()
+        if env is not None:
+            popen_kwargs['env'] = env
+
+        commands = []
+        for cmd in cmds:
+            self.log.debug('Command: %s', ' '.join(cmd))
+            paths = self._get_output_paths(cmd)
+            commands.append(watchmaker.utils.process.Command(
+                cmd,
+                stdout=watchmaker.utils.process.Pipe(
+                    self.log.debug if log_pipe in ['stdout', 'all'] else None,
+                    'Command stdout: ', paths.get('stdout'), output),
+                stderr=watchmaker.utils.process.Pipe(
+                    self.log.error if log_pipe in ['stderr', 'all'] else None,
+                    'Command stderr: ', paths.get('stderr'), output),
+                timeouts=timeouts,
+                **popen_kwargs
+            ))
+        return commands
+
+    def _check_results(self, commands, results, raise_error):
+        failed = []
+        timed_out = []
+        for command, ret in zip(commands, results):
+            self.log.debug(
+                'Command retcode: %s, cmd=%s', ret['retcode'],
+                ' '.join(command.cmd))
+            reason = ret.pop('timed_out')
+            if reason:
+                timed_out.append((command, ret, reason))
+            elif ret['retcode'] != 0:
+                failed.append((command.cmd, ret))
+
+        if timed_out:
+            command, ret, reason = timed_out[0]
+            for name in ('stdout', 'stderr'):
+                tail = self._get_output_tail(ret[name])
+                if tail:
+                    self.log.critical(
+                        'Command %s before termination: %s', name, tail)
+            msg = (
+                'Command terminated! Reason={0}, cmd={1}'.format(
+                    'no output within {0} seconds'.format(
+                        command.timeouts.inactivity)
+                    if reason == 'inactivity' else
+                    'still running after {0} seconds'.format(
+                        command.timeouts.total),
+                    ' '.join(command.cmd)))
+            self.log.critical(msg)
+            raise CommandTimeout(msg, result=ret)
+
+        if raise_error and failed:
+            cmd, ret = failed[0]
             msg = 'Command failed! Exit code={0}, cmd={1}'.format(
                 ret['retcode'], ' '.join(cmd))
             self.log.critical(msg)
             raise WatchmakerException(msg)
 
-        return ret
+    def _get_output_paths(self, cmd):
+        if not self.command_output_dir:
+            return {}
+        if not os.path.isdir(self.command_output_dir):
+            os.makedirs(self.command_output_dir)
+        self.command_output_count += 1
+        path = os.path.join(
+            self.command_output_dir,
+            '{0}-{1:03d}-{2}'.format(
+                self.__class__.__name__, self.command_output_count,
+                os.path.basename(cmd[0])))
+        self.log.debug('Command output: %s.{stdout,stderr}.log', path)
+        return {
+            'stdout': '{0}.stdout.log'.format(path),
+            'stderr': '{0}.stderr.log'.format(path),
+        }
+
+    def _run_commands(self, commands, max_concurrency, retry):
+        results = [None] * len(commands)
+        pending = list(range(len(commands)))
+
+        def run():
+            rets = watchmaker.utils.process.run_processes(
+                [commands[x] for x in pending], max_concurrency)
+            for index, ret in zip(pending, rets):
+                self._close_output(results[index])
+                results[index] = ret
+                self._record_usage(commands[index].cmd, ret)
+            pending[:] = [
+                x for x in pending if retry and retry.matches(results[x])]
+            return pending
+
+        def log_retry(details):
+            for index in pending:
+                self.log.warning(
+                    'Command failed transiently, retrying in %.1f seconds '
+                    '(attempt %s), retcode=%s, cmd=%s',
+                    details['wait'], details['tries'],
+                    results[index]['retcode'],
+                    ' '.join(commands[index].cmd))
+
+        if retry:
+            run = backoff.on_predicate(
+                backoff.expo,
+                predicate=bool,
+                max_time=retry.max_time,
+                max_value=retry.max_wait,
+                jitter=backoff.full_jitter,
+                on_backoff=log_retry,
+            )(run)
+        run()
+        return results
+
+    def _record_usage(self, cmd, ret):
+        usage = ret.pop('usage')
+        self.log.debug(
+            'Command usage: %s, cmd=%s',
+            watchmaker.utils.process.format_usage(usage), ' '.join(cmd))
+        if self.command_usage is None:
+            self.command_usage = []
+        self.command_usage.append(dict(
+            usage, worker=self.__class__.__name__, cmd=cmd,
+            retcode=ret['retcode']))
+
+    @staticmethod
+    def _close_output(result):
+        for name in ('stdout', 'stderr'):
+            if result and not isinstance(result[name], bytes):
+                result[name].close()
+
+    @staticmethod
+    def _get_output_tail(output, size=TIMEOUT_OUTPUT_TAIL):
+        if isinstance(output, bytes):
+            tail = output[-size:]
+        else:
+            tail = output.tail(size)
+        return tail.decode('utf-8', 'replace').strip()
+
+    def _purge_trash(self, trash_dir):
+        return watchmaker.utils.trash.purge_trash(
+            trash_dir, self.trash_max_age, self.trash_max_size, self.log)
+
+    def _evict_extract_cache(self):
+        if not self.extract_cache_dir or (
+            self.extract_cache_max_age is None and
+            self.extract_cache_max_size is None
+        ) or not os.path.isdir(self.extract_cache_dir):
+            return None
+        return watchmaker.utils.trash.evict_extract_cache(
+            self.extract_cache_dir, self.extract_cache_max_age,
+            self.extract_cache_max_size, self.log)
 
     def cleanup(self):
-        """Delete working directory."""
+        """Move working directory to the trash, and purge it in background."""
         self.log.info('Cleanup Time...')
         try:
             self.log.debug('working_dir=%s', self.working_dir)
-            shutil.rmtree(self.working_dir)
-            self.log.info('Deleted working directory...')
+            trashed = [self.working_dir]
+            if self._in_ram_dir(self.working_dir):
+                # Freeing memory is quick, and the trash would count against
+                # the RAM budget for as long as it is kept
+                shutil.rmtree(self.working_dir)
+                self._release_ram(self._ram_reserved)
+                trashed = []
+                spill_dir = self.ram_spill_dir and os.path.join(
+                    self.ram_spill_dir, os.path.basename(self.working_dir))
+                if spill_dir and os.path.isdir(spill_dir):
+                    trashed.append(spill_dir)
+            for path in trashed:
+                try:
+                    trash_dir = watchmaker.utils.trash.move_to_trash(path)
+                except OSError:
+                    # E.g. a file still open on Windows
+                    self.log.warning(
+                        'Could not move %s to the trash, deleting it', path)
+                    shutil.rmtree(path)
+                else:
+                    self._purge_trash(trash_dir)
+            self._evict_extract_cache()
+            self.log.info('Moved working directory to the trash...')
         except Exception:
             msg = 'Cleanup Failed!'
             self.log.critical(msg)
@@ -245,6 +738,74 @@ class PlatformManagerBase(object):
 
         self.log.info('Exiting cleanup routine...')
 
+    @staticmethod
+    def _extract_archive(opener, mode, filepath, to_directory):
+        # Extract relative to the target path rather than changing the working
+        # directory, which is process-wide state shared by every thread
+        openfile = opener(filepath, mode)
+        try:
+            # Never write over files in place, they may be hardlinks into the
+            # extraction cache, or links into other trees
+            watchmaker.utils.clear_destinations(
+                to_directory,
+                openfile.namelist() if hasattr(openfile, 'namelist')
+                else openfile.getnames())
+            openfile.extractall(to_directory)
+        finally:
+            openfile.close()
+
+    def _extract_from_cache(self, opener, mode, filepath, to_directory):
+        digest = watchmaker.utils.file_digest(filepath)
+        cached_dir = os.sep.join((self.extract_cache_dir, digest))
+
+        if os.path.isdir(cached_dir):
+            self.log.debug(
+                'Extraction cache hit. source=%s, digest=%s', filepath, digest)
+            # Record the use, which eviction goes by
+            try:
+                os.utime(cached_dir, None)
+            except OSError:
+                pass
+        else:
+            self.log.debug(
+                'Extraction cache miss. source=%s, digest=%s',
+                filepath, digest)
+            try:
+                os.makedirs(self.extract_cache_dir)
+            except OSError:
+                if not os.path.isdir(self.extract_cache_dir):
+                    msg = 'Unable create directory - {0}'.format(
+                        self.extract_cache_dir)
+                    self.log.critical(msg)
+                    raise
+
+            # Extract next to the final location, then rename it into place so
+            # a partial extraction is never mistaken for a cached tree
+            staging_dir = tempfile.mkdtemp(
+                prefix='{0}-'.format(digest), dir=self.extract_cache_dir)
+            try:
+                self._extract_archive(opener, mode, filepath, staging_dir)
+                if os.name != 'nt':
+                    # Hardlinks share the read-only attribute on Windows,
+                    # which would keep the materialized files from being
+                    # deleted later
+                    watchmaker.utils.make_readonly(staging_dir)
+                os.rename(staging_dir, cached_dir)
+            except OSError:
+                if not os.path.isdir(cached_dir):
+                    raise
+                self.log.debug(
+                    'Archive was cached concurrently. digest=%s', digest)
+            finally:
+                if os.path.isdir(staging_dir):
+                    shutil.rmtree(staging_dir)
+
+        if self._is_spill_link(to_directory):
+            # Stage into the spill dir, where the link points, rather than
+            # replacing the link with a tree in memory
+            to_directory = os.path.realpath(to_directory)
+        watchmaker.utils.stage_tree(cached_dir, to_directory, 'hardlink')
+
     def extract_contents(self, filepath, to_directory, create_dir=False):
         """
         Extract a compressed archive to the specified directory.
@@ -299,17 +860,17 @@ class PlatformManagerBase(object):
                 self.log.critical(msg)
                 raise
 
-        cwd = os.getcwd()
-        os.chdir(to_directory)
+        if self._in_ram_dir(to_directory) and not os.listdir(to_directory):
+            if not self._reserve_ram(self._estimate_extracted_size(
+                opener, mode, filepath
+            )):
+                os.rmdir(to_directory)
+                self._spill(to_directory, directory=True)
 
-        try:
-            openfile = opener(filepath, mode)
-            try:
-                openfile.extractall()
-            finally:
-                openfile.close()
-        finally:
-            os.chdir(cwd)
+        if self.extract_cache_dir:
+            self._extract_from_cache(opener, mode, filepath, to_directory)
+        else:
+            self._extract_archive(opener, mode, filepath, to_directory)
 
         self.log.info(
             'Extracted file. source=%s, dest=%s',
@@ -324,13 +885,20 @@ class LinuxPlatformManager(PlatformManagerBase):
     Serves as a foundational class to keep OS consitency.
     """
 
+    RAM_FS = os.sep.join(('', 'dev', 'shm'))
+
     def _install_from_yum(self, packages):
         yum_cmd = ['sudo', 'yum', '-y', 'install']
         if isinstance(packages, list):
             yum_cmd.extend(packages)
         else:
             yum_cmd.append(packages)
-        self.call_process(yum_cmd)
+        # The output is logged already, it need not be kept in memory too
+        ret = self.call_process(
+            yum_cmd, output='buffer',
+            retry=watchmaker.utils.process.PACKAGE_LOCK_RETRY)
+        ret['stdout'].close()
+        ret['stderr'].close()
         self.log.debug(packages)
 
 
@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+"""Watchmaker systemd service mixin."""
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals, with_statement)
+
+import os
+
+
+class SystemdServiceMixin(object):
+    """
+    Manage services with systemctl, when systemd is the running init system.
+
+    Precedes a class with the same ``service_*`` methods in the bases of a
+    worker, e.g. :class:`watchmaker.workers.salt.SaltLinux`, whose methods
+    are used when systemd is not running. Commands are run with the
+    ``call_process`` method of the platform manager of the worker.
+    """
+
+    # Exists only when systemd is the running init system
+    SYSTEMD_RUNTIME_DIR = '/run/systemd/system'
+
+    # Unit file states of services started at boot
+    SYSTEMD_ENABLED_STATES = ('enabled', 'enabled-runtime')
+
+    def _has_systemd(self):
+        return os.path.isdir(self.SYSTEMD_RUNTIME_DIR)
+
+    def _systemctl(self, *args):
+        return self.call_process(['systemctl'] + list(args), raise_error=False)
+
+    def service_status(self, service):
+        """
+        Get the service status, from systemd when it is running.
+
+        Both states are read with one ``systemctl show`` query.
+
+        Args:
+            service: (obj:`str`)
+                Name of the service to query.
+
+        Returns:
+            :obj:`tuple`: ``('running', 'enabled')``
+                Whether the service is running, and whether it is enabled.
+
+        """
+        if not self._has_systemd():
+            return super(SystemdServiceMixin, self).service_status(service)
+        ret = self._systemctl(
+            'show', '--property', 'ActiveState,UnitFileState', service)
+        props = dict(
+            line.split(b'=', 1) for line in ret['stdout'].splitlines()
+            if b'=' in line)
+        return (
+            props.get(b'ActiveState', b'').strip() == b'active',
+            props.get(b'UnitFileState', b'').strip().decode() in
+            self.SYSTEMD_ENABLED_STATES
+        )
+
+    def service_stop(self, service):
+        """Stop a service, with systemd when it is running."""
+        if not self._has_systemd():
+            return super(SystemdServiceMixin, self).service_stop(service)
+        return self._systemctl('stop', service)['retcode'] == 0
+
+    def service_start(self, service):
+        """Start a service, with systemd when it is running."""
+        if not self._has_systemd():
+            return super(SystemdServiceMixin, self).service_start(service)
+        return self._systemctl('start', service)['retcode'] == 0
+
+    def service_disable(self, service):
+        """Disable a service, with systemd when it is running."""
+        if not self._has_systemd():
+            return super(SystemdServiceMixin, self).service_disable(service)
+        return self._systemctl('disable', service)['retcode'] == 0
+
+    def service_enable(self, service):
+        """Enable a service, with systemd when it is running."""
+        if not self._has_systemd():
+            return super(SystemdServiceMixin, self).service_enable(service)
+        return self._systemctl('enable', service)['retcode'] == 0
@@ -4,9 +4,14 @@ from __future__ import (absolute_import, division, print_function,
                         unicode_literals, with_statement)
 
 import abc
+import io
+import json
+import logging
+import os
 
 from six import add_metaclass
 
+import watchmaker.utils.process
 from watchmaker.workers.salt import SaltLinux, SaltWindows
 from watchmaker.workers.yum import Yum
 
@@ -28,7 +33,14 @@ class WorkersManagerBase(object):
 
     WORKERS = {}
 
+    #: File in the log directory where the resources used by the commands
+    #: of the workers are written
+    COMMAND_USAGE_FILE = 'watchmaker-command-usage.json'
+
     def __init__(self, system_params, workers, *args, **kwargs):
+        self.log = logging.getLogger(
+            '{0}.{1}'.format(__name__, self.__class__.__name__)
+        )
         self.system_params = system_params
         self.workers = workers
         WorkersManagerBase.args = args
@@ -52,11 +64,38 @@ class WorkersManagerBase(object):
                 system_params=self.system_params,
                 **configuration))
 
-        for worker in workers:
-            worker.before_install()
+        try:
+            for worker in workers:
+                worker.before_install()
+
+            for worker in workers:
+                worker.install()
+        finally:
+            self._report_command_usage(workers)
 
+    def _report_command_usage(self, workers):
+        records = []
         for worker in workers:
-            worker.install()
+            records.extend(getattr(worker, 'command_usage', None) or [])
+        if not records:
+            return
+
+        summary = watchmaker.utils.process.summarize_usage(records)
+        for total in summary:
+            self.log.info(
+                'Command usage summary: worker=%s, command=%s, count=%s, %s',
+                total['worker'], total['command'], total['count'],
+                watchmaker.utils.process.format_usage(total))
+
+        usage_file = os.path.join(
+            self.system_params['logdir'], self.COMMAND_USAGE_FILE)
+        try:
+            with io.open(usage_file, 'w', encoding='utf-8') as fh_:
+                fh_.write(json.dumps(
+                    {'summary': summary, 'commands': records}, indent=1))
+        except EnvironmentError:
+            self.log.warning(
+                'Unable to write the command usage to %s', usage_file)
 
     @abc.abstractmethod
     def cleanup(self):  # noqa: D102
@@ -3,15 +3,35 @@
 from __future__ import (absolute_import, division, print_function,
                         unicode_literals, with_statement)
 
+import concurrent.futures
+import errno
+import hashlib
 import os
 import shutil
 import ssl
+import stat
+import time
 import warnings
 
 import backoff
 
 from watchmaker.utils import urllib
 
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+#: Supported ways to place files when staging salt content and formulas
+STAGING_METHODS = ('copy', 'hardlink', 'reflink', 'symlink')
+
+# ioctl request that clones the extents of a file, see ioctl_ficlone(2)
+FICLONE = 0x40049409
+
+#: Upper bound on the number of files copied at the same time by
+#: :func:`copy_tree`
+MAX_COPY_WORKERS = 16
+
 
 def scheme_from_uri(uri):
     """Return a scheme from a parsed uri."""
@@ -67,6 +87,9 @@ def copytree(src, dst, force=False, **kwargs):
     r"""
     Copy OS directory trees from source to destination.
 
+    The tree is copied with :func:`copy_tree`, unless ``kwargs`` holds options
+    of :func:`shutil.copytree`, in which case that is used instead.
+
     Args:
         src: (:obj:`str`)
             Source directory tree to be copied.
@@ -80,11 +103,357 @@ def copytree(src, dst, force=False, **kwargs):
             Whether to delete destination prior to copy.
             (*Default*: ``False``)
 
+    Returns:
+        :obj:`dict`:
+            The metrics of the copy, see :func:`copy_tree`, or ``None`` when
+            :func:`shutil.copytree` was used.
+
     """
     if force and os.path.exists(dst):
         shutil.rmtree(dst)
 
-    shutil.copytree(src, dst, **kwargs)
+    if kwargs:
+        shutil.copytree(src, dst, **kwargs)
+        return None
+
+    return copy_tree(src, dst)
+
+
+def _copy_file(src, dst):
+    # Let the kernel copy the data, without a round trip through userspace,
+    # wherever it supports copy_file_range(2) between the two files
+    if hasattr(os, 'copy_file_range'):
+        try:
+            with open(src, 'rb') as src_fh, open(dst, 'wb') as dst_fh:
+                size = remaining = os.fstat(src_fh.fileno()).st_size
+                while remaining > 0:
+                    copied = os.copy_file_range(
+                        src_fh.fileno(), dst_fh.fileno(), remaining)
+                    if not copied:
+                        # Files of pseudo filesystems report a bogus size
+                        raise OSError(
+                            errno.EINVAL, 'Short copy_file_range', src)
+                    remaining -= copied
+            shutil.copystat(src, dst)
+            return size
+        except OSError as exc:
+            if exc.errno not in (
+                errno.EINVAL, errno.ENOSYS, errno.EXDEV, errno.EOPNOTSUPP,
+                errno.EBADF, errno.EPERM
+            ):
+                raise
+
+    shutil.copy2(src, dst)
+    return os.path.getsize(dst)
+
+
+def _copy_tree_file(src, dst, method):
+    if method == 'copy':
+        if os.path.lexists(dst):
+            os.remove(dst)
+        return _copy_file(src, dst)
+    stage_file(src, dst, method)
+    return os.path.getsize(dst)
+
+
+def copy_tree(src, dst, method='copy', max_workers=None):
+    r"""
+    Copy a directory tree, placing the files on a thread pool.
+
+    The tree is walked once. Every directory is created first, then the files
+    are placed concurrently, and finally the directory metadata is copied.
+    Symlinks within ``src`` are recreated as-is. Files that already exist in
+    ``dst`` are replaced.
+
+    Args:
+        src: (:obj:`str`)
+            Source directory tree.
+
+        dst: (:obj:`str`)
+            Destination directory, created when it does not exist.
+
+        method: (:obj:`str`)
+            One of :data:`STAGING_METHODS`, used to place each file, see
+            :func:`stage_file`. Files are copied with ``copy_file_range(2)``
+            where available.
+            (*Default*: ``copy``)
+
+        max_workers: (:obj:`int`)
+            Number of files placed at the same time.
+            (*Default*: :data:`MAX_COPY_WORKERS`)
+
+    Returns:
+        :obj:`dict`:
+            Count of ``dirs``, ``files``, and ``links`` created, the ``bytes``
+            of the files, and the ``seconds`` taken.
+
+    """
+    start = time.time()
+    stats = {'dirs': 0, 'files': 0, 'links': 0, 'bytes': 0, 'seconds': 0}
+    dirs_to_create, links_to_create, files_to_copy = _walk_tree(src, dst)
+
+    for _, dst_dir in dirs_to_create:
+        if not os.path.isdir(dst_dir):
+            os.makedirs(dst_dir)
+            stats['dirs'] += 1
+
+    stats['links'] = _create_links(links_to_create)
+
+    if files_to_copy:
+        with concurrent.futures.ThreadPoolExecutor(
+            max_workers=min(
+                len(files_to_copy), max_workers or MAX_COPY_WORKERS)
+        ) as executor:
+            for size in executor.map(
+                lambda x: _copy_tree_file(x[0], x[1], method), files_to_copy
+            ):
+                stats['files'] += 1
+                stats['bytes'] += size
+
+    if method == 'copy':
+        # Deepest first, so copying the metadata of a directory is not undone
+        # by creating entries in it
+        for src_dir, dst_dir in reversed(dirs_to_create):
+            shutil.copystat(src_dir, dst_dir)
+
+    stats['seconds'] = round(time.time() - start, 3)
+    return stats
+
+
+def _walk_tree(src, dst):
+    # Return the (src, dst) pairs of the directories, the (target, dst) pairs
+    # of the symlinks, and the (src, dst) pairs of the files of a tree
+    dirs = []
+    links = []
+    files = []
+    for root, dir_names, file_names in os.walk(src):
+        dst_root = os.path.join(dst, os.path.relpath(root, src))
+        dirs.append((root, os.path.normpath(dst_root)))
+        for name in file_names + dir_names:
+            src_path = os.path.join(root, name)
+            if os.path.islink(src_path):
+                links.append(
+                    (os.readlink(src_path), os.path.join(dst_root, name)))
+            elif name in file_names:
+                files.append((src_path, os.path.join(dst_root, name)))
+    return dirs, links, files
+
+
+def _create_links(links):
+    # Create the (target, dst) symlinks, replacing whatever is at dst
+    for target, dst_path in links:
+        if os.path.lexists(dst_path):
+            os.remove(dst_path)
+        os.symlink(target, dst_path)
+    return len(links)
+
+
+def file_digest(path, algorithm='sha256', blocksize=1048576):
+    """Return the hex digest of the contents of a file."""
+    digest = hashlib.new(algorithm)
+    with open(path, 'rb') as fh_:
+        for block in iter(lambda: fh_.read(blocksize), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def make_readonly(path):
+    """Remove the write permission bits from every file in a directory tree."""
+    write_bits = stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH
+    for root, _, files in os.walk(path):
+        for name in files:
+            filepath = os.path.join(root, name)
+            if os.path.islink(filepath):
+                continue
+            mode = stat.S_IMODE(os.stat(filepath).st_mode)
+            os.chmod(filepath, mode & ~write_bits)
+
+
+def _reflink(src, dst):
+    if fcntl is None:
+        raise OSError(errno.EOPNOTSUPP, 'Reflinks are not supported', dst)
+    with open(src, 'rb') as src_fh, open(dst, 'wb') as dst_fh:
+        fcntl.ioctl(dst_fh.fileno(), FICLONE, src_fh.fileno())
+    shutil.copystat(src, dst)
+
+
+def stage_file(src, dst, method='copy'):
+    r"""
+    Place a file at a destination using the given staging method.
+
+    Whenever the method is not possible, e.g. a hardlink across filesystems or
+    a reflink on a filesystem without support for it, the file is copied
+    instead. An existing file at ``dst`` is replaced, never written through.
+
+    Args:
+        src: (:obj:`str`)
+            Path to the source file.
+
+        dst: (:obj:`str`)
+            Path where the file is placed.
+
+        method: (:obj:`str`)
+            One of :data:`STAGING_METHODS`.
+            (*Default*: ``copy``)
+
+    Returns:
+        :obj:`str`: The staging method that was actually used.
+
+    """
+    if os.path.lexists(dst):
+        os.remove(dst)
+
+    try:
+        if method == 'hardlink':
+            os.link(src, dst)
+            return method
+        if method == 'symlink':
+            os.symlink(os.path.abspath(src), dst)
+            return method
+        if method == 'reflink':
+            _reflink(src, dst)
+            return method
+    except (AttributeError, EnvironmentError, NotImplementedError):
+        if os.path.lexists(dst):
+            os.remove(dst)
+
+    shutil.copy2(src, dst)
+    return 'copy'
+
+
+def stage_tree(src, dst, method='copy'):
+    r"""
+    Place a directory tree at a destination using the given staging method.
+
+    With the ``symlink`` method, ``dst`` becomes a symlink to ``src``.
+    Otherwise, the tree is placed with :func:`copy_tree`.
+
+    Args:
+        src: (:obj:`str`)
+            Source directory tree.
+
+        dst: (:obj:`str`)
+            Destination directory.
+
+        method: (:obj:`str`)
+            One of :data:`STAGING_METHODS`.
+            (*Default*: ``copy``)
+
+    Returns:
+        :obj:`dict`:
+            The metrics of the copy, see :func:`copy_tree`.
+
+    """
+    if os.path.islink(dst):
+        # Never stage files through a link into some other tree
+        os.remove(dst)
+
+    if method == 'symlink' and not os.path.isdir(dst):
+        try:
+            os.symlink(os.path.abspath(src), dst)
+            return {
+                'dirs': 0, 'files': 0, 'links': 1, 'bytes': 0, 'seconds': 0}
+        except (AttributeError, NotImplementedError, OSError):
+            method = 'copy'
+
+    return copy_tree(src, dst, method)
+
+
+def clear_destinations(root, names):
+    r"""
+    Remove what an extraction into a directory would write through.
+
+    Archives are extracted by writing over existing files in place, which
+    writes through a hardlink, e.g. into the extraction cache or an earlier
+    srv version, and through a symlink, e.g. into the bundled files. An
+    existing file or link at each name is removed, as is a symlink below
+    ``root`` on the way to it, so the extraction places new files instead.
+    Directories are kept.
+
+    Args:
+        root: (:obj:`str`)
+            Directory the archive is extracted to.
+
+        names: (:obj:`list`)
+            Relative paths of the archive members.
+
+    Returns:
+        :obj:`int`: Number of files and links removed.
+
+    """
+    removed = 0
+    for name in names:
+        parts = [
+            x for x in name.replace('\\', '/').split('/')
+            if x not in ('', '.')
+        ]
+        if '..' in parts:
+            continue
+        path = root
+        for index, part in enumerate(parts):
+            path = os.path.join(path, part)
+            if os.path.islink(path) or (
+                index == len(parts) - 1 and os.path.isfile(path)
+            ):
+                os.remove(path)
+                removed += 1
+                break
+            if not os.path.isdir(path):
+                break
+    return removed
+
+
+def _warm_file(path, blocksize=1048576):
+    with open(path, 'rb') as fh_:
+        size = os.fstat(fh_.fileno()).st_size
+        if hasattr(os, 'posix_fadvise'):
+            # Starts asynchronous readahead of the whole file and returns
+            os.posix_fadvise(fh_.fileno(), 0, 0, os.POSIX_FADV_WILLNEED)
+        else:
+            for _ in iter(lambda: fh_.read(blocksize), b''):
+                pass
+    return size
+
+
+def warm_page_cache(paths):
+    r"""
+    Read files into the page cache ahead of their use.
+
+    Where available, ``posix_fadvise(POSIX_FADV_WILLNEED)`` asks the kernel to
+    read each file in the background. Otherwise, each file is read through.
+    Files that cannot be read are skipped.
+
+    Args:
+        paths: (:obj:`list`)
+            Files and directory trees to read.
+
+    Returns:
+        :obj:`dict`:
+            Count of ``files`` warmed, their ``bytes``, and the ``seconds``
+            taken.
+
+    """
+    start = time.time()
+    stats = {'files': 0, 'bytes': 0, 'seconds': 0}
+    for path in paths:
+        if os.path.isfile(path):
+            filepaths = [path]
+        else:
+            filepaths = (
+                os.path.join(root, name)
+                for root, _, files in os.walk(path)
+                for name in files
+            )
+        for filepath in filepaths:
+            if os.path.islink(filepath):
+                continue
+            try:
+                stats['bytes'] += _warm_file(filepath)
+            except EnvironmentError:
+                continue
+            stats['files'] += 1
+    stats['seconds'] = round(time.time() - start, 3)
+    return stats
 
 
 def config_none_deprecate(check_value, log):
@@ -122,18 +491,28 @@ def clean_none(value):
     return value
 
 
-def copy_subdirectories(src_dir, dest_dir, log=None):
+def copy_subdirectories(src_dir, dest_dir, log=None, method='copy'):
     """Copy subdirectories within given src dir into dest dir."""
     for subdir in next(os.walk(src_dir))[1]:
         if (
             not subdir.startswith('.') and
             not os.path.exists(os.sep.join((dest_dir, subdir)))
         ):
-            copytree(
-                os.sep.join((src_dir, subdir)),
-                os.sep.join((dest_dir, subdir))
-            )
+            if method == 'copy':
+                stats = copytree(
+                    os.sep.join((src_dir, subdir)),
+                    os.sep.join((dest_dir, subdir))
+                )
+            else:
+                stats = stage_tree(
+                    os.sep.join((src_dir, subdir)),
+                    os.sep.join((dest_dir, subdir)),
+                    method
+                )
             if log:
-                log.info('Copied from %s to %s',
+                log.info('Copied from %s to %s. dirs=%s, files=%s, links=%s, '
+                         'bytes=%s, seconds=%s',
                          os.sep.join((src_dir, subdir)),
-                         os.sep.join((dest_dir, subdir)))
+                         os.sep.join((dest_dir, subdir)),
+                         stats['dirs'], stats['files'], stats['links'],
+                         stats['bytes'], stats['seconds'])
@@ -0,0 +1,256 @@
+# -*- coding: utf-8 -*-
+"""
+Manifests of directory trees and incremental tree synchronization.
+
+This module only depends on the standard library, so that ``setup.py`` can
+load it to generate the manifest of the bundled salt files at build time.
+"""
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals, with_statement)
+
+import hashlib
+import io
+import json
+import os
+import shutil
+import tempfile
+
+MANIFEST_NAME = 'manifest.json'
+MANIFEST_ALGORITHM = 'sha256'
+
+IGNORED_NAMES = ('.git',)
+
+
+def _hash_file(path, blocksize=1048576):
+    digest = hashlib.new(MANIFEST_ALGORITHM)
+    with open(path, 'rb') as fh_:
+        for block in iter(lambda: fh_.read(blocksize), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _to_relpath(path, root):
+    return os.path.relpath(path, root).replace(os.sep, '/')
+
+
+def _to_localpath(root, relpath):
+    return os.path.join(root, *relpath.split('/'))
+
+
+def _walk_files(root):
+    # Yield the relative path and the path of every file in a tree
+    for dirpath, dirs, files in os.walk(root):
+        dirs[:] = sorted(x for x in dirs if x not in IGNORED_NAMES)
+        for name in files:
+            if name in IGNORED_NAMES or (
+                dirpath == root and name == MANIFEST_NAME
+            ):
+                continue
+            path = os.path.join(dirpath, name)
+            yield _to_relpath(path, root), path
+
+
+def build_manifest(root):
+    """
+    Describe every file in a directory tree.
+
+    Args:
+        root: (:obj:`str`)
+            Directory tree to describe.
+
+    Returns:
+        :obj:`dict`:
+            Map of paths relative to ``root``, always ``/``-separated, to a
+            :obj:`dict` with the ``size`` and ``sha256`` of the file.
+
+    """
+    return dict(
+        (relpath, {
+            'size': os.path.getsize(path),
+            MANIFEST_ALGORITHM: _hash_file(path),
+        })
+        for relpath, path in _walk_files(root)
+    )
+
+
+def update_manifest(root, previous=None):
+    """
+    Describe every file in a directory tree, only reading the changed files.
+
+    Same as :func:`build_manifest`, with the ``mtime`` of each file. Files
+    whose size and mtime match their entry in ``previous`` keep the digest
+    of that entry, instead of being read again.
+
+    Args:
+        root: (:obj:`str`)
+            Directory tree to describe.
+
+        previous: (:obj:`dict`)
+            Manifest returned by an earlier call for ``root``.
+            (*Default*: ``None``)
+
+    Returns:
+        :obj:`dict`:
+            Map of paths relative to ``root``, always ``/``-separated, to a
+            :obj:`dict` with the ``size``, ``mtime``, and ``sha256`` of the
+            file.
+
+    """
+    previous = previous or {}
+    manifest = {}
+    for relpath, path in _walk_files(root):
+        stat = os.stat(path)
+        entry = {'size': stat.st_size, 'mtime': stat.st_mtime}
+        known = previous.get(relpath) or {}
+        if (
+            known.get('size') == entry['size'] and
+            known.get('mtime') == entry['mtime'] and
+            known.get(MANIFEST_ALGORITHM)
+        ):
+            entry[MANIFEST_ALGORITHM] = known[MANIFEST_ALGORITHM]
+        else:
+            entry[MANIFEST_ALGORITHM] = _hash_file(path)
+        manifest[relpath] = entry
+    return manifest
+
+
+def write_manifest(manifest, path):
+    """Write a manifest to a file, atomically replacing any existing file."""
+    dirname = os.path.dirname(path)
+    fd_, tmp_path = tempfile.mkstemp(prefix='.manifest-', dir=dirname)
+    try:
+        text = json.dumps(manifest, indent=1, sort_keys=True)
+        if isinstance(text, bytes):
+            # Python 2 returns a str when every string of the manifest is one
+            text = text.decode('utf-8')
+        with io.open(fd_, 'w', encoding='utf-8') as fh_:
+            fh_.write(text)
+        if os.name == 'nt' and os.path.exists(path):
+            os.remove(path)
+        os.rename(tmp_path, path)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def load_manifest(path):
+    """Return the manifest stored in a file, or ``None`` if it is missing."""
+    try:
+        with io.open(path, 'r', encoding='utf-8') as fh_:
+            return json.load(fh_)
+    except (EnvironmentError, ValueError):
+        return None
+
+
+def subtree(manifest, prefix):
+    """Return the entries of a manifest below ``prefix``, relative to it."""
+    prefix = prefix.rstrip('/') + '/'
+    return dict(
+        (path[len(prefix):], entry) for path, entry in manifest.items()
+        if path.startswith(prefix)
+    )
+
+
+def _is_current(path, entry, state):
+    if not state or state.get(MANIFEST_ALGORITHM) != entry[MANIFEST_ALGORITHM]:
+        return False
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return False
+    return stat.st_size == state['size'] and stat.st_mtime == state['mtime']
+
+
+def sync_tree(src, dst, manifest, state_file, copy_function=shutil.copy2):
+    """
+    Incrementally synchronize a directory tree described by a manifest.
+
+    Only files that were added or changed in ``manifest`` since the last sync,
+    or that were modified in ``dst`` since then, are copied. Files below the
+    top-level directories of ``manifest`` that are not in ``manifest`` are
+    deleted from ``dst``. Anything else in ``dst`` is left alone.
+
+    Args:
+        src: (:obj:`str`)
+            Source directory tree, as described by ``manifest``.
+
+        dst: (:obj:`str`)
+            Destination directory tree.
+
+        manifest: (:obj:`dict`)
+            Manifest of ``src``, see :func:`build_manifest`.
+
+        state_file: (:obj:`str`)
+            File recording what the last sync placed in ``dst``. It must not
+            be inside one of the top-level directories of ``manifest``.
+
+        copy_function: (:obj:`callable`)
+            Function used to place a file, called as
+            ``copy_function(src_path, dst_path)``. ``dst_path`` never exists
+            when it is called.
+            (*Default*: :func:`shutil.copy2`)
+
+    Returns:
+        :obj:`dict`:
+            Count of files ``added``, ``replaced``, ``deleted``, and
+            ``unchanged``.
+
+    """
+    stats = {'added': 0, 'replaced': 0, 'deleted': 0, 'unchanged': 0}
+    previous = load_manifest(state_file) or {}
+    current = {}
+
+    for relpath in sorted(manifest):
+        entry = manifest[relpath]
+        dst_path = _to_localpath(dst, relpath)
+        if _is_current(dst_path, entry, previous.get(relpath)):
+            current[relpath] = previous[relpath]
+            stats['unchanged'] += 1
+            continue
+
+        stats[_place_file(
+            _to_localpath(src, relpath), dst_path, copy_function)] += 1
+        stat = os.stat(dst_path)
+        current[relpath] = {
+            'size': stat.st_size,
+            'mtime': stat.st_mtime,
+            MANIFEST_ALGORITHM: entry[MANIFEST_ALGORITHM],
+        }
+
+    stats['deleted'] = _delete_unlisted(dst, manifest)
+    write_manifest(current, state_file)
+    return stats
+
+
+def _place_file(src_path, dst_path, copy_function):
+    # Return whether the file was `added` or `replaced`
+    status = 'added'
+    if os.path.lexists(dst_path):
+        # Never write through an existing file, it may be a link
+        os.remove(dst_path)
+        status = 'replaced'
+    else:
+        dst_dir = os.path.dirname(dst_path)
+        if not os.path.isdir(dst_dir):
+            os.makedirs(dst_dir)
+    copy_function(src_path, dst_path)
+    return status
+
+
+def _delete_unlisted(dst, manifest):
+    # Delete the files below the top-level directories of the manifest that
+    # it does not list, and the directories left empty. Return the count of
+    # files deleted
+    deleted = 0
+    for top in sorted(set(x.split('/', 1)[0] for x in manifest)):
+        top_path = _to_localpath(dst, top)
+        for dirpath, _, files in os.walk(top_path, topdown=False):
+            for name in files:
+                path = os.path.join(dirpath, name)
+                if _to_relpath(path, dst) not in manifest:
+                    os.remove(path)
+                    deleted += 1
+            if dirpath != top_path and not os.listdir(dirpath):
+                os.rmdir(dirpath)
+    return deleted
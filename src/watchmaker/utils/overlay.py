@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+"""
+Overlay of several directory trees, e.g. the file roots of salt.
+
+Salt searches its file roots in order, and serves a file from the first root
+that has it. An overlay holds a link to the first copy of every file of the
+roots, so salt finds every file in a single root.
+"""
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals, with_statement)
+
+import os
+import shutil
+import tempfile
+
+import watchmaker.utils
+import watchmaker.utils.manifest
+
+
+def index_roots(roots):
+    """
+    Find the root that each file of the roots is served from.
+
+    Args:
+        roots: (:obj:`list`)
+            Directories, in the order they are searched.
+
+    Returns:
+        :obj:`tuple`:
+            A :obj:`dict` of the relative path of each file, with ``/``
+            separators, to the first root that has it, and a :obj:`dict` of
+            the relative path of each file that several roots have to those
+            roots, in order.
+
+    """
+    index = {}
+    conflicts = {}
+    for root in roots:
+        for dirpath, dirs, files in os.walk(root, followlinks=True):
+            dirs.sort()
+            for name in files:
+                relpath = os.path.relpath(
+                    os.path.join(dirpath, name), root
+                ).replace(os.sep, '/')
+                if relpath in index:
+                    conflicts.setdefault(
+                        relpath, [index[relpath]]).append(root)
+                else:
+                    index[relpath] = root
+    return index, conflicts
+
+
+def build_overlay(roots, overlay, method='hardlink'):
+    """
+    Replace a directory with the overlay of several roots.
+
+    The new overlay is built next to ``overlay``, then swapped with it, and
+    an index of the overlay is saved next to it, as ``<overlay>.index.json``,
+    with the ``roots``, the root of each file, and the conflicts.
+
+    Args:
+        roots: (:obj:`list`)
+            Directories, in the order they are searched.
+
+        overlay: (:obj:`str`)
+            Path to the overlay directory.
+
+        method: (:obj:`str`)
+            How the files are placed in the overlay, ``hardlink`` or
+            ``symlink``, see :func:`watchmaker.utils.stage_file`.
+            (*Default*: ``hardlink``)
+
+    Returns:
+        :obj:`tuple`:
+            The index and the conflicts of the overlay, see
+            :func:`index_roots`.
+
+    """
+    index, conflicts = index_roots(roots)
+
+    staging_dir = tempfile.mkdtemp(
+        prefix='.{0}-'.format(os.path.basename(overlay)),
+        dir=os.path.dirname(overlay))
+    try:
+        staged_overlay = os.path.join(staging_dir, 'overlay')
+        os.mkdir(staged_overlay)
+        for relpath in sorted(index):
+            dst = os.path.join(staged_overlay, *relpath.split('/'))
+            if not os.path.isdir(os.path.dirname(dst)):
+                os.makedirs(os.path.dirname(dst))
+            watchmaker.utils.stage_file(
+                os.path.join(index[relpath], *relpath.split('/')), dst, method)
+        if os.path.lexists(overlay):
+            os.rename(overlay, os.path.join(staging_dir, 'previous'))
+        os.rename(staged_overlay, overlay)
+    finally:
+        shutil.rmtree(staging_dir)
+
+    watchmaker.utils.manifest.write_manifest(
+        {'roots': roots, 'files': index, 'conflicts': conflicts},
+        '{0}.index.json'.format(overlay))
+    return index, conflicts
@@ -0,0 +1,737 @@
+# -*- coding: utf-8 -*-
+"""
+Run commands as child processes, reading their output on threads.
+
+Each command runs on a thread of a pool, whose size bounds how many commands
+run at the same time. A thread per output pipe reads the output of the
+command, so the thread of the command is free to enforce its timeouts. On
+POSIX, the pipes are polled, so a reader stops as soon as it is asked to. On
+Windows, where pipes cannot be polled, a reader blocked on a pipe that never
+closes is left behind.
+"""
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals, with_statement)
+
+import collections
+import concurrent.futures
+import errno
+import io
+import mmap
+import os
+import re
+import select
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import six
+
+# Clock of the timeouts and of the wall time of commands, which does not jump
+# with the system clock, where available
+_monotonic = getattr(time, 'monotonic', time.time)
+
+# Number of bytes read from a pipe at a time
+READ_SIZE = 65536
+
+#: Number of seconds between two checks of whether a command ran out of time,
+#: or the run of the commands was interrupted
+POLL_INTERVAL = 1
+
+#: Number of bytes of the output of a pipe kept in memory, beyond which it is
+#: spilled to a temporary file
+SPILL_SIZE = 1048576
+
+#: Ways the output of a command may be returned
+OUTPUT_TYPES = ('bytes', 'buffer')
+
+#: Number of bytes buffered before the output of a command is written to
+#: its output file
+FILE_BUFFER_SIZE = 1048576
+
+#: Number of lines logged from the start and from the end of the output of a
+#: command that is written to an output file
+SUMMARY_HEAD_LINES = 10
+SUMMARY_TAIL_LINES = 10
+
+#: Number of seconds between two progress messages about the output of a
+#: command that is written to an output file
+SUMMARY_INTERVAL = 30
+
+#: Lines of the output of a command that are always logged, even when it is
+#: written to an output file
+SUMMARY_ERROR_PATTERN = re.compile(
+    br'\berror\b|\bcritical\b|\btraceback\b', re.IGNORECASE)
+
+#: Resources used by a command, as returned in the ``usage`` of its result:
+#: seconds from start to exit, seconds of user and system CPU time, maximum
+#: resident set size in KiB, and blocks read and written. Only ``wall`` is
+#: measured on Windows, the others are ``None``. CPU time, memory, and I/O
+#: include the descendants of the command it waited for.
+USAGE_FIELDS = ('wall', 'user', 'system', 'maxrss', 'inblock', 'oublock')
+
+#: Number of seconds a timed out command is given to exit after it is asked
+#: to terminate, before it is killed
+KILL_GRACE = 10
+
+
+class OutputBuffer(object):
+    """
+    Bounded-memory buffer of the output of a command.
+
+    Output is appended to a list of chunks, which is moved to a temporary
+    file as soon as it grows beyond ``spill_size``. Read it once the command
+    has exited.
+
+    Args:
+        spill_size: (:obj:`int`)
+            Number of bytes kept in memory.
+            (*Default*: :data:`SPILL_SIZE`)
+
+        spill_dir: (:obj:`str`)
+            Directory of the temporary file. When ``None``, the default
+            temporary directory is used.
+            (*Default*: ``None``)
+
+    """
+
+    def __init__(self, spill_size=SPILL_SIZE, spill_dir=None):
+        self.spill_size = spill_size
+        self.spill_dir = spill_dir
+        self.size = 0
+        self._chunks = []
+        self._file = None
+
+    def __len__(self):
+        """Return the number of bytes of output."""
+        return self.size
+
+    @property
+    def spilled(self):
+        """Whether the output was spilled to a temporary file."""
+        return self._file is not None
+
+    def write(self, data):
+        """Append ``data`` to the buffer."""
+        self.size += len(data)
+        if self._file is not None:
+            self._file.write(data)
+            return
+        self._chunks.append(data)
+        if self.size > self.spill_size:
+            # Kept open until the buffer is closed
+            # pylint: disable=consider-using-with
+            self._file = tempfile.TemporaryFile(
+                prefix='watchmaker-output-', dir=self.spill_dir)
+            self._file.writelines(self._chunks)
+            self._chunks = []
+
+    def view(self):
+        """
+        Return the output without copying it.
+
+        Returns:
+            :obj:`bytes` or :obj:`mmap.mmap`:
+                The output, joined once and kept as the only chunk, or a
+                read-only map of the temporary file when the output was
+                spilled.
+
+        """
+        if self._file is None:
+            self._chunks = [b''.join(self._chunks)]
+            return self._chunks[0]
+        self._file.flush()
+        return mmap.mmap(
+            self._file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def getvalue(self):
+        """Return the output as :obj:`bytes`."""
+        if self._file is None:
+            return b''.join(self._chunks)
+        self._file.flush()
+        self._file.seek(0)
+        try:
+            return self._file.read()
+        finally:
+            self._file.seek(0, os.SEEK_END)
+
+    def tail(self, size):
+        """Return the last ``size`` bytes of the output."""
+        if self._file is None:
+            return b''.join(self._chunks)[-size:]
+        self._file.flush()
+        self._file.seek(max(self.size - size, 0))
+        try:
+            return self._file.read()
+        finally:
+            self._file.seek(0, os.SEEK_END)
+
+    def close(self):
+        """Release the memory or the temporary file of the buffer."""
+        self._chunks = []
+        if self._file is not None:
+            self._file.close()
+
+
+class Pipe(object):
+    """
+    Where the output of a pipe of a command goes.
+
+    Args:
+        logger: (:obj:`callable`)
+            Called as ``logger('%s%s', prefix, line)`` for each line the
+            command writes to the pipe. When ``None``, the pipe is not logged.
+            (*Default*: ``None``)
+
+        prefix: (:obj:`str`)
+            Prefix of the logged lines.
+            (*Default*: ``''``)
+
+        path: (:obj:`str`)
+            File where the raw output of the pipe is appended, with large
+            buffered writes. When set, only a summary of the output is logged:
+            the first :data:`SUMMARY_HEAD_LINES` and last
+            :data:`SUMMARY_TAIL_LINES` lines, the lines matching
+            :data:`SUMMARY_ERROR_PATTERN`, and a progress message every
+            :data:`SUMMARY_INTERVAL` seconds. When ``None``, every line is
+            logged.
+            (*Default*: ``None``)
+
+        output: (:obj:`str`)
+            One of :data:`OUTPUT_TYPES`. With ``buffer``, the output of the
+            pipe is returned as an :obj:`OutputBuffer`, which does not need
+            to hold all of it in memory.
+            (*Default*: ``bytes``)
+
+    """
+
+    def __init__(self, logger=None, prefix='', path=None, output='bytes'):
+        self.logger = logger
+        self.prefix = prefix
+        self.path = path
+        self.output = output
+
+
+class Timeouts(object):
+    """
+    How long a command may run.
+
+    Args:
+        total: (:obj:`float`)
+            Number of seconds the command may run. When ``None``, it may run
+            indefinitely.
+            (*Default*: ``None``)
+
+        inactivity: (:obj:`float`)
+            Number of seconds the command may run without writing any output.
+            When ``None``, it may be silent indefinitely.
+            (*Default*: ``None``)
+
+        kill_grace: (:obj:`float`)
+            Number of seconds a timed out command is given to exit after it
+            is asked to terminate, before it is killed. When ``None``,
+            :data:`KILL_GRACE` applies.
+            (*Default*: ``None``)
+
+    """
+
+    def __init__(self, total=None, inactivity=None, kill_grace=None):
+        self.total = total
+        self.inactivity = inactivity
+        self.kill_grace = KILL_GRACE if kill_grace is None else kill_grace
+
+    def __bool__(self):
+        """Return whether the command may run out of time."""
+        return bool(self.total or self.inactivity)
+
+    __nonzero__ = __bool__
+
+
+class Command(object):
+    """
+    A command to run as a child process.
+
+    Args:
+        cmd: (:obj:`list`)
+            Command to execute.
+
+        stdout: (:obj:`Pipe`)
+            Where the stdout of the command goes. When ``None``, it is
+            returned as :obj:`bytes` and not logged.
+            (*Default*: ``None``)
+
+        stderr: (:obj:`Pipe`)
+            Same as ``stdout``, for stderr.
+            (*Default*: ``None``)
+
+        timeouts: (:obj:`Timeouts`)
+            How long the command may run. A command that may run out of time
+            runs in its own process group, or its own console process group
+            on Windows, and the whole group is terminated. When ``None``, it
+            may run indefinitely.
+            (*Default*: ``None``)
+
+        popen_kwargs:
+            Passed on to :obj:`subprocess.Popen`, e.g. ``env``.
+
+    """
+
+    def __init__(self, cmd, stdout=None, stderr=None, timeouts=None,
+                 **popen_kwargs):
+        self.cmd = cmd
+        self.stdout = stdout or Pipe()
+        self.stderr = stderr or Pipe()
+        self.timeouts = timeouts or Timeouts()
+        self.popen_kwargs = popen_kwargs
+        if self.timeouts:
+            # Run in a process group of its own, so the command can be
+            # terminated along with every process it started
+            if os.name == 'nt':
+                self.popen_kwargs.setdefault(
+                    'creationflags', subprocess.CREATE_NEW_PROCESS_GROUP)
+            elif six.PY2:
+                self.popen_kwargs.setdefault('preexec_fn', os.setsid)
+            else:
+                self.popen_kwargs.setdefault('start_new_session', True)
+        if six.PY2 and os.name != 'nt':
+            # Commands that start at the same time must not inherit the pipes
+            # of each other, or their output never reaches EOF
+            self.popen_kwargs.setdefault('close_fds', True)
+
+
+class RetryPolicy(object):
+    """
+    Which failures of a command are transient, and how to retry them.
+
+    A failed command matches the policy when its exit code is one of
+    ``retcodes`` and its stderr matches ``stderr_pattern``, ignoring either
+    when it is ``None``. It is retried with exponential backoff and full
+    jitter, until it succeeds, fails otherwise, or ``max_time`` is up.
+    Commands that ran out of time are never retried.
+
+    Args:
+        retcodes: (:obj:`tuple`)
+            Exit codes of transient failures.
+            (*Default*: ``None``)
+
+        stderr_pattern: (:obj:`str`)
+            Regular expression searched for in the stderr of transient
+            failures.
+            (*Default*: ``None``)
+
+        max_time: (:obj:`float`)
+            Number of seconds after the first attempt that a command may
+            still be retried.
+            (*Default*: ``300``)
+
+        max_wait: (:obj:`float`)
+            Number of seconds the wait between two attempts may grow to.
+            (*Default*: ``30``)
+
+    """
+
+    def __init__(self, retcodes=None, stderr_pattern=None, max_time=300,
+                 max_wait=30):
+        self.retcodes = retcodes
+        self.stderr_pattern = stderr_pattern
+        self.max_time = max_time
+        self.max_wait = max_wait
+        self._stderr_re = None
+        if stderr_pattern:
+            self._stderr_re = re.compile(
+                stderr_pattern.encode('utf-8'), re.IGNORECASE)
+
+    def matches(self, result):
+        """Return whether the result of a command is a transient failure."""
+        if result['retcode'] == 0 or result.get('timed_out'):
+            return False
+        if self.retcodes is not None and (
+            result['retcode'] not in self.retcodes
+        ):
+            return False
+        if self._stderr_re is None:
+            return True
+        stderr = result['stderr']
+        if isinstance(stderr, OutputBuffer):
+            if not stderr.size:
+                return False
+            stderr = stderr.view()
+        return self._stderr_re.search(stderr) is not None
+
+
+#: Failures of yum, dnf, and rpm caused by another process holding the rpm
+#: database or package manager lock, e.g. cloud-init on first boot
+PACKAGE_LOCK_RETRY = RetryPolicy(
+    stderr_pattern=(
+        r'Existing lock /var/run/yum\.pid'
+        r'|another app is currently holding the yum lock'
+        r"|can't create transaction lock"
+        r'|rpmdb open failed'
+        r'|Waiting for process with pid'),
+    max_time=600,
+)
+
+
+class _Output(object):
+    """Collect the output of a pipe, logging it line by line."""
+
+    def __init__(self, pipe):
+        self.logger = pipe.logger
+        self.prefix = pipe.prefix
+        self.path = pipe.path
+        self.output = pipe.output
+        self.buffer = OutputBuffer()
+        self.last_activity = _monotonic()
+        self._lock = threading.Lock()
+        self._closed = False
+        self._partial = b''
+        self._file = None
+        if self.path:
+            # Kept open until the pipe reaches EOF, see feed_eof()
+            # pylint: disable=consider-using-with
+            self._file = io.open(
+                self.path, 'ab', buffering=FILE_BUFFER_SIZE)
+        self._lines = 0
+        self._skipped = 0
+        self._tail = collections.deque(maxlen=SUMMARY_TAIL_LINES)
+        self._last_summary = self.last_activity
+
+    def feed(self, data):
+        with self._lock:
+            if self._closed:
+                # Read by a reader that was left behind
+                return
+            self.last_activity = _monotonic()
+            self.buffer.write(data)
+            if self._file:
+                self._file.write(data)
+            if self.logger:
+                lines = (self._partial + data).split(b'\n')
+                self._partial = lines.pop()
+                for line in lines:
+                    self._log_line(line.rstrip())
+
+    def feed_eof(self):
+        with self._lock:
+            if not self._closed:
+                self._closed = True
+                self._feed_eof()
+
+    def _feed_eof(self):
+        if self.logger and self._partial:
+            self._log_line(self._partial.rstrip())
+        self._partial = b''
+        if self._file:
+            self._file.close()
+            self._file = None
+            if self.logger and self._skipped > len(self._tail):
+                self.logger(
+                    '%s... %s lines skipped, see %s', self.prefix,
+                    self._skipped - len(self._tail), self.path)
+            for line in self._tail:
+                self.logger('%s%s', self.prefix, line)
+            self._skipped = 0
+            self._tail.clear()
+
+    def _log_line(self, line):
+        self._lines += 1
+        if (
+            not self.path or self._lines <= SUMMARY_HEAD_LINES or
+            SUMMARY_ERROR_PATTERN.search(line)
+        ):
+            self.logger('%s%s', self.prefix, line)
+            return
+        self._skipped += 1
+        self._tail.append(line)
+        if self.last_activity - self._last_summary >= SUMMARY_INTERVAL:
+            self._last_summary = self.last_activity
+            self.logger(
+                '%s... %s lines so far, see %s', self.prefix, self._lines,
+                self.path)
+
+    def getvalue(self):
+        if self.output == 'buffer':
+            return self.buffer
+        try:
+            return self.buffer.getvalue()
+        finally:
+            self.buffer.close()
+
+
+def _read_pipe(pipe, output, stopped, errors):
+    # Read a pipe on a thread until EOF, or until ``stopped`` is set. On
+    # Windows, where pipes cannot be polled, a blocked read is only left
+    # behind once the pipe is stopped.
+    def reader():
+        fd_ = pipe.fileno()
+        try:
+            while not stopped.is_set():
+                try:
+                    if os.name != 'nt' and not select.select(
+                        [fd_], [], [], POLL_INTERVAL
+                    )[0]:
+                        continue
+                    data = os.read(fd_, READ_SIZE)
+                # select.error is not an OSError on Python 2
+                except (select.error, OSError) as exc:  # noqa: B014
+                    if exc.args[:1] == (errno.EINTR,):
+                        # Interrupted by a signal, on Python 2
+                        continue
+                    errors.append(exc)
+                    break
+                if not data:
+                    break
+                output.feed(data)
+        finally:
+            pipe.close()
+
+    reader_thread = threading.Thread(target=reader, name='pipe-reader')
+    reader_thread.daemon = True
+    reader_thread.start()
+    return reader_thread
+
+
+def _join(threads, timeout):
+    # Return whether every thread finished within ``timeout`` seconds
+    deadline = _monotonic() + timeout
+    for thread in threads:
+        thread.join(max(deadline - _monotonic(), 0))
+    return not any(x.is_alive() for x in threads)
+
+
+def _reap(process):
+    if os.name == 'nt' or not hasattr(os, 'wait4'):
+        return process.wait(), None
+    try:
+        _, status, rusage = os.wait4(process.pid, 0)
+    except OSError as exc:
+        if exc.errno != errno.ECHILD:
+            raise
+        # Reaped already, e.g. by Popen itself
+        return process.wait(), None
+    if os.WIFSIGNALED(status):
+        process.returncode = -os.WTERMSIG(status)
+    else:
+        process.returncode = os.WEXITSTATUS(status)
+    return process.returncode, rusage
+
+
+def _get_usage(started, rusage):
+    usage = {
+        'wall': _monotonic() - started,
+        'user': None,
+        'system': None,
+        'maxrss': None,
+        'inblock': None,
+        'oublock': None,
+    }
+    if rusage is not None:
+        usage.update({
+            'user': rusage.ru_utime,
+            'system': rusage.ru_stime,
+            # Bytes on macOS, KiB elsewhere
+            'maxrss': (
+                rusage.ru_maxrss // 1024 if sys.platform == 'darwin'
+                else rusage.ru_maxrss),
+            'inblock': rusage.ru_inblock,
+            'oublock': rusage.ru_oublock,
+        })
+    return usage
+
+
+def _signal_group(process, force):
+    try:
+        if os.name == 'nt':
+            cmd = ['taskkill', '/T', '/PID', str(process.pid)]
+            if force:
+                cmd.insert(1, '/F')
+            with open(os.devnull, 'wb') as devnull:
+                subprocess.call(cmd, stdout=devnull, stderr=devnull)
+        else:
+            os.killpg(
+                process.pid, signal.SIGKILL if force else signal.SIGTERM)
+    except OSError:
+        # The group is gone already
+        pass
+
+
+def _get_timeout(command, started, outputs):
+    # Return the reason the command is out of time, and how long it may
+    # still run otherwise
+    now = _monotonic()
+    remaining = []
+    timeouts = command.timeouts
+    if timeouts.total:
+        remaining.append(('timeout', started + timeouts.total - now))
+    if timeouts.inactivity:
+        last_activity = max(x.last_activity for x in outputs)
+        remaining.append((
+            'inactivity', last_activity + timeouts.inactivity - now))
+    if not remaining:
+        return None, None
+    reason, wait = min(remaining, key=lambda x: x[1])
+    return (reason if wait <= 0 else None), max(wait, 0)
+
+
+class _Interrupted(Exception):
+    """The run of the commands was interrupted."""
+
+
+def _run(command, interrupted):
+    stdout = _Output(command.stdout)
+    stderr = _Output(command.stderr)
+    # Not a context manager on Python 2, it is reaped or killed below
+    process = subprocess.Popen(  # pylint: disable=consider-using-with
+        command.cmd,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        **command.popen_kwargs
+    )
+    started = _monotonic()
+    timed_out = None
+    stopped = threading.Event()
+    errors = []
+    readers = [
+        _read_pipe(process.stdout, stdout, stopped, errors),
+        _read_pipe(process.stderr, stderr, stopped, errors),
+    ]
+    try:
+        while True:
+            if interrupted.is_set():
+                raise _Interrupted()
+            timed_out, wait = _get_timeout(
+                command, started, (stdout, stderr))
+            if timed_out or _join(
+                readers, POLL_INTERVAL if wait is None
+                else min(wait, POLL_INTERVAL)
+            ):
+                break
+
+        if timed_out:
+            # Ask nicely first, then kill whatever is left of the group
+            _signal_group(process, force=False)
+            if not _join(readers, command.timeouts.kill_grace):
+                _signal_group(process, force=True)
+                if not _join(readers, command.timeouts.kill_grace):
+                    # A process that left the group holds the pipes open
+                    stopped.set()
+                    _join(readers, POLL_INTERVAL)
+        elif errors:
+            raise errors[0]
+        retcode, rusage = _reap(process)
+    except BaseException:
+        stopped.set()
+        process.kill()
+        process.wait()
+        raise
+    finally:
+        stdout.feed_eof()
+        stderr.feed_eof()
+    return {
+        'retcode': retcode,
+        'stdout': stdout.getvalue(),
+        'stderr': stderr.getvalue(),
+        'timed_out': timed_out,
+        'usage': _get_usage(started, rusage),
+    }
+
+
+def run_processes(commands, max_concurrency=None):
+    """
+    Run commands concurrently, and wait for all of them to exit.
+
+    Args:
+        commands: (:obj:`list`)
+            :obj:`Command` instances to run.
+
+        max_concurrency: (:obj:`int`)
+            Number of commands that may run at the same time. When ``None``,
+            every command is started at once.
+            (*Default*: ``None``)
+
+    Returns:
+        :obj:`list`:
+            One :obj:`dict` per command, in the order of ``commands``,
+            containing four keys: ``retcode`` (:obj:`int`), ``stdout``
+            (:obj:`bytes` or :obj:`OutputBuffer`), ``stderr`` (:obj:`bytes`
+            or :obj:`OutputBuffer`), ``timed_out``, which is ``timeout`` or
+            ``inactivity`` when the command was terminated for running out of
+            time, and ``None`` otherwise, and ``usage``, see
+            :data:`USAGE_FIELDS`.
+
+    Raises:
+        Any exception raised when starting or reading from a command, once
+        all the other commands have exited. When the run is interrupted,
+        e.g. by :obj:`KeyboardInterrupt`, the commands are killed.
+
+    """
+    interrupted = threading.Event()
+    executor = concurrent.futures.ThreadPoolExecutor(
+        max_workers=max_concurrency or len(commands) or 1)
+    futures = [
+        executor.submit(_run, command, interrupted) for command in commands]
+    try:
+        # Wait in steps, so that an interrupt reaches this thread
+        while concurrent.futures.wait(futures, POLL_INTERVAL).not_done:
+            pass
+    except BaseException:
+        interrupted.set()
+        for future in futures:
+            future.cancel()
+        raise
+    finally:
+        executor.shutdown(wait=True)
+    return [future.result() for future in futures]
+
+
+def format_usage(usage):
+    """Return the :data:`USAGE_FIELDS` of a :obj:`dict` as a log string."""
+    return ', '.join(
+        '{0}={1}'.format(
+            field,
+            round(usage[field], 2) if isinstance(usage[field], float)
+            else usage[field])
+        for field in USAGE_FIELDS)
+
+
+def summarize_usage(records):
+    """
+    Total the resources used by commands, by worker and executable.
+
+    Args:
+        records: (:obj:`list`)
+            Resources used by each command, as :obj:`dict` with the
+            :data:`USAGE_FIELDS`, the name of the ``worker`` that ran it,
+            and the ``cmd`` itself.
+
+    Returns:
+        :obj:`list`:
+            One :obj:`dict` per worker and executable, slowest first, with
+            the ``worker``, the ``command`` (the base name of the
+            executable), the ``count`` of runs, the totals of ``wall``,
+            ``user`` and ``system`` seconds, ``inblock`` and ``oublock``, and
+            the largest ``maxrss``. Totals of fields that were not measured
+            are ``None``.
+
+    """
+    summary = {}
+    for record in records:
+        command = os.path.basename(record['cmd'][0])
+        key = (record['worker'], command)
+        total = summary.setdefault(key, dict(
+            {field: None for field in USAGE_FIELDS},
+            worker=record['worker'], command=command, count=0))
+        total['count'] += 1
+        for field in USAGE_FIELDS:
+            value = record[field]
+            if value is None:
+                continue
+            if total[field] is None:
+                total[field] = value
+            elif field == 'maxrss':
+                total[field] = max(total[field], value)
+            else:
+                total[field] += value
+    return sorted(summary.values(), key=lambda x: -x['wall'])
@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+"""Follow the progress of salt states in the salt debug log."""
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals, with_statement)
+
+import io
+import os
+import re
+import threading
+
+#: Number of seconds between two reads of the salt log
+POLL_INTERVAL = 1
+
+_LEVEL = re.compile(r'\]\[(?P<level>[A-Z]+)\s*\]\[(?P<pid>\d+)\] ')
+_EXECUTING = re.compile(
+    r'Executing state (?P<fun>\S+) for \[(?P<name>.*)\]$')
+_COMPLETED = re.compile(
+    r'Completed state \[(?P<name>.*)\] at time \S+ '
+    r'\(duration_in_ms=(?P<duration>[\d.]+)\)')
+
+
+class StateProgress(object):
+    """
+    Report each salt state as it starts and completes.
+
+    A thread reads the lines salt appends to its log file, at ``debug`` or
+    ``info`` log file level, and reports the states they mention. Only the
+    lines appended after :meth:`start` are read. Several ``salt-call``
+    processes may log to the file at once, e.g. the shards of a parallel
+    highstate; the state each of them is running is tracked by its PID.
+
+    Args:
+        path: (:obj:`str`)
+            Salt log file.
+
+        logger: (:obj:`callable`)
+            Called as ``logger(msg, *args)`` for each state that starts and
+            completes.
+
+        interval: (:obj:`float`)
+            Number of seconds between two reads of the log file.
+            (*Default*: :data:`POLL_INTERVAL`)
+
+    """
+
+    def __init__(self, path, logger, interval=POLL_INTERVAL):
+        self.path = path
+        self.logger = logger
+        self.interval = interval
+        self.completed = 0
+        self.failed = 0
+        self._offset = 0
+        self._partial = ''
+        self._running = {}
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """Start following the log file from its current end."""
+        try:
+            self._offset = os.path.getsize(self.path)
+        except OSError:
+            self._offset = 0
+        self._thread = threading.Thread(
+            target=self._follow, name='salt-state-progress')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """Stop following the log file, once the lines left are read."""
+        self._stopped.set()
+        self._thread.join()
+        self._read()
+
+    def _follow(self):
+        while not self._stopped.wait(self.interval):
+            self._read()
+
+    def _read(self):
+        try:
+            if os.path.getsize(self.path) < self._offset:
+                # Rotated or truncated
+                self._offset = 0
+            with io.open(self.path, 'rb') as fh_:
+                fh_.seek(self._offset)
+                data = fh_.read()
+        except EnvironmentError:
+            return
+        self._offset += len(data)
+        lines = (self._partial + data.decode('utf-8', 'replace')).split('\n')
+        self._partial = lines.pop()
+        for line in lines:
+            self._parse(line.rstrip())
+
+    def _parse(self, line):
+        level = _LEVEL.search(line)
+        if not level:
+            return
+        message = line[level.end():]
+        pid = level.group('pid')
+
+        executing = _EXECUTING.match(message)
+        if executing:
+            current = self._running[pid] = {
+                'fun': executing.group('fun'),
+                'name': executing.group('name'),
+                'failed': False,
+            }
+            self.logger(
+                'Salt state started: %s %s', current['fun'], current['name'])
+            return
+
+        completed = _COMPLETED.match(message)
+        if completed:
+            current = self._running.pop(pid, None) or {
+                'fun': 'state', 'name': completed.group('name'),
+                'failed': False}
+            self.completed += 1
+            if current['failed']:
+                self.failed += 1
+            self.logger(
+                'Salt state %s in %.1fs: %s %s (%s completed, %s failed)',
+                'failed' if current['failed'] else 'completed',
+                float(completed.group('duration')) / 1000,
+                current['fun'], current['name'], self.completed, self.failed)
+            return
+
+        if pid in self._running and level.group('level') == 'ERROR':
+            self._running[pid]['failed'] = True
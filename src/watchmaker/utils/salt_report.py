@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+"""Timing reports of salt state runs."""
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals, with_statement)
+
+import watchmaker.utils.sls
+
+#: Number of the slowest states listed in a report
+TOP_STATES = 10
+
+_ID_DELIM = '_|-'
+
+
+def _get_duration(data):
+    # Milliseconds, a number in recent salt versions, e.g. "12.3 ms" in
+    # older ones
+    duration = data.get('duration', 0)
+    try:
+        return float(str(duration).split()[0]) / 1000
+    except (IndexError, ValueError):
+        return 0.0
+
+
+def _add(totals, key, name, state):
+    total = totals.setdefault(
+        key, {name: key, 'states': 0, 'changed': 0, 'duration': 0.0})
+    total['states'] += 1
+    total['changed'] += int(state['changed'])
+    total['duration'] += state['duration']
+
+
+def _ranked(totals):
+    return sorted(totals.values(), key=lambda x: -x['duration'])
+
+
+def state_report(state_return, top=TOP_STATES):
+    """
+    Rank the states of a salt state run by duration.
+
+    Args:
+        state_return: (:obj:`dict`)
+            Return of ``state.highstate`` or ``state.sls``, mapping the
+            ``<module>_|-<id>_|-<name>_|-<function>`` key of each state to
+            its result.
+
+        top: (:obj:`int`)
+            Number of the slowest states to list.
+            (*Default*: :data:`TOP_STATES`)
+
+    Returns:
+        :obj:`dict`:
+            Counts of the ``states``, and of the ``changed``, ``unchanged``,
+            and ``failed`` ones, their total ``duration`` in seconds, the
+            ``slowest`` states, and the ``sls`` files and ``formulas`` with
+            the count of their ``states``, ``changed`` states, and total
+            ``duration``, slowest first.
+
+    """
+    states = []
+    for key, data in state_return.items():
+        parts = key.split(_ID_DELIM)
+        sls = data.get('__sls__') or ''
+        states.append({
+            'id': data.get('__id__') or (parts[1] if len(parts) > 1 else key),
+            'function': '.'.join((parts[0], parts[-1])) if len(parts) > 3
+            else key,
+            'sls': sls,
+            'duration': _get_duration(data),
+            'result': data.get('result'),
+            'changed': bool(data.get('changes')),
+        })
+
+    per_sls = {}
+    per_formula = {}
+    for state in states:
+        _add(per_sls, state['sls'], 'sls', state)
+        _add(
+            per_formula, watchmaker.utils.sls.namespace(state['sls']),
+            'formula', state)
+
+    changed = sum(1 for x in states if x['changed'])
+    return {
+        'states': len(states),
+        'changed': changed,
+        'unchanged': len(states) - changed,
+        'failed': sum(1 for x in states if x['result'] is False),
+        'duration': sum(x['duration'] for x in states),
+        'slowest': sorted(states, key=lambda x: -x['duration'])[:top],
+        'sls': _ranked(per_sls),
+        'formulas': _ranked(per_formula),
+    }
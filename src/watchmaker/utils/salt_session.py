@@ -0,0 +1,303 @@
+# -*- coding: utf-8 -*-
+"""
+Long-lived salt execution session, answering salt calls over a pipe.
+
+Each ``salt-call`` process imports salt, loads its configuration, and loads
+the grains, before it runs a single execution module function. A session
+runs a helper process in the python interpreter of salt, which pays that
+cost once, and then runs one function after another with
+:class:`salt.client.Caller`.
+
+The helper and the client speak JSON lines over the stdin and stdout of the
+helper. A request is ``{"argv": [...]}``, where ``argv`` holds the function,
+its arguments, and optionally ``--out <outputter>``, as they are passed to
+``salt-call``. A response is ``{"retcode": ..., "stdout": ..., "stderr":
+...}``, where ``stdout`` is the return rendered by the salt outputter, as
+``salt-call`` prints it.
+
+The helper loads the configuration and the execution modules when the first
+function runs, and loads them again before the next function once the minion
+configuration or the grains file changed, or the modules were synced.
+
+This module only depends on the standard library, so that the helper can run
+it in the python interpreter of salt, where watchmaker is not installed.
+"""
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals, with_statement)
+
+import io
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+import traceback
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue  # noqa: N813
+
+try:
+    # Accepts the byte strings salt writes on Python 2
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+_monotonic = getattr(time, 'monotonic', time.time)
+
+#: Salt functions that are never run in a session, as they are long running,
+#: or change salt itself
+EXCLUDED_FUNCTIONS = ('state.', 'pkg.', 'pip.')
+
+#: Salt functions after which the execution modules of a session are
+#: reloaded, as they may have changed
+RELOAD_FUNCTIONS = ('saltutil.sync_', 'saltutil.refresh_modules')
+
+#: Files in the salt configuration directory that the session loads again
+#: when they change
+CONFIG_FILES = ('minion', 'grains')
+
+#: Number of seconds the helper is given to exit once it is closed
+CLOSE_TIMEOUT = 10
+
+# Number of seconds between two checks of whether the helper exited
+_POLL_INTERVAL = 0.1
+
+
+class SessionError(Exception):
+    """The salt session helper failed."""
+
+
+def _split_argv(argv):
+    out = None
+    args = []
+    argv = iter(argv)
+    for arg in argv:
+        if arg == '--out':
+            out = next(argv, None)
+        elif arg.startswith('--out='):
+            out = arg.split('=', 1)[1]
+        elif arg.startswith('-'):
+            return None, None
+        else:
+            args.append(arg)
+    return args, out
+
+
+def is_supported(argv):
+    """
+    Return whether a salt command may run in a session.
+
+    Args:
+        argv: (:obj:`list`)
+            Function, arguments, and options, as passed to ``salt-call``.
+
+    Returns:
+        :obj:`bool`:
+            ``True`` when the only option is ``--out``, and the function is
+            not one of the :data:`EXCLUDED_FUNCTIONS`.
+
+    """
+    args, _ = _split_argv(argv)
+    return bool(args) and not args[0].startswith(EXCLUDED_FUNCTIONS)
+
+
+class SaltSession(object):
+    """
+    Client of a salt session helper.
+
+    Args:
+        python: (:obj:`str`)
+            Python interpreter of salt.
+
+        config_dir: (:obj:`str`)
+            Salt configuration directory, as passed to ``salt-call
+            --config-dir``.
+
+        env: (:obj:`dict`)
+            Environment of the helper. When ``None``, it inherits the
+            environment of the current process.
+            (*Default*: ``None``)
+
+    """
+
+    def __init__(self, python, config_dir, env=None):
+        script = '{0}.py'.format(
+            os.path.splitext(os.path.abspath(__file__))[0])
+        # The helper outlives this call, it is stopped by close()
+        self.process = subprocess.Popen(  # pylint: disable=consider-using-with
+            [python, script, config_dir],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            env=env,
+        )
+        # Responses are read on a thread, so that a call can time out
+        self._responses = queue.Queue()
+        reader = threading.Thread(
+            target=self._read_responses, name='salt-session-reader')
+        reader.daemon = True
+        reader.start()
+
+    def _read_responses(self):
+        try:
+            for line in iter(self.process.stdout.readline, b''):
+                self._responses.put(line)
+        finally:
+            self.process.stdout.close()
+            self._responses.put(b'')
+
+    def call(self, argv, timeout=None):
+        """
+        Run a salt function in the session.
+
+        Args:
+            argv: (:obj:`list`)
+                Function, arguments, and options, as passed to ``salt-call``,
+                see :func:`is_supported`.
+
+            timeout: (:obj:`float`)
+                Number of seconds the function may run. When it runs out of
+                time, the helper is killed. When ``None``, it may run
+                indefinitely.
+                (*Default*: ``None``)
+
+        Returns:
+            :obj:`dict`:
+                Dictionary containing four keys: ``retcode`` (:obj:`int`),
+                ``stdout`` (:obj:`bytes`), and ``stderr`` (:obj:`bytes`), as
+                if ``salt-call`` ran the function, and ``wall``, the number
+                of seconds it ran.
+
+        Raises:
+            :obj:`SessionError`:
+                The helper exited, ran out of time, or its response was not
+                understood.
+
+        """
+        started = _monotonic()
+        try:
+            self.process.stdin.write(
+                json.dumps({'argv': argv}).encode('utf-8') + b'\n')
+            self.process.stdin.flush()
+            response = json.loads(
+                self._responses.get(timeout=timeout).decode('utf-8'))
+        except queue.Empty:
+            self.kill()
+            raise SessionError(
+                'Salt session helper killed: still running after {0} '
+                'seconds'.format(timeout))
+        except (EnvironmentError, ValueError) as exc:
+            raise SessionError(
+                'Salt session helper failed: {0}, retcode={1}'.format(
+                    exc, self.process.poll()))
+        return {
+            'retcode': response['retcode'],
+            'stdout': response['stdout'].encode('utf-8'),
+            'stderr': response['stderr'].encode('utf-8'),
+            'wall': _monotonic() - started,
+        }
+
+    def kill(self):
+        """Kill the helper."""
+        if self.process.poll() is None:
+            self.process.kill()
+        self.process.wait()
+
+    def close(self):
+        """Stop the helper, killing it if it does not exit in time."""
+        try:
+            self.process.stdin.close()
+        except EnvironmentError:
+            pass
+        deadline = _monotonic() + CLOSE_TIMEOUT
+        while self.process.poll() is None and _monotonic() < deadline:
+            time.sleep(_POLL_INTERVAL)
+        self.kill()
+
+
+def _get_context(caller):
+    pack = getattr(caller.sminion.functions, 'pack', {})
+    return pack.get('__context__', {})
+
+
+def _call(caller, opts, fun, args, out):
+    import salt.exceptions
+    import salt.output
+    import salt.utils.args
+
+    args, kwargs = salt.utils.args.parse_input(args, condition=False)
+
+    context = _get_context(caller)
+    context['retcode'] = 0
+    stderr = StringIO()
+    sys.stderr, saved_stderr = stderr, sys.stderr
+    try:
+        ret = caller.cmd(fun, *args, **kwargs)
+        retcode = context.get('retcode', 0)
+    except (salt.exceptions.SaltException, TypeError):
+        # As salt-call reports a failed function, or its wrong arguments.
+        # Anything else ends the helper, and the client uses salt-call
+        ret = traceback.format_exc()
+        retcode = 1
+    finally:
+        sys.stderr = saved_stderr
+
+    stdout = salt.output.string_format(
+        {'local': ret}, out or 'nested', opts=opts)
+    return {
+        'retcode': retcode,
+        'stdout': stdout + '\n',
+        'stderr': stderr.getvalue(),
+    }
+
+
+def _new_caller(opts):
+    import salt.client
+    return salt.client.Caller(mopts=opts)
+
+
+def _load_opts(config_dir):
+    import salt.config
+
+    opts = salt.config.minion_config(os.path.join(config_dir, 'minion'))
+    opts['file_client'] = 'local'
+    opts['color'] = False
+    return opts
+
+
+def _get_config_stamp(config_dir):
+    stamp = []
+    for name in CONFIG_FILES:
+        try:
+            stat = os.stat(os.path.join(config_dir, name))
+            stamp.append((stat.st_mtime, stat.st_size))
+        except OSError:
+            stamp.append(None)
+    return stamp
+
+
+def serve(config_dir):
+    """Answer the requests on stdin until it is closed."""
+    # Keep stdout for responses, anything else printed goes to stderr
+    with io.open(os.dup(sys.stdout.fileno()), 'wb') as responses:
+        os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+
+        opts = caller = stamp = None
+        for line in iter(sys.stdin.readline, ''):
+            args, out = _split_argv(json.loads(line)['argv'])
+            if caller is None or _get_config_stamp(config_dir) != stamp:
+                stamp = _get_config_stamp(config_dir)
+                opts = _load_opts(config_dir)
+                caller = _new_caller(opts)
+            response = _call(caller, opts, args[0], args[1:], out)
+            responses.write(json.dumps(response).encode('utf-8') + b'\n')
+            responses.flush()
+            if args[0].startswith(RELOAD_FUNCTIONS):
+                # Loaded again before the next function, if there is one
+                caller = None
+
+
+if __name__ == '__main__':
+    serve(sys.argv[1])
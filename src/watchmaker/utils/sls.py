@@ -0,0 +1,397 @@
+# -*- coding: utf-8 -*-
+"""Static analysis of salt top files and SLS files."""
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals, with_statement)
+
+import collections
+import io
+import os
+import re
+
+import yaml
+
+# File types that may reference other SLS namespaces
+SALT_FILE_EXTENSIONS = ('.sls', '.jinja', '.j2', '.jinja2', '.tmpl', '.yml',
+                        '.yaml')
+
+# Requisites that order states, or make one depend on the result of another
+REQUISITES = ('require', 'watch', 'onchanges', 'onfail', 'prereq', 'use',
+              'listen')
+_REQUISITE_KEYS = frozenset(
+    [x + suffix for x in REQUISITES for suffix in ('', '_in', '_any')] +
+    ['onfail_all'])
+
+_JINJA_BLOCK = re.compile(r'{%.*?%}|{#.*?#}', re.DOTALL)
+_JINJA_EXPRESSION = re.compile(r'{{.*?}}', re.DOTALL)
+_JINJA_PLACEHOLDER = '__jinja__'
+
+_NAME = r'[A-Za-z0-9_\-]+'
+_REFERENCES = (
+    # include:
+    #   - foo.bar
+    re.compile(
+        r'^include:[ \t]*\n((?:[ \t]*(?:-.*)?\n?)+)', re.MULTILINE),
+    # - sls: foo.bar
+    re.compile(r'\bsls:[ \t]*[\'"]?({0})'.format(_NAME)),
+    # salt://foo/bar.conf
+    re.compile(r'salt://({0})/'.format(_NAME)),
+    # {% from "foo/map.jinja" import foo %}
+    re.compile(
+        r'\b(?:from|import|include)[ \t]+[\'"]({0})/'.format(_NAME)),
+)
+_INCLUDE_ITEM = re.compile(
+    r'^[ \t]*-[ \t]*[\'"]?({0})'.format(_NAME), re.MULTILINE)
+_INCLUDE_TEMPLATED = re.compile(
+    r'^[ \t]*-[ \t]*[\'"]?{0}'.format(_JINJA_PLACEHOLDER), re.MULTILINE)
+# Variables salt sets to the location of the file being rendered, so they
+# stay within the namespace of the file itself, e.g. `{{ tplroot }}.config`
+_OWN_NAMESPACE = re.compile(
+    r'{{-?\s*(?:tplroot|tpldir|tplpath|slspath|slsdotpath|slscolonpath|sls)'
+    r'\b[^{}]*}}')
+
+
+def namespace(sls):
+    """Return the namespace, i.e. the top-level name, of an SLS reference."""
+    return sls.split('.', 1)[0].split('/', 1)[0]
+
+
+def read_text(path):
+    """Return the contents of a text file, ignoring undecodable bytes."""
+    with io.open(path, 'r', encoding='utf-8', errors='ignore') as fh_:
+        return fh_.read()
+
+
+def top_file_states(text, saltenv='base'):
+    """
+    Find the SLS files a top file assigns in a salt environment.
+
+    Jinja is stripped before the top file is parsed, so targets and states
+    that are only known once the template is rendered cannot be resolved.
+
+    Args:
+        text: (:obj:`str`)
+            Contents of the top file.
+
+        saltenv: (:obj:`str`)
+            Salt environment to read.
+            (*Default*: ``base``)
+
+    Returns:
+        :obj:`set`:
+            The SLS names assigned to any target, or ``None`` when they
+            cannot be determined statically.
+
+    """
+    text = _JINJA_BLOCK.sub('', text)
+    text = _JINJA_EXPRESSION.sub(_JINJA_PLACEHOLDER, text)
+    try:
+        top = yaml.safe_load(text) or {}
+    except yaml.YAMLError:
+        return None
+
+    if not isinstance(top, dict):
+        return None
+
+    states = set()
+    for items in (top.get(saltenv) or {}).values():
+        for item in items or []:
+            if isinstance(item, dict):
+                # Match options, e.g. `- match: grain`
+                continue
+            if _JINJA_PLACEHOLDER in str(item):
+                return None
+            states.add(str(item))
+    return states
+
+
+def referenced_namespaces(text):
+    """
+    Find the SLS namespaces referenced by the contents of a salt file.
+
+    Jinja statements are stripped before includes are read, so an include
+    that is only known once the template is rendered, e.g. one read from the
+    pillar, cannot be resolved.
+
+    Args:
+        text: (:obj:`str`)
+            Contents of the salt file.
+
+    Returns:
+        :obj:`set`:
+            The SLS namespaces referenced, or ``None`` when an include
+            cannot be determined statically.
+
+    """
+    # Includes are read without the jinja statements, e.g. a loop over
+    # included names
+    include_text = _JINJA_EXPRESSION.sub(
+        _JINJA_PLACEHOLDER,
+        _OWN_NAMESPACE.sub('.', _JINJA_BLOCK.sub('', text)))
+    namespaces = set()
+    for match in _REFERENCES[0].finditer(include_text):
+        if _INCLUDE_TEMPLATED.search(match.group(1)):
+            return None
+        namespaces.update(_INCLUDE_ITEM.findall(match.group(1)))
+    for pattern in _REFERENCES[1:]:
+        for match in pattern.finditer(text):
+            namespaces.add(match.group(1))
+    # Relative includes, e.g. `.bar`, never match, as they stay within the
+    # namespace of the file itself
+    return namespaces
+
+
+def tree_namespaces(root):
+    """
+    Find the SLS namespaces referenced by the salt files in a tree.
+
+    Args:
+        root: (:obj:`str`)
+            Directory of the salt files.
+
+    Returns:
+        :obj:`set`:
+            The SLS namespaces referenced, or ``None`` when an include of
+            any salt file cannot be determined statically, see
+            :func:`referenced_namespaces`.
+
+    """
+    namespaces = set()
+    for dirpath, dirs, files in os.walk(root):
+        dirs[:] = [x for x in dirs if not x.startswith('.')]
+        for name in files:
+            if name.endswith(SALT_FILE_EXTENSIONS):
+                found = referenced_namespaces(
+                    read_text(os.path.join(dirpath, name)))
+                if found is None:
+                    return None
+                namespaces.update(found)
+    return namespaces
+
+
+def state_namespaces(states, top_file):
+    """
+    Find the SLS namespaces a run of salt states applies.
+
+    Args:
+        states: (:obj:`list`)
+            Salt states to apply, where ``highstate`` applies the states
+            the top file assigns, and ``none`` applies nothing.
+
+        top_file: (:obj:`str`)
+            Path to the top file of the base environment.
+
+    Returns:
+        :obj:`set`:
+            The SLS namespaces applied, or ``None`` when the states the top
+            file assigns cannot be determined statically, see
+            :func:`top_file_states`.
+
+    """
+    namespaces = set()
+    for state in states:
+        if state.lower() == 'highstate':
+            top_states = None
+            if os.path.isfile(top_file):
+                top_states = top_file_states(read_text(top_file))
+            if top_states is None:
+                return None
+            namespaces.update(namespace(x) for x in top_states)
+        elif state.lower() != 'none':
+            namespaces.add(namespace(state))
+    return namespaces
+
+
+def formula_providers(paths):
+    """
+    Map each SLS namespace to the formula providing it.
+
+    Args:
+        paths: (:obj:`list`)
+            Paths of the files of the formulas, relative to the directory
+            of the formulas, with ``/`` separators, e.g. the paths of a
+            manifest.
+
+    Returns:
+        :obj:`tuple`:
+            A :obj:`dict` of each SLS namespace to the first formula that
+            provides it, and a :obj:`set` of the formulas with salt
+            extension modules, e.g. ``_modules``, which any run may use.
+
+    """
+    providers = {}
+    with_modules = set()
+    for path in paths:
+        parts = path.split('/')
+        if len(parts) < 2 or parts[1].startswith('.'):
+            continue
+        if parts[1].startswith('_'):
+            with_modules.add(parts[0])
+        elif len(parts) > 2:
+            providers.setdefault(parts[1], parts[0])
+        elif parts[1].endswith('.sls'):
+            providers.setdefault(parts[1][:-len('.sls')], parts[0])
+    return providers, with_modules
+
+
+def reachable_formulas(providers, namespaces, trees, formulas_dir,
+                       reached=()):
+    """
+    Find the formulas a run reaches, following includes and references.
+
+    The salt files of ``trees`` are read first, then the salt files of each
+    formula reached along the way, until no new formula is reached.
+
+    Args:
+        providers: (:obj:`dict`)
+            Each SLS namespace and the formula providing it, see
+            :func:`formula_providers`.
+
+        namespaces: (:obj:`set`)
+            SLS namespaces the run applies.
+
+        trees: (:obj:`list`)
+            Directories of salt files the run reads, e.g. the salt content.
+
+        formulas_dir: (:obj:`str`)
+            Directory of the formulas in ``providers``.
+
+        reached: (:obj:`list`)
+            Formulas the run reaches in any case, whose salt files are read
+            as well.
+            (*Default*: ``()``)
+
+    Returns:
+        :obj:`set`:
+            The formulas reached, or ``None`` when an include of any salt
+            file cannot be determined statically, see
+            :func:`referenced_namespaces`.
+
+    """
+    reached = set(reached)
+    pending = list(reached)
+    namespaces = set(namespaces)
+    while True:
+        for tree in trees:
+            found = tree_namespaces(tree)
+            if found is None:
+                return None
+            namespaces.update(found)
+        for name in namespaces:
+            formula = providers.get(name)
+            if formula and formula not in reached:
+                reached.add(formula)
+                pending.append(formula)
+        if not pending:
+            return reached
+        namespaces = set()
+        trees = [os.path.join(formulas_dir, x) for x in pending]
+        pending = []
+
+
+def _requisite_targets(chunks, ref):
+    # SLS files of the states a requisite refers to, or None when it cannot
+    # be resolved statically, e.g. a glob
+    if isinstance(ref, dict):
+        targets = list(ref.items())
+    else:
+        targets = [(None, ref)]
+
+    found = set()
+    for module, target in targets:
+        if module == 'sls':
+            found.add(target)
+            continue
+        matches = set(
+            chunk['__sls__'] for chunk in chunks
+            if target in (chunk.get('__id__'), chunk.get('name')) and
+            module in (None, 'id', chunk.get('state'))
+        )
+        if not matches:
+            return None
+        found.update(matches)
+    return found
+
+
+def independent_sls_groups(lowstate):
+    """
+    Partition the SLS files of a lowstate into groups without requisites.
+
+    Two SLS files are in the same group when any state of one has a
+    requisite, e.g. ``require``, ``watch_in``, or ``onchanges_any``, on a
+    state of the other, directly or through other SLS files. The groups can
+    be applied concurrently, each as if no other SLS file existed. The
+    ``order`` of states across groups is not kept.
+
+    Args:
+        lowstate: (:obj:`list`)
+            Return of ``state.show_lowstate``, a :obj:`dict` per state.
+
+    Returns:
+        :obj:`list`:
+            Groups of SLS names, each a sorted :obj:`list`, in order of
+            their first state in the lowstate, or ``None`` when a requisite
+            cannot be resolved.
+
+    """
+    parent = {}
+
+    def find(sls):
+        while parent[sls] != sls:
+            parent[sls] = parent[parent[sls]]
+            sls = parent[sls]
+        return sls
+
+    chunks = [x for x in lowstate if isinstance(x, dict) and '__sls__' in x]
+    for chunk in chunks:
+        parent.setdefault(chunk['__sls__'], chunk['__sls__'])
+
+    for chunk in chunks:
+        for key, refs in chunk.items():
+            if key not in _REQUISITE_KEYS:
+                continue
+            for ref in refs if isinstance(refs, list) else [refs]:
+                targets = _requisite_targets(chunks, ref)
+                if targets is None:
+                    return None
+                for target in targets:
+                    if target not in parent:
+                        return None
+                    parent[find(target)] = find(chunk['__sls__'])
+
+    groups = collections.OrderedDict()
+    for chunk in chunks:
+        groups.setdefault(find(chunk['__sls__']), []).append(chunk['__sls__'])
+    return [sorted(set(x)) for x in groups.values()]
+
+
+def shard_commands(cmd, groups):
+    """
+    Split a salt highstate command into one per independent SLS group.
+
+    Each command applies the highstate, excluding the SLS files of the other
+    groups, along with any exclusions of ``cmd``, and runs concurrently with
+    the others.
+
+    Args:
+        cmd: (:obj:`list`)
+            Command that applies the highstate.
+
+        groups: (:obj:`list`)
+            Groups of SLS names, see :func:`independent_sls_groups`.
+
+    Returns:
+        :obj:`list`:
+            The command of each group, in the order of ``groups``.
+
+    """
+    base_cmd = [x for x in cmd if not x.startswith('exclude=')]
+    user_exclude = [
+        x[len('exclude='):] for x in cmd if x.startswith('exclude=')]
+    every_sls = set(x for group in groups for x in group)
+    return [
+        base_cmd + [
+            'exclude={0}'.format(','.join(
+                sorted(every_sls.difference(group)) + user_exclude)),
+            'concurrent=True']
+        for group in groups
+    ]
@@ -0,0 +1,207 @@
+# -*- coding: utf-8 -*-
+"""
+Trash of working directories, and eviction of the extraction cache.
+
+Deleting a large tree takes a while, so working directories are moved to a
+trash directory next to them when watchmaker cleans up, and trees that are
+no longer kept are deleted in a process detached from watchmaker, which goes
+on when watchmaker exits.
+"""
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals, with_statement)
+
+import os
+import shutil
+import subprocess
+import time
+
+import six
+
+TRASH_DIR_NAME = '.trash'
+
+# Prefix of the extraction cache entries that are being evicted
+EVICTED_PREFIX = '.evicted-'
+
+# Windows process creation flag of a process without a console, which lives
+# on when its parent exits
+DETACHED_PROCESS = 0x00000008
+
+
+def move_to_trash(path):
+    """
+    Move a tree to the trash directory next to it.
+
+    Args:
+        path: (:obj:`str`)
+            Path to the tree.
+
+    Returns:
+        :obj:`str`: Path to the trash directory.
+
+    """
+    trash_dir = os.path.join(os.path.dirname(path), TRASH_DIR_NAME)
+    try:
+        os.makedirs(trash_dir)
+    except OSError:
+        if not os.path.isdir(trash_dir):
+            raise
+    # Name the entry after the time it was trashed, which renaming does not
+    # record anywhere else
+    os.rename(path, os.path.join(trash_dir, '{0}-{1}'.format(
+        int(time.time()), os.path.basename(path))))
+    return trash_dir
+
+
+def purge_trash(trash_dir, max_age, max_size, log):
+    """
+    Delete the trees in a trash directory that are no longer kept.
+
+    The newest trees are kept, while they are younger than ``max_age`` and
+    fit in ``max_size`` together.
+
+    Args:
+        trash_dir: (:obj:`str`)
+            Path to the trash directory.
+
+        max_age: (:obj:`int`)
+            Number of seconds a tree is kept in the trash.
+
+        max_size: (:obj:`int`)
+            Number of bytes the trees kept in the trash may take up.
+
+        log: (:obj:`logging.Logger`)
+            Logger to report to.
+
+    Returns:
+        :obj:`subprocess.Popen`: The process deleting the trees in the
+        background, or ``None`` when nothing was deleted in the background.
+
+    """
+    entries = []
+    for name in os.listdir(trash_dir):
+        try:
+            trashed_at = int(name.split('-', 1)[0])
+        except ValueError:
+            trashed_at = 0
+        entries.append((trashed_at, os.path.join(trash_dir, name)))
+    expired = _get_expired(entries, max_age, max_size)
+    if not expired:
+        return None
+    return _remove_in_background(expired, 'the trash', log)
+
+
+def evict_extract_cache(cache_dir, max_age, max_size, log):
+    """
+    Delete the extracted archives in a cache that are no longer kept.
+
+    The most recently used archives are kept, while they were used within
+    ``max_age`` and fit in ``max_size`` together. Extractions in progress
+    are left alone.
+
+    Args:
+        cache_dir: (:obj:`str`)
+            Path to the extraction cache.
+
+        max_age: (:obj:`int`)
+            Number of seconds since its last use that an archive is kept.
+            When ``None``, archives are kept indefinitely.
+
+        max_size: (:obj:`int`)
+            Number of bytes the archives kept may take up. When ``None``,
+            their size is not bounded.
+
+        log: (:obj:`logging.Logger`)
+            Logger to report to.
+
+    Returns:
+        :obj:`subprocess.Popen`: The process deleting the archives in the
+        background, or ``None`` when nothing was deleted in the background.
+
+    """
+    # Extractions in progress are named `<digest>-<random>`, and evicted
+    # entries left by an earlier run are removed again
+    entries = []
+    evicted = []
+    for name in os.listdir(cache_dir):
+        path = os.path.join(cache_dir, name)
+        if name.startswith(EVICTED_PREFIX):
+            evicted.append(path)
+        elif '-' not in name and not name.startswith('.'):
+            entries.append((os.stat(path).st_mtime, path))
+    for path in _get_expired(
+        entries,
+        float('inf') if max_age is None else max_age,
+        float('inf') if max_size is None else max_size,
+    ):
+        # Rename the entry first, so it is a cache miss rather than a partial
+        # tree while it is deleted
+        evicted_path = os.path.join(
+            cache_dir, EVICTED_PREFIX + os.path.basename(path))
+        try:
+            os.rename(path, evicted_path)
+        except OSError:
+            continue
+        evicted.append(evicted_path)
+    if not evicted:
+        return None
+    return _remove_in_background(evicted, 'the extraction cache', log)
+
+
+def _get_expired(entries, max_age, max_size):
+    # Keep the newest (time, path) entries, while they are younger than
+    # max_age and fit in max_size together
+    now = time.time()
+    kept_size = 0
+    expired = []
+    for used_at, path in sorted(entries, reverse=True):
+        size = 0
+        for root, _, files in os.walk(path):
+            for filename in files:
+                try:
+                    size += os.lstat(os.path.join(root, filename)).st_size
+                except OSError:
+                    pass
+        if now - used_at < max_age and kept_size + size <= max_size:
+            kept_size += size
+            continue
+        expired.append(path)
+    return expired
+
+
+def _remove_in_background(paths, source, log):
+    try:
+        remover = _remove_detached(paths)
+    except OSError as exc:
+        log.warning(
+            'Could not delete from %s in the background, deleting now: %s',
+            source, exc)
+        for path in paths:
+            shutil.rmtree(path, ignore_errors=True)
+        return None
+    log.debug('Deleting from %s in the background: %s', source, paths)
+    return remover
+
+
+def _remove_detached(paths):
+    # Delete in a process detached from watchmaker, so the deletion goes on
+    # when watchmaker exits right after its cleanup
+    if os.name == 'nt':
+        cmd = ['cmd', '/c']
+        for path in paths:
+            if len(cmd) > 2:
+                cmd.append('&')
+            cmd.extend(['rmdir', '/s', '/q', path])
+        kwargs = {'creationflags': (
+            DETACHED_PROCESS | subprocess.CREATE_NEW_PROCESS_GROUP)}
+    else:
+        cmd = ['rm', '-rf', '--'] + paths
+        kwargs = {'close_fds': True}
+        if six.PY2:
+            kwargs['preexec_fn'] = os.setsid
+        else:
+            kwargs['start_new_session'] = True
+    with open(os.devnull, 'r+b') as devnull:
+        # Outlives this call on purpose, it is returned to be waited on
+        # pylint: disable=consider-using-with
+        return subprocess.Popen(
+            cmd, stdin=devnull, stdout=devnull, stderr=devnull, **kwargs)
@@ -6,15 +6,41 @@ from __future__ import (absolute_import, division, print_function,
 import abc
 import logging
 
+from watchmaker.exceptions import InvalidValue
+
 
 class WorkerBase(object):
-    """Define the architecture of a Worker."""
+    """
+    Define the architecture of a Worker.
+
+    Args:
+        command_timeout: (:obj:`int`)
+            Number of seconds any command run by the worker may run before it
+            is terminated, along with every process it started. It is asked
+            to terminate first, and killed if it does not exit within a grace
+            period. When ``0``, commands may run indefinitely.
+            (*Default*: ``0``)
+
+        command_inactivity_timeout: (:obj:`int`)
+            Number of seconds any command run by the worker may run without
+            writing any output before it is terminated, as with
+            ``command_timeout``. A salt highstate writes little output until
+            it completes, so this must exceed the longest running state.
+            When ``0``, commands may be silent indefinitely.
+            (*Default*: ``0``)
+
+    """
 
     def __init__(self, system_params, *args, **kwargs):
         self.log = logging.getLogger(
             '{0}.{1}'.format(__name__, self.__class__.__name__)
         )
 
+        # Pop arguments used by WorkerBase
+        self.command_timeout = kwargs.pop('command_timeout', None) or 0
+        self.command_inactivity_timeout = \
+            kwargs.pop('command_inactivity_timeout', None) or 0
+
         self.system_params = system_params
         WorkerBase.args = args
         WorkerBase.kwargs = kwargs
@@ -28,3 +54,18 @@ class WorkerBase(object):
     def install(self):
         """Add install method to all child classes."""
         pass
+
+    def _validate_non_negative(self, *options):
+        # Raise when an option is not a non-negative number
+        for option in options:
+            try:
+                value = float(getattr(self, option))
+            except (TypeError, ValueError):
+                value = -1
+            if value < 0:
+                msg = (
+                    'Selected {0} ({1}) is not a non-negative number'.format(
+                        option, getattr(self, option))
+                )
+                self.log.critical(msg)
+                raise InvalidValue(msg)
@@ -3,12 +3,9 @@
 from __future__ import (absolute_import, division, print_function,
                         unicode_literals, with_statement)
 
-import ast
 import codecs
 import glob
-import json
 import os
-import shutil
 
 import yaml
 
@@ -18,13 +15,22 @@ from watchmaker.exceptions import InvalidValue, WatchmakerException
 from watchmaker.managers.platform import (LinuxPlatformManager,
                                           PlatformManagerBase,
                                           WindowsPlatformManager)
+from watchmaker.managers.systemd import SystemdServiceMixin
 from watchmaker.workers.base import WorkerBase
+from watchmaker.workers.salt_calls import SaltCallsMixin
+from watchmaker.workers.salt_staging import SaltStagingMixin
 
 
-class SaltBase(WorkerBase, PlatformManagerBase):
+class SaltBase(SaltStagingMixin, SaltCallsMixin, WorkerBase,
+               PlatformManagerBase):
     r"""
     Cross-platform worker for running salt.
 
+    Also accepts the arguments of
+    :class:`watchmaker.workers.base.WorkerBase`,
+    :class:`watchmaker.workers.salt_staging.SaltStagingMixin` and
+    :class:`watchmaker.workers.salt_calls.SaltCallsMixin`.
+
     Args:
         salt_debug_log: (:obj:`list`)
             Filesystem path to a file where the salt debug output should be
@@ -158,9 +164,11 @@ class SaltBase(WorkerBase, PlatformManagerBase):
         self.salt_call = None
         self.salt_base_env = None
         self.salt_formula_root = None
+        self.salt_pillar_root = None
         self.salt_file_roots = None
         self.salt_state_args = None
         self.salt_debug_logfile = None
+        self.salt_srv = None
 
     def before_install(self):
         """Validate configuration before starting install."""
@@ -178,6 +186,11 @@ class SaltBase(WorkerBase, PlatformManagerBase):
             self.log.critical(msg)
             raise InvalidValue(msg)
 
+        self._validate_non_negative(
+            'command_timeout', 'command_inactivity_timeout')
+
+        super(SaltBase, self).before_install()
+
     def install(self):
         """Install Salt."""
         pass
@@ -192,6 +205,12 @@ class SaltBase(WorkerBase, PlatformManagerBase):
         )
 
     def _prepare_for_install(self):
+        self._prepare_staging()
+
+        if self.command_output_files:
+            self.command_output_dir = os.sep.join(
+                (self.salt_log_dir, self.COMMAND_OUTPUT_DIR_NAME))
+
         self.working_dir = self.create_working_dir(
             self.salt_working_dir,
             self.salt_working_dir_prefix
@@ -231,59 +250,14 @@ class SaltBase(WorkerBase, PlatformManagerBase):
         ) as fh_:
             yaml.safe_dump(self.salt_conf, fh_, default_flow_style=False)
 
-    def _get_formulas_conf(self):
-
-        # Append Salt formulas bundled with Watchmaker package.
-        formulas_path = os.sep.join((static.__path__[0], 'salt', 'formulas'))
-        for formula in os.listdir(formulas_path):
-            formula_path = os.path.join(self.salt_formula_root, '', formula)
-            watchmaker.utils.copytree(
-                os.sep.join((formulas_path, formula)),
-                formula_path,
-                force=True
-            )
-
-        # Obtain & extract any Salt formulas specified in user_formulas.
-        for formula_name, formula_url in self.user_formulas.items():
-            filename = os.path.basename(formula_url)
-            file_loc = os.sep.join((self.working_dir, filename))
-
-            # Download the formula
-            self.retrieve_file(formula_url, file_loc)
-
-            # Extract the formula
-            formula_working_dir = self.create_working_dir(
-                self.working_dir,
-                '{0}-'.format(filename)
-            )
-            self.extract_contents(
-                filepath=file_loc,
-                to_directory=formula_working_dir
-            )
-
-            # Get the first directory within the extracted directory
-            formula_inner_dir = os.path.join(
-                formula_working_dir,
-                next(os.walk(formula_working_dir))[1][0]
-            )
-
-            # Move the formula to the formula root
-            formula_loc = os.sep.join((self.salt_formula_root, formula_name))
-            self.log.debug(
-                'Placing user formula in salt file roots. formula_url=%s, '
-                'formula_loc=%s',
-                formula_url, formula_loc
-            )
-            if os.path.exists(formula_loc):
-                shutil.rmtree(formula_loc)
-            shutil.move(formula_inner_dir, formula_loc)
-
-        return [
-            os.path.join(self.salt_formula_root, x) for x in next(os.walk(
-                self.salt_formula_root))[1]
-        ]
+        if self.warm_page_cache:
+            # Runs while the network-bound steps of the install are underway
+            self._start_page_cache_warming()
 
     def _build_salt_formula(self, extract_dir):
+        if self.salt_srv_version:
+            extract_dir = self.salt_srv_version
+
         if self.salt_content:
             salt_content_filename = watchmaker.utils.basename_from_uri(
                 self.salt_content
@@ -337,7 +311,10 @@ class SaltBase(WorkerBase, PlatformManagerBase):
             (static.__path__[0], 'salt', 'content')
         )
         watchmaker.utils.copy_subdirectories(
-            bundled_content, extract_dir, self.log)
+            bundled_content, extract_dir, self.log, self.staging_method)
+
+        self.salt_file_roots = {'file_roots': {
+            'base': self._stage_file_roots(extract_dir)}}
 
         with codecs.open(
             os.path.join(self.salt_conf_path, 'minion'),
@@ -345,17 +322,20 @@ class SaltBase(WorkerBase, PlatformManagerBase):
             encoding="utf-8"
         ) as fh_:
             salt_conf = yaml.safe_load(fh_)
-            salt_conf.update(self.salt_file_roots)
+            salt_conf.update({'file_roots': {'base': [
+                self._get_live_path(x)
+                for x in self.salt_file_roots['file_roots']['base']
+            ]}})
             fh_.seek(0)
             yaml.safe_dump(salt_conf, fh_, default_flow_style=False)
 
-    def _set_grain(self, grain, value):
-        cmd = [
-            'grains.setval',
-            grain,
-            str(json.dumps(value))
-        ]
-        self.run_salt(cmd)
+        if self.salt_srv_version:
+            self._activate_srv_version()
+
+    def _get_file_roots(self, formulas_conf):
+        file_roots = [str(self.salt_base_env)]
+        file_roots += [str(x) for x in formulas_conf]
+        return file_roots
 
     def _get_grain(self, grain):
         grain_full = self.run_salt(['grains.get', grain])
@@ -452,6 +432,11 @@ class SaltBase(WorkerBase, PlatformManagerBase):
         """
         Execute salt command.
 
+        When the salt session is started, see ``salt_session``, commands
+        that :func:`watchmaker.utils.salt_session.is_supported` accepts run
+        in the session instead of salt-call. The session is started once
+        salt is installed, and stopped before the states are applied.
+
         Args:
             command: (:obj:`str` or :obj:`list`)
                 Salt options and a salt module to be executed by salt-call.
@@ -460,20 +445,13 @@ class SaltBase(WorkerBase, PlatformManagerBase):
                 do not specify those options in the command.
 
         """
-        cmd = [
-            self.salt_call,
-            '--local',
-            '--retcode-passthrough',
-            '--no-color',
-            '--config-dir',
-            self.salt_conf_path
-        ]
-        if isinstance(command, list):
-            cmd.extend(command)
-        else:
-            cmd.append(command)
-
-        return self.call_process(cmd, **kwargs)
+        if self._in_salt_session(command, kwargs):
+            ret = self._call_salt_session(
+                command if isinstance(command, list) else [command],
+                **kwargs)
+            if ret is not None:
+                return ret
+        return self.call_process(self._get_salt_cmd(command), **kwargs)
 
     def service_status(self, service):
         """
@@ -498,9 +476,10 @@ class SaltBase(WorkerBase, PlatformManagerBase):
             'service.enabled', service,
             '--out', 'newline_values_only'
         ]
+        status, enabled = self.run_salts([cmd_status, cmd_enabled])
         return (
-            self.run_salt(cmd_status)['stdout'].strip().lower() == b'true',
-            self.run_salt(cmd_enabled)['stdout'].strip().lower() == b'true'
+            status['stdout'].strip().lower() == b'true',
+            enabled['stdout'].strip().lower() == b'true'
         )
 
     def service_stop(self, service):
@@ -583,11 +562,11 @@ class SaltBase(WorkerBase, PlatformManagerBase):
         ]
         return self.run_salt(cmd)['stdout'].strip().lower() == b'true'
 
-    def process_grains(self):
-        """Set salt grains."""
+    def _get_grains(self):
+        grains = {}
         ent_env = {'enterprise_environment': str(self.ent_env)}
-        self._set_grain('systemprep', ent_env)
-        self._set_grain('watchmaker', ent_env)
+        grains['systemprep'] = ent_env
+        grains['watchmaker'] = ent_env
 
         grain = {}
         if self.ou_path:
@@ -597,11 +576,17 @@ class SaltBase(WorkerBase, PlatformManagerBase):
         if self.admin_users:
             grain['admin_users'] = self.admin_users.split(':')
         if grain:
-            self._set_grain('join-domain', grain)
+            grains['join-domain'] = grain
 
         if self.computer_name:
             name = {'computername': str(self.computer_name)}
-            self._set_grain('name-computer', name)
+            grains['name-computer'] = name
+
+        return grains
+
+    def process_grains(self):
+        """Set salt grains."""
+        self._set_grains(self._get_grains())
 
         self.log.info('Syncing custom salt modules...')
         self.run_salt('saltutil.sync_all')
@@ -624,6 +609,9 @@ class SaltBase(WorkerBase, PlatformManagerBase):
                 Comma-separated string of states to exclude from execution.
 
         """
+        # States run in salt-call, and may change salt itself
+        self._stop_salt_session()
+
         if not states:
             self.log.info(
                 'No States were specified. Will not apply any salt states.'
@@ -631,6 +619,7 @@ class SaltBase(WorkerBase, PlatformManagerBase):
             return
 
         cmds = []
+        requested_states = states
         states = states.split(',')
         salt_cmd = self.salt_state_args
 
@@ -656,30 +645,37 @@ class SaltBase(WorkerBase, PlatformManagerBase):
             if exclude:
                 cmd.extend(['exclude={0}'.format(exclude)])
 
-            ret = self.run_salt(cmd, log_pipe='stderr', raise_error=False)
-
-            if ret['retcode'] != 0:
-                failed_states = self._get_failed_states(
-                    ast.literal_eval(ret['stdout'].decode('utf-8')))
-                if failed_states:
-                    raise WatchmakerException(
-                        yaml.safe_dump(
-                            {
-                                'Salt state execution failed':
-                                failed_states
-                            },
-                            default_flow_style=False,
-                            indent=4
-                        )
-                    )
+        fingerprint = None
+        mode = 'apply'
+        if self.unchanged_states != 'apply':
+            fingerprint = self._get_states_fingerprint(
+                requested_states, exclude)
+            mode = self._get_unchanged_states_mode(fingerprint)
+        if mode == 'skip':
+            return
+
+        drift_check = mode == 'test'
+        for cmd in cmds:
+            if drift_check:
+                cmd.append('test=True')
+            self._apply_states(cmd, drift_check)
 
+        if drift_check:
+            self.log.info('Salt state drift check completed successfully!')
+            return
+
+        if fingerprint:
+            self._save_states_fingerprint(fingerprint)
         self.log.info('Salt states all applied successfully!')
 
 
-class SaltLinux(SaltBase, LinuxPlatformManager):
+class SaltLinux(SystemdServiceMixin, SaltBase, LinuxPlatformManager):
     """
     Run salt on Linux.
 
+    Services are managed with systemd when it is running, see
+    :class:`watchmaker.managers.systemd.SystemdServiceMixin`.
+
     Args:
         install_method: (:obj:`str`)
             **Required**. Method to use to install salt.
@@ -705,6 +701,15 @@ class SaltLinux(SaltBase, LinuxPlatformManager):
 
     """
 
+    # Salt installations, from the onedir package and from the distro
+    # packages, and the rpm database queried by salt's pkg states
+    PAGE_CACHE_GLOBS = (
+        '/opt/saltstack/salt',
+        '/usr/lib/python*/site-packages/salt',
+        '/usr/lib64/python*/site-packages/salt',
+        '/var/lib/rpm',
+    )
+
     def __init__(self, *args, **kwargs):
         # Init inherited classes
         super(SaltLinux, self).__init__(*args, **kwargs)
@@ -784,20 +789,6 @@ class SaltLinux(SaltBase, LinuxPlatformManager):
                 self.log.debug('No salt version defined in config.')
             self.call_process(bootstrap_cmd)
 
-    def _build_salt_formula(self, extract_dir):
-        formulas_conf = self._get_formulas_conf()
-
-        file_roots = [str(self.salt_base_env)]
-        file_roots += [str(x) for x in formulas_conf]
-
-        self.salt_file_roots = {'file_roots': {'base': file_roots}}
-
-        super(SaltLinux, self)._build_salt_formula(extract_dir)
-
-    def _set_grain(self, grain, value):
-        self.log.info('Setting grain `%s` ...', grain)
-        super(SaltLinux, self)._set_grain(grain, value)
-
     def _selinux_status(self):
         selinux_getenforce = self.call_process(['getenforce'])
         return selinux_getenforce['stdout'].strip().lower() == b'enforcing'
@@ -816,8 +807,10 @@ class SaltLinux(SaltBase, LinuxPlatformManager):
         if os.path.exists(self.salt_call):
             salt_running, salt_enabled = self.service_status(salt_svc)
         self._install_package()
+        self._start_salt_session()
         if self.pip_install:
             self._install_pip_packages()
+
         salt_stopped = self.service_stop(salt_svc)
         self._build_salt_formula(self.salt_srv)
         if salt_enabled:
@@ -926,19 +919,27 @@ class SaltWindows(SaltBase, WindowsPlatformManager):
 
         super(SaltWindows, self)._prepare_for_install()
 
-    def _build_salt_formula(self, extract_dir):
-        formulas_conf = self._get_formulas_conf()
-
+    def _get_file_roots(self, formulas_conf):
         file_roots = [str(self.salt_base_env), str(self.salt_win_repo)]
         file_roots += [str(x) for x in formulas_conf]
+        return file_roots
 
-        self.salt_file_roots = {'file_roots': {'base': file_roots}}
+    def _get_page_cache_paths(self):
+        paths = super(SaltWindows, self)._get_page_cache_paths()
+        return paths + [self.salt_root]
 
-        super(SaltWindows, self)._build_salt_formula(extract_dir)
+    def _get_salt_python(self):
+        # salt-call.bat runs the interpreter of the salt installation
+        python = os.sep.join((self.salt_root, 'bin', 'python.exe'))
+        if os.path.isfile(python):
+            return python
+        return self._get_grain('pythonexecutable')
 
-    def _set_grain(self, grain, value):
-        self.log.info('Setting grain `%s` ...', grain)
-        super(SaltWindows, self)._set_grain(grain, value)
+    def _get_grains(self):
+        grains = super(SaltWindows, self)._get_grains()
+        if self.ash_role:
+            grains['ash-windows'] = {'lookup': {'role': str(self.ash_role)}}
+        return grains
 
     def install(self):
         """Install salt and execute salt states."""
@@ -950,8 +951,10 @@ class SaltWindows(SaltBase, WindowsPlatformManager):
         if os.path.exists(self.salt_call):
             salt_running, salt_enabled = self.service_status(salt_svc)
         self._install_package()
+        self._start_salt_session()
         if self.pip_install:
             self._install_pip_packages()
+
         salt_stopped = self.service_stop(salt_svc)
         self._build_salt_formula(self.salt_srv)
         if salt_enabled:
@@ -964,10 +967,6 @@ class SaltWindows(SaltBase, WindowsPlatformManager):
             if not self.service_start(salt_svc):
                 self.log.error('Failed to restart %s service', salt_svc)
 
-        if self.ash_role:
-            role = {'lookup': {'role': str(self.ash_role)}}
-            self._set_grain('ash-windows', role)
-
         self.process_grains()
 
         self.log.info('Refreshing package database...')
@@ -0,0 +1,539 @@
+# -*- coding: utf-8 -*-
+"""Watchmaker salt worker, salt calls and applying the salt states."""
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals, with_statement)
+
+import ast
+import codecs
+import hashlib
+import json
+import os
+import tempfile
+
+import yaml
+
+import watchmaker
+import watchmaker.utils.manifest
+import watchmaker.utils.process
+import watchmaker.utils.salt_progress
+import watchmaker.utils.salt_report
+import watchmaker.utils.salt_session
+import watchmaker.utils.sls
+from watchmaker.exceptions import InvalidValue, WatchmakerException
+
+
+class SaltCallsMixin(object):
+    """
+    Run the salt calls of the salt worker, and apply the salt states.
+
+    Mixed into :class:`watchmaker.workers.salt.SaltBase`, which accepts these
+    arguments as well.
+
+    Args:
+        command_output_files: (:obj:`bool`)
+            Write the raw output of each command run by the worker, e.g.
+            ``yum`` or ``salt-call``, to its own files in the
+            ``watchmaker-commands`` directory in the log directory, one per
+            pipe. Only the first and last lines, lines that look like
+            errors, and periodic progress messages are written to the
+            watchmaker log.
+            (*Default*: ``False``)
+
+        salt_session: (:obj:`bool`)
+            Once salt is installed, run the salt execution module functions
+            the worker calls before the states in a single long-lived helper
+            process, see :mod:`watchmaker.utils.salt_session`, instead of
+            one ``salt-call`` process each. A call to the helper is bounded
+            by the shorter of ``command_timeout`` and
+            ``command_inactivity_timeout``. When the helper fails or runs
+            out of time, the worker falls back to ``salt-call``.
+            (*Default*: ``False``)
+
+        salt_state_progress: (:obj:`bool`)
+            While the salt states are applied, follow the salt debug log, and
+            log each state as it starts and completes, with its duration and
+            whether it failed.
+            (*Default*: ``False``)
+
+        salt_state_report: (:obj:`bool`)
+            After the salt states are applied, log the slowest states and
+            formulas, and write the duration of every state, totalled per
+            SLS file and per formula, to ``salt_state_report.<fun>.json`` in
+            the watchmaker log directory.
+            (*Default*: ``False``)
+
+        unchanged_states: (:obj:`str`)
+            What to do when the inputs of the salt states are unchanged since
+            the last successful run: the staged salt content and formulas,
+            the minion configuration, the grains, the states, the excluded
+            states, and the salt and watchmaker versions.
+            (*Default*: ``apply``)
+
+            - ``apply``: Apply the states anyway.
+            - ``skip``: Do not apply the states.
+            - ``test``: Apply the states with ``test=True``, logging the
+              states that drifted, without changing anything.
+
+        force_states: (:obj:`bool`)
+            Apply the salt states, even when ``unchanged_states`` would skip
+            or test them.
+            (*Default*: ``False``)
+
+        parallel_states: (:obj:`bool`)
+            Partition the SLS files of the highstate into groups without
+            requisites on each other, and apply each group in its own
+            concurrent ``salt-call``. When the requisites cannot be resolved,
+            the highstate is applied serially.
+            (*Default*: ``False``)
+
+        max_parallel_states: (:obj:`int`)
+            Number of groups of ``parallel_states`` applied at the same time.
+            When ``0``, every group is applied at once.
+            (*Default*: ``0``)
+
+    """
+
+    # Directory in the log directory where the output of each command is
+    # written, when enabled
+    COMMAND_OUTPUT_DIR_NAME = 'watchmaker-commands'
+
+    # Name of the salt session in the resources used by each command
+    SALT_SESSION_COMMAND = 'salt-session'
+
+    # Number of the slowest formulas logged after the salt states are applied
+    STATE_REPORT_FORMULAS = 5
+
+    UNCHANGED_STATES_MODES = ('apply', 'skip', 'test')
+
+    # File in the salt configuration directory with the fingerprint of the
+    # inputs of the last successful salt state run
+    STATES_FINGERPRINT_FILE = 'states.fingerprint'
+
+    # File in the salt configuration directory with the manifests of the file
+    # and pillar roots, so the next fingerprint only reads the changed files
+    STATES_ROOTS_FILE = 'states.roots.json'
+
+    def __init__(self, *args, **kwargs):
+        # Init inherited classes
+        super(SaltCallsMixin, self).__init__(*args, **kwargs)
+
+        # Pop arguments used by SaltCallsMixin
+        self.command_output_files = \
+            kwargs.pop('command_output_files', None) or False
+        self.salt_session = kwargs.pop('salt_session', None) or False
+        self.salt_state_progress = \
+            kwargs.pop('salt_state_progress', None) or False
+        self.salt_state_report = \
+            kwargs.pop('salt_state_report', None) or False
+        self.unchanged_states = \
+            kwargs.pop('unchanged_states', None) or 'apply'
+        self.force_states = kwargs.pop('force_states', None) or False
+        self.parallel_states = kwargs.pop('parallel_states', None) or False
+        self.max_parallel_states = \
+            kwargs.pop('max_parallel_states', None) or 0
+
+        self._session = None
+
+    def before_install(self):
+        """Validate the salt state configuration before starting install."""
+        if self.unchanged_states not in self.UNCHANGED_STATES_MODES:
+            msg = (
+                'Selected unchanged_states ({0}) is not one of the valid'
+                ' modes: {1}'.format(
+                    self.unchanged_states, list(self.UNCHANGED_STATES_MODES))
+            )
+            self.log.critical(msg)
+            raise InvalidValue(msg)
+
+        self._validate_non_negative('max_parallel_states')
+
+        super(SaltCallsMixin, self).before_install()
+
+    def run_salts(self, commands, **kwargs):
+        """
+        Execute several independent salt commands concurrently.
+
+        Args:
+            commands: (:obj:`list`)
+                Salt commands, each as accepted by :meth:`run_salt`.
+
+        Returns:
+            :obj:`list`:
+                The result of each command, in the order of ``commands``.
+
+        """
+        if all(self._in_salt_session(x, kwargs) for x in commands):
+            # The session runs one command at a time, still faster than
+            # starting salt-call for each
+            return [self.run_salt(x, **kwargs) for x in commands]
+        return self.call_processes(
+            [self._get_salt_cmd(x) for x in commands], **kwargs)
+
+    def _get_salt_cmd(self, command):
+        cmd = [
+            self.salt_call,
+            '--local',
+            '--retcode-passthrough',
+            '--no-color',
+            '--config-dir',
+            self.salt_conf_path
+        ]
+        if isinstance(command, list):
+            cmd.extend(command)
+        else:
+            cmd.append(command)
+        return cmd
+
+    def _get_salt_python(self):
+        # The interpreter named by the salt-call script, so that salt is not
+        # started only to tell which one it runs in
+        try:
+            with open(self.salt_call, 'rb') as fh_:
+                shebang = fh_.readline().decode('utf-8', 'replace')
+        except EnvironmentError:
+            shebang = ''
+        python = shebang[2:].split()[0] if (
+            shebang.startswith('#!') and shebang[2:].split()) else None
+        if python and os.path.basename(python) != 'env' and os.path.isfile(
+            python
+        ):
+            return python
+        return self._get_grain('pythonexecutable')
+
+    def _start_salt_session(self):
+        if not self.salt_session or self._session:
+            return
+        python = self._get_salt_python()
+        try:
+            self._session = watchmaker.utils.salt_session.SaltSession(
+                python, self.salt_conf_path, env=self._get_process_env())
+        except EnvironmentError as exc:
+            self.log.warning(
+                'Unable to start the salt session, using salt-call: %s', exc)
+            return
+        self.log.info('Started the salt session. python=%s', python)
+
+    def _stop_salt_session(self):
+        if self._session:
+            self._session.close()
+            self._session = None
+            self.log.debug('Stopped the salt session')
+
+    def _in_salt_session(self, command, kwargs):
+        return (
+            self._session is not None and
+            set(kwargs) <= set(['log_pipe', 'raise_error']) and
+            watchmaker.utils.salt_session.is_supported(
+                command if isinstance(command, list) else [command])
+        )
+
+    def _call_salt_session(self, command, log_pipe='all', raise_error=True):
+        self.log.debug('Salt session command: %s', ' '.join(command))
+        # No output is seen until the function returns, so either timeout
+        # bounds the whole call
+        timeout = min(
+            [float(x) for x in (
+                self.command_timeout, self.command_inactivity_timeout) if x]
+            or [None])
+        try:
+            ret = self._session.call(command, timeout=timeout)
+        except watchmaker.utils.salt_session.SessionError as exc:
+            self.log.warning('%s, using salt-call', exc)
+            self._stop_salt_session()
+            return None
+
+        usage = dict.fromkeys(watchmaker.utils.process.USAGE_FIELDS)
+        usage['wall'] = ret.pop('wall')
+        self._record_usage(
+            [self.SALT_SESSION_COMMAND] + command, dict(ret, usage=usage))
+
+        for name, logger in (
+            ('stdout', self.log.debug), ('stderr', self.log.error)
+        ):
+            if log_pipe in [name, 'all']:
+                for line in ret[name].splitlines():
+                    logger('Command %s: %s', name, line.rstrip())
+        self.log.debug(
+            'Command retcode: %s, cmd=%s', ret['retcode'], ' '.join(command))
+        if raise_error and ret['retcode'] != 0:
+            msg = 'Command failed! Exit code={0}, cmd={1}'.format(
+                ret['retcode'], ' '.join(command))
+            self.log.critical(msg)
+            raise WatchmakerException(msg)
+        return ret
+
+    def _set_grains(self, grains):
+        # Same as grains.setvals, without starting salt: each grain replaces
+        # the grain of the same name in the grains file, others are kept
+        self.log.info('Setting grains `%s` ...', '`, `'.join(sorted(grains)))
+        grains_file = os.sep.join((self.salt_conf_path, 'grains'))
+        current = {}
+        if os.path.exists(grains_file):
+            with codecs.open(grains_file, 'r', encoding='utf-8') as fh_:
+                current = yaml.safe_load(fh_) or {}
+            if not isinstance(current, dict):
+                msg = 'Grains file is not a dictionary: {0}'.format(
+                    grains_file)
+                self.log.critical(msg)
+                raise WatchmakerException(msg)
+        current.update(grains)
+
+        fd_, tmp_path = tempfile.mkstemp(
+            prefix='.grains-', dir=self.salt_conf_path)
+        os.close(fd_)
+        try:
+            with codecs.open(tmp_path, 'w', encoding='utf-8') as fh_:
+                yaml.safe_dump(current, fh_, default_flow_style=False)
+            if os.name == 'nt' and os.path.exists(grains_file):
+                os.remove(grains_file)
+            os.rename(tmp_path, grains_file)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def _report_states(self, cmd, state_ret):
+        states = state_ret.get('return') if isinstance(
+            state_ret, dict) else None
+        if not isinstance(states, dict):
+            # An error other than a failed state, nothing to report
+            return
+
+        report = watchmaker.utils.salt_report.state_report(states)
+        fun = [x for x in cmd if x.startswith('state.')][0]
+        report_file = os.sep.join((
+            self.salt_log_dir,
+            'salt_state_report.{0}.json'.format(fun.split('.', 1)[1])))
+        try:
+            with codecs.open(report_file, 'w', encoding='utf-8') as fh_:
+                fh_.write(json.dumps(report, indent=1))
+        except EnvironmentError:
+            self.log.warning('Unable to write %s', report_file)
+
+        self.log.info(
+            'Salt state report: states=%s, changed=%s, unchanged=%s, '
+            'failed=%s, duration=%.1fs, report=%s',
+            report['states'], report['changed'], report['unchanged'],
+            report['failed'], report['duration'], report_file)
+        for state in report['slowest']:
+            self.log.info(
+                'Slow salt state: %.1fs, %s %s, sls=%s', state['duration'],
+                state['function'], state['id'], state['sls'])
+        for formula in report['formulas'][:self.STATE_REPORT_FORMULAS]:
+            self.log.info(
+                'Slow salt formula: %.1fs, %s, states=%s, changed=%s',
+                formula['duration'], formula['formula'], formula['states'],
+                formula['changed'])
+
+    def _get_unchanged_states_mode(self, fingerprint):
+        if (
+            self.force_states or
+            fingerprint != self._load_states_fingerprint()
+        ):
+            # Until the states succeed, the last run no longer applies
+            self._save_states_fingerprint(None)
+            return 'apply'
+        if self.unchanged_states == 'skip':
+            self.log.info(
+                'Salt state inputs are unchanged since the last successful '
+                'run, skipping the salt states. fingerprint=%s', fingerprint)
+        else:
+            self.log.info(
+                'Salt state inputs are unchanged since the last successful '
+                'run, checking for drift with test=True. fingerprint=%s',
+                fingerprint)
+        return self.unchanged_states
+
+    def _apply_states(self, cmd, drift_check):
+        # The return of the states is only parsed when it is used, as it holds
+        # every state of the run
+        parse = self.salt_state_report or drift_check
+        progress = None
+        if self.salt_state_progress:
+            progress = watchmaker.utils.salt_progress.StateProgress(
+                self.salt_debug_logfile, self.log.info)
+            progress.start()
+        try:
+            if self.parallel_states and 'state.highstate' in cmd:
+                retcode, state_ret = self._run_highstate_shards(cmd, parse)
+            else:
+                retcode, state_ret = self._run_states(cmd, parse)
+        finally:
+            if progress:
+                progress.stop()
+
+        if state_ret is not None:
+            if drift_check:
+                self._log_drift(state_ret)
+            elif self.salt_state_report:
+                self._report_states(cmd, state_ret)
+
+        if retcode != 0:
+            failed_states = self._get_failed_states(state_ret)
+            if failed_states:
+                raise WatchmakerException(
+                    yaml.safe_dump(
+                        {
+                            'Salt state execution failed':
+                            failed_states
+                        },
+                        default_flow_style=False,
+                        indent=4
+                    )
+                )
+
+    def _parse_state_return(self, cmd, ret):
+        try:
+            return ast.literal_eval(ret['stdout'].getvalue().decode('utf-8'))
+        except (SyntaxError, ValueError):
+            if ret['retcode'] != 0:
+                raise
+            self.log.warning(
+                'Unable to parse the return of the salt states, no timing '
+                'report. cmd=%s', ' '.join(cmd))
+            return None
+
+    def _run_states(self, cmd, parse):
+        ret = self.run_salt(
+            cmd, log_pipe='stderr', raise_error=False, output='buffer')
+        if not parse and ret['retcode'] == 0:
+            return ret['retcode'], None
+        return ret['retcode'], self._parse_state_return(cmd, ret)
+
+    def _get_lowstate(self):
+        ret = self.run_salt(
+            ['--out', 'json', 'state.show_lowstate'], log_pipe='stderr',
+            raise_error=False, output='buffer')
+        if ret['retcode'] != 0:
+            return None
+        try:
+            return json.loads(
+                ret['stdout'].getvalue().decode('utf-8'))['local']
+        except (KeyError, TypeError, ValueError):
+            return None
+
+    def _run_highstate_shards(self, cmd, parse):
+        lowstate = self._get_lowstate()
+        groups = None
+        if isinstance(lowstate, list):
+            groups = watchmaker.utils.sls.independent_sls_groups(lowstate)
+        if not groups or len(groups) < 2:
+            self.log.info(
+                'The highstate has no independent SLS groups, applying it '
+                'serially')
+            return self._run_states(cmd, parse)
+
+        shard_cmds = watchmaker.utils.sls.shard_commands(cmd, groups)
+        self.log.info(
+            'Applying the highstate in %s concurrent shards: %s',
+            len(groups), '; '.join(','.join(x) for x in groups))
+        rets = self.run_salts(
+            shard_cmds, log_pipe='stderr', raise_error=False,
+            output='buffer',
+            max_concurrency=int(float(self.max_parallel_states)) or None)
+
+        # A shard killed by a signal has a negative retcode
+        retcode = next((x['retcode'] for x in rets if x['retcode']), 0)
+        if not parse and retcode == 0:
+            return retcode, None
+        return retcode, self._merge_shard_returns(
+            shard_cmds, rets, parse, retcode)
+
+    def _merge_shard_returns(self, shard_cmds, rets, parse, retcode):
+        # Merge the returns, keeping any error that is not a state result
+        merged = {'return': {}, 'retcode': retcode}
+        for shard_cmd, ret in zip(shard_cmds, rets):
+            if not parse and ret['retcode'] == 0:
+                continue
+            try:
+                state_ret = self._parse_state_return(shard_cmd, ret)
+            except (SyntaxError, ValueError):
+                # E.g. a shard killed by a signal, before it printed a return
+                state_ret = 'Salt exited with retcode {0}: {1}'.format(
+                    ret['retcode'], ' '.join(shard_cmd))
+            states = state_ret.get('return') if isinstance(
+                state_ret, dict) else None
+            if isinstance(states, dict) and isinstance(
+                merged['return'], dict
+            ):
+                merged['return'].update(states)
+            elif ret['retcode'] != 0 and state_ret is not None:
+                merged['return'] = state_ret if states is None else states
+        return merged
+
+    def _get_states_fingerprint(self, states, exclude):
+        minion_file = os.sep.join((self.salt_conf_path, 'minion'))
+        with codecs.open(minion_file, 'r', encoding='utf-8') as fh_:
+            minion = fh_.read()
+        grains_file = os.sep.join((self.salt_conf_path, 'grains'))
+        grains = ''
+        if os.path.exists(grains_file):
+            with codecs.open(grains_file, 'r', encoding='utf-8') as fh_:
+                grains = fh_.read()
+
+        inputs = {
+            'watchmaker': watchmaker.__version__,
+            'salt': self._get_grain('saltversion'),
+            'roots': self._get_roots_digests(yaml.safe_load(minion) or {}),
+            'states': states,
+            'exclude': exclude,
+            'minion': minion,
+            'grains': grains,
+        }
+        return hashlib.sha256(
+            json.dumps(inputs, sort_keys=True).encode('utf-8')).hexdigest()
+
+    def _get_roots_digests(self, salt_conf):
+        # Digests of the files of the trees salt reads the states and pillar
+        # from, reading only the files changed since the last fingerprint
+        roots_file = os.sep.join((self.salt_conf_path, self.STATES_ROOTS_FILE))
+        previous = watchmaker.utils.manifest.load_manifest(roots_file) or {}
+        roots = {}
+        for option in ('file_roots', 'pillar_roots'):
+            for paths in (salt_conf.get(option) or {}).values():
+                for path in paths:
+                    roots[path] = watchmaker.utils.manifest.update_manifest(
+                        path, previous.get(path))
+        watchmaker.utils.manifest.write_manifest(roots, roots_file)
+        return dict(
+            (path, dict(
+                (relpath, entry[watchmaker.utils.manifest.MANIFEST_ALGORITHM])
+                for relpath, entry in manifest.items()))
+            for path, manifest in roots.items())
+
+    def _load_states_fingerprint(self):
+        try:
+            with codecs.open(
+                os.sep.join(
+                    (self.salt_conf_path, self.STATES_FINGERPRINT_FILE)),
+                'r', encoding='utf-8'
+            ) as fh_:
+                return fh_.read().strip()
+        except EnvironmentError:
+            return None
+
+    def _save_states_fingerprint(self, fingerprint):
+        fingerprint_file = os.sep.join(
+            (self.salt_conf_path, self.STATES_FINGERPRINT_FILE))
+        if fingerprint is None:
+            if os.path.exists(fingerprint_file):
+                os.remove(fingerprint_file)
+            return
+        with codecs.open(fingerprint_file, 'w', encoding='utf-8') as fh_:
+            fh_.write(fingerprint)
+
+    def _log_drift(self, state_ret):
+        states = state_ret.get('return') if isinstance(
+            state_ret, dict) else None
+        if not isinstance(states, dict):
+            return
+        # With test=True, states that would change have no result
+        drifted = sorted(
+            key.split('_|-')[1] if '_|-' in key else key
+            for key, data in states.items() if data.get('result') is None)
+        if drifted:
+            self.log.warning(
+                'Salt states drifted since the last successful run: %s',
+                ', '.join(drifted))
+        else:
+            self.log.info('No salt states drifted since the last run')
@@ -0,0 +1,590 @@
+# -*- coding: utf-8 -*-
+"""Watchmaker salt worker, staging of the salt content and formulas."""
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals, with_statement)
+
+import concurrent.futures
+import fnmatch
+import functools
+import glob
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+import watchmaker.utils
+import watchmaker.utils.manifest
+import watchmaker.utils.overlay
+import watchmaker.utils.sls
+from watchmaker import static
+from watchmaker.exceptions import InvalidValue
+
+
+class SaltStagingMixin(object):
+    """
+    Stage the salt content and formulas of the salt worker.
+
+    Mixed into :class:`watchmaker.workers.salt.SaltBase`, which accepts these
+    arguments as well.
+
+    Args:
+        extraction_cache: (:obj:`bool`)
+            Cache the extracted contents of the salt content and user formula
+            archives in the Watchmaker "prep" directory, keyed by the digest
+            of each archive. An archive that is byte-identical to one seen in
+            a previous run is not decompressed again; the cached tree is
+            hardlinked into place instead.
+            (*Default*: ``False``)
+
+        extraction_cache_max_age: (:obj:`int`)
+            Number of hours since its last use that an archive is kept in the
+            extraction cache. At the end of the run, the others are deleted
+            by a background process, as with ``cleanup_max_age``.
+            (*Default*: ``720``)
+
+        extraction_cache_max_size: (:obj:`int`)
+            Number of MiB the archives kept in the extraction cache may take
+            up. The most recently used are kept.
+            (*Default*: ``1024``)
+
+        staging_method: (:obj:`str`)
+            How the formulas and salt content bundled with Watchmaker are
+            placed in the watchmaker salt "srv" directory. Whenever the method
+            is not possible, e.g. a hardlink across filesystems, files are
+            copied instead.
+            (*Default*: ``copy``)
+
+            - ``copy``: Copy the files.
+            - ``hardlink``: Hardlink the files.
+            - ``reflink``: Clone the files, on filesystems that support it,
+              such as XFS and Btrfs.
+            - ``symlink``: Symlink each formula and content directory to the
+              directory in the installed Watchmaker package.
+
+            Links left in the "srv" directory by an earlier run are removed
+            before ``salt_content`` is extracted there, so the archive never
+            overwrites files of the installed package.
+
+        consolidate_file_roots: (:obj:`bool`)
+            Merge the salt states directory and every formula into a single
+            overlay directory, and configure it as the only salt file root.
+            When several roots provide the same file, the file from the root
+            that salt would search first is used, and the conflict is logged.
+            An index of the overlay, mapping each file to the root it came
+            from, is saved next to the overlay directory.
+            (*Default*: ``False``)
+
+        referenced_formulas_only: (:obj:`bool`)
+            Only stage the bundled formulas that the run can reach: the
+            formulas providing the states in "salt_states", or assigned by the
+            top file when applying the "highstate", and the formulas those
+            include or reference in turn. Bundled formulas that ship salt
+            extension modules, all user formulas, and the formulas named by
+            "exclude_states", which salt still renders, are always staged.
+            When the states cannot be determined from the top file, or the
+            includes of a salt file, without rendering them, e.g. an include
+            read from the pillar, every bundled formula is staged.
+            (*Default*: ``False``)
+
+        ram_working_dir: (:obj:`int`)
+            Memory budget, in MiB, for keeping the Watchmaker working
+            directory on a memory-backed filesystem (Linux-only, in
+            ``/dev/shm``), so downloaded archives and their extracted
+            contents never touch a slow disk. A download or extraction that
+            does not fit in the remaining budget is spilled to the working
+            directory on disk. When ``0``, the working directory is on disk.
+            (*Default*: ``0``)
+
+        cleanup_max_age: (:obj:`int`)
+            Number of hours the working directory of a run is kept in the
+            trash directory, next to it, for troubleshooting. At the end of
+            the run, the working directory is moved to the trash, and the
+            trash is purged by a background process, which goes on after
+            Watchmaker exits. Anything a run leaves in the trash, e.g. when
+            the system restarts before the purge finished, is purged by the
+            next run. A working directory kept in memory, see
+            ``ram_working_dir``, is deleted right away instead.
+            (*Default*: ``0``)
+
+        cleanup_max_size: (:obj:`int`)
+            Number of MiB the working directories kept in the trash may take
+            up. The newest are kept.
+            (*Default*: ``0``)
+
+        warm_page_cache: (:obj:`bool`)
+            While salt is installed and the salt content and formulas are
+            downloaded, read the salt installation, the bundled formulas, the
+            previously staged salt content and formulas, and, on Linux, the
+            rpm database into the page cache in the background, so the first
+            salt command does not wait on a cold disk.
+            (*Default*: ``False``)
+
+        versioned_srv: (:obj:`bool`)
+            Stage the salt content and formulas of each run in a new version
+            directory in the watchmaker salt "srv" directory, and atomically
+            switch the ``current`` symlink that the salt minion configuration
+            points at to it once staging is complete. A failed run never
+            leaves a partially staged tree in use. The previous version is
+            kept, for rollback, and older versions are deleted in the
+            background (Linux-only).
+            (*Default*: ``False``)
+
+    """
+
+    # Upper bound on the number of user formulas fetched at the same time
+    MAX_FORMULA_WORKERS = 8
+
+    # Records the bundled formula files placed in the formula root by the last
+    # run, so unchanged files are not copied again
+    FORMULAS_SYNC_STATE = '.bundled-formulas.json'
+
+    # Number of versions of the salt srv directory kept by `versioned_srv`,
+    # including the current one
+    SRV_VERSIONS_KEPT = 2
+
+    # Salt installations and other files read by the first salt commands,
+    # which are read into the page cache by `warm_page_cache`
+    PAGE_CACHE_GLOBS = ()
+
+    def __init__(self, *args, **kwargs):
+        # Init inherited classes
+        super(SaltStagingMixin, self).__init__(*args, **kwargs)
+
+        # Pop arguments used by SaltStagingMixin
+        self.extraction_cache = kwargs.pop('extraction_cache', None) or False
+        self.extraction_cache_max_age = \
+            kwargs.pop('extraction_cache_max_age', None) or 720
+        self.extraction_cache_max_size = \
+            kwargs.pop('extraction_cache_max_size', None) or 1024
+        self.staging_method = kwargs.pop('staging_method', None) or 'copy'
+        self.consolidate_file_roots = \
+            kwargs.pop('consolidate_file_roots', None) or False
+        self.referenced_formulas_only = \
+            kwargs.pop('referenced_formulas_only', None) or False
+        self.ram_working_dir = kwargs.pop('ram_working_dir', None) or 0
+        self.cleanup_max_age = kwargs.pop('cleanup_max_age', None) or 0
+        self.cleanup_max_size = kwargs.pop('cleanup_max_size', None) or 0
+        self.versioned_srv = kwargs.pop('versioned_srv', None) or False
+        self.warm_page_cache = kwargs.pop('warm_page_cache', None) or False
+
+        self.salt_srv_version = None
+        self.bundled_manifest = None
+
+        if self.extraction_cache:
+            self.extract_cache_dir = os.sep.join((
+                self.system_params['prepdir'], 'cache', 'extracted'))
+
+    def before_install(self):
+        """Validate the staging configuration before starting install."""
+        if self.staging_method not in watchmaker.utils.STAGING_METHODS:
+            msg = (
+                'Selected staging method ({0}) is not one of the valid'
+                ' staging methods: {1}'.format(
+                    self.staging_method,
+                    list(watchmaker.utils.STAGING_METHODS))
+            )
+            self.log.critical(msg)
+            raise InvalidValue(msg)
+
+        self._validate_non_negative(
+            'extraction_cache_max_age', 'extraction_cache_max_size',
+            'ram_working_dir', 'cleanup_max_age', 'cleanup_max_size')
+
+        super(SaltStagingMixin, self).before_install()
+
+    def _prepare_staging(self):
+        if self.ram_working_dir:
+            if self.RAM_FS and os.path.isdir(self.RAM_FS):
+                self.ram_dir = os.sep.join((self.RAM_FS, 'watchmaker'))
+                self.ram_budget = int(float(self.ram_working_dir) * 1048576)
+            else:
+                self.log.warning(
+                    'No memory-backed filesystem on this platform, creating '
+                    'the working directory on disk')
+
+        self.trash_max_age = float(self.cleanup_max_age) * 3600
+        self.trash_max_size = int(float(self.cleanup_max_size) * 1048576)
+        self.extract_cache_max_age = \
+            float(self.extraction_cache_max_age) * 3600
+        self.extract_cache_max_size = \
+            int(float(self.extraction_cache_max_size) * 1048576)
+
+        if self.versioned_srv:
+            if os.name == 'nt':
+                self.log.warning(
+                    'Versioned salt srv directories are not supported on '
+                    'this platform, staging in place')
+            else:
+                self._create_srv_version()
+
+    def _get_page_cache_paths(self):
+        paths = [os.sep.join((static.__path__[0], 'salt')), self.salt_srv]
+        for pattern in self.PAGE_CACHE_GLOBS:
+            paths += sorted(glob.glob(pattern))
+        return paths
+
+    def _start_page_cache_warming(self):
+        warm_thread = threading.Thread(
+            target=self._warm_page_cache,
+            args=(self._get_page_cache_paths(),),
+            name='page-cache-warming'
+        )
+        warm_thread.daemon = True
+        warm_thread.start()
+        return warm_thread
+
+    def _warm_page_cache(self, paths):
+        stats = watchmaker.utils.warm_page_cache(paths)
+        self.log.info(
+            'Warmed the page cache. paths=%s, files=%s, bytes=%s, seconds=%s',
+            paths, stats['files'], stats['bytes'], stats['seconds'])
+
+    def _create_srv_version(self):
+        versions_dir = os.sep.join((self.salt_srv, 'versions'))
+        try:
+            os.makedirs(versions_dir)
+        except OSError:
+            if not os.path.isdir(versions_dir):
+                raise
+        now = time.time()
+        self.salt_srv_version = tempfile.mkdtemp(
+            prefix='.staging-{0}.{1:06d}-'.format(
+                time.strftime('%Y%m%dT%H%M%S', time.gmtime(now)),
+                int(now % 1 * 1000000)),
+            dir=versions_dir)
+        self.log.info(
+            'Staging a new salt srv version. version_dir=%s',
+            self.salt_srv_version)
+
+        # Start from the formulas of the current version, so the sync of the
+        # bundled formulas stays incremental. Hardlinks are safe, as staged
+        # files are always replaced and never written through
+        current_formulas = os.sep.join((
+            self.salt_srv, 'current', 'formulas'))
+        if not os.path.isdir(current_formulas):
+            current_formulas = self.salt_formula_root
+        salt_dirs = self._get_salt_dirs(self.salt_srv_version)
+        if os.path.isdir(current_formulas):
+            watchmaker.utils.copy_tree(
+                current_formulas, salt_dirs[1], 'hardlink')
+
+        # Stage into the new version, while salt is configured with the
+        # paths through the `current` symlink
+        self.salt_base_env = salt_dirs[0]
+        self.salt_formula_root = salt_dirs[1]
+        self.salt_pillar_root = salt_dirs[2]
+        self.salt_conf['pillar_roots'] = {
+            'base': [self._get_live_path(self.salt_pillar_root)]}
+
+    def _get_live_path(self, path):
+        if self.salt_srv_version and (
+            path == self.salt_srv_version or
+            path.startswith(self.salt_srv_version + os.sep)
+        ):
+            return os.sep.join((self.salt_srv, 'current')) + (
+                path[len(self.salt_srv_version):])
+        return path
+
+    def _activate_srv_version(self):
+        versions_dir = os.path.dirname(self.salt_srv_version)
+        version = os.path.basename(self.salt_srv_version)[len('.staging-'):]
+        version_dir = os.sep.join((versions_dir, version))
+        os.rename(self.salt_srv_version, version_dir)
+
+        # Renaming a new symlink over the current one swaps it atomically
+        current = os.sep.join((self.salt_srv, 'current'))
+        current_tmp = os.sep.join((self.salt_srv, '.current-' + version))
+        os.symlink(os.sep.join(('versions', version)), current_tmp)
+        os.rename(current_tmp, current)
+        self.log.info(
+            'Activated salt srv version. current=%s, version_dir=%s',
+            current, version_dir)
+
+        self.salt_srv_version = version_dir
+        salt_dirs = self._get_salt_dirs(version_dir)
+        self.salt_base_env = salt_dirs[0]
+        self.salt_formula_root = salt_dirs[1]
+        self.salt_pillar_root = salt_dirs[2]
+
+        gc_thread = threading.Thread(
+            target=self._remove_old_srv_versions,
+            args=(versions_dir, version),
+            name='salt-srv-gc'
+        )
+        gc_thread.daemon = True
+        gc_thread.start()
+        return gc_thread
+
+    def _remove_old_srv_versions(self, versions_dir, current_version):
+        # Version names sort by the time they were staged. Hidden dirs are
+        # left by runs that failed while staging
+        versions = sorted(
+            (x for x in os.listdir(versions_dir) if x != current_version),
+            reverse=True)
+        kept = [x for x in versions if not x.startswith('.')][
+            :self.SRV_VERSIONS_KEPT - 1]
+        for version in versions:
+            if version in kept:
+                continue
+            try:
+                shutil.rmtree(os.sep.join((versions_dir, version)))
+                self.log.debug('Removed old salt srv version: %s', version)
+            except OSError as exc:
+                self.log.warning(
+                    'Failed to remove old salt srv version %s: %s',
+                    version, exc)
+
+    def _get_bundled_manifest(self):
+        if self.bundled_manifest is None:
+            salt_static = os.sep.join((static.__path__[0], 'salt'))
+            self.bundled_manifest = watchmaker.utils.manifest.load_manifest(
+                os.sep.join((
+                    salt_static, watchmaker.utils.manifest.MANIFEST_NAME)))
+            if self.bundled_manifest is None:
+                # Not installed from a built package, e.g. a source checkout
+                self.log.debug(
+                    'No manifest of bundled salt files, building it from '
+                    '%s', salt_static)
+                self.bundled_manifest = (
+                    watchmaker.utils.manifest.build_manifest(salt_static))
+        return self.bundled_manifest
+
+    def _sync_bundled_formulas(self, formulas_path, excluded):
+        formulas_manifest = dict(
+            (path, entry) for path, entry in
+            watchmaker.utils.manifest.subtree(
+                self._get_bundled_manifest(), 'formulas').items()
+            if path.split('/', 1)[0] not in excluded
+        )
+
+        # Formulas symlinked by a previous run must not be synced through
+        for formula in set(x.split('/', 1)[0] for x in formulas_manifest):
+            formula_loc = os.sep.join((self.salt_formula_root, formula))
+            if os.path.islink(formula_loc):
+                os.remove(formula_loc)
+
+        sync_stats = watchmaker.utils.manifest.sync_tree(
+            formulas_path,
+            self.salt_formula_root,
+            formulas_manifest,
+            os.sep.join((self.salt_formula_root, self.FORMULAS_SYNC_STATE)),
+            copy_function=functools.partial(
+                watchmaker.utils.stage_file, method=self.staging_method)
+        )
+        self.log.info(
+            'Synced bundled formulas to %s. method=%s, added=%s, '
+            'replaced=%s, deleted=%s, unchanged=%s',
+            self.salt_formula_root, self.staging_method, sync_stats['added'],
+            sync_stats['replaced'], sync_stats['deleted'],
+            sync_stats['unchanged']
+        )
+
+    def _link_bundled_formulas(self, formulas_path, excluded):
+        for formula in os.listdir(formulas_path):
+            if formula in excluded:
+                continue
+            formula_src = os.sep.join((formulas_path, formula))
+            formula_loc = os.sep.join((self.salt_formula_root, formula))
+            if os.path.islink(formula_loc):
+                if os.readlink(formula_loc) == formula_src:
+                    continue
+                os.remove(formula_loc)
+            elif os.path.isdir(formula_loc):
+                shutil.rmtree(formula_loc)
+            watchmaker.utils.stage_tree(formula_src, formula_loc, 'symlink')
+            self.log.debug(
+                'Linked bundled formula. formula_src=%s, formula_loc=%s',
+                formula_src, formula_loc)
+
+        # The formula root no longer holds what the last sync placed there
+        sync_state = os.sep.join((
+            self.salt_formula_root, self.FORMULAS_SYNC_STATE))
+        if os.path.exists(sync_state):
+            os.remove(sync_state)
+
+    def _get_referenced_formulas(self, formulas_path, user_formula_dirs):
+        providers, referenced = watchmaker.utils.sls.formula_providers(
+            watchmaker.utils.manifest.subtree(
+                self._get_bundled_manifest(), 'formulas'))
+
+        top_file = os.sep.join((self.salt_base_env, 'top.sls'))
+        namespaces = watchmaker.utils.sls.state_namespaces(
+            [x for x in self.salt_states.split(',') if x], top_file)
+        if namespaces is None:
+            self.log.info(
+                'Could not determine the states assigned by the top file, '
+                'staging every bundled formula. top_file=%s', top_file)
+            return None
+        if not namespaces:
+            # Nothing is applied, only extension modules may be used
+            return referenced
+
+        # Salt still renders an excluded SLS file the run reaches, and only
+        # drops its states afterwards, so an exclusion never makes a formula
+        # unneeded. The formulas the exclusions name are kept as well
+        for state in self.exclude_states.split(','):
+            state = state.strip()
+            if state and not state.startswith('id:'):
+                namespaces.update(fnmatch.filter(
+                    providers, watchmaker.utils.sls.namespace(
+                        state.split(':', 1)[-1].strip())))
+
+        # Follow the includes and references of the salt content, the user
+        # formulas, and every bundled formula reached along the way
+        referenced = watchmaker.utils.sls.reachable_formulas(
+            providers, namespaces,
+            [self.salt_base_env] + list(user_formula_dirs), formulas_path,
+            referenced)
+        if referenced is None:
+            self.log.info(
+                'Could not determine the states included by the salt files, '
+                'staging every bundled formula')
+        return referenced
+
+    def _get_formulas_conf(self):
+
+        # Obtain & extract any Salt formulas specified in user_formulas.
+        fetched_formulas = []
+        if self.user_formulas:
+            with concurrent.futures.ThreadPoolExecutor(
+                max_workers=min(
+                    len(self.user_formulas), self.MAX_FORMULA_WORKERS)
+            ) as executor:
+                futures = [
+                    (
+                        formula_name,
+                        formula_url,
+                        executor.submit(
+                            self._fetch_user_formula,
+                            formula_name,
+                            formula_url
+                        )
+                    )
+                    for formula_name, formula_url
+                    in self.user_formulas.items()
+                ]
+                fetched_formulas = [
+                    (formula_name, formula_url, future.result())
+                    for formula_name, formula_url, future in futures
+                ]
+
+        # Stage Salt formulas bundled with Watchmaker package. Bundled formulas
+        # that are overridden by a user formula, or that the run does not
+        # reference, are never staged.
+        formulas_path = os.sep.join((static.__path__[0], 'salt', 'formulas'))
+        overridden = set(self.user_formulas)
+        if overridden:
+            self.log.debug(
+                'Bundled formulas overridden by user formulas: %s',
+                sorted(overridden))
+        excluded = set(overridden)
+        referenced = None
+        if self.referenced_formulas_only:
+            referenced = self._get_referenced_formulas(
+                formulas_path, [x[2] for x in fetched_formulas])
+        if referenced is not None:
+            unreferenced = set(
+                x for x in os.listdir(formulas_path)
+                if x not in referenced and x not in overridden
+            )
+            self.log.info(
+                'Staging the bundled formulas referenced by the run. '
+                'referenced=%s, unreferenced=%s',
+                sorted(referenced), sorted(unreferenced))
+            excluded.update(unreferenced)
+        if self.staging_method == 'symlink':
+            self._link_bundled_formulas(formulas_path, excluded)
+        else:
+            self._sync_bundled_formulas(formulas_path, excluded)
+
+        # Place the formulas in the order they are configured, no matter which
+        # one finished downloading first
+        for formula_name, formula_url, formula_inner_dir in fetched_formulas:
+            # Move the formula to the formula root
+            formula_loc = os.sep.join((self.salt_formula_root, formula_name))
+            self.log.debug(
+                'Placing user formula in salt file roots. '
+                'formula_url=%s, formula_loc=%s',
+                formula_url, formula_loc
+            )
+            self._place_formula(formula_inner_dir, formula_loc)
+
+        # Hidden directories are leftovers of interrupted placements, and
+        # unreferenced formulas may remain from earlier runs
+        return [
+            os.path.join(self.salt_formula_root, x) for x in next(os.walk(
+                self.salt_formula_root))[1] if not x.startswith('.') and (
+                    referenced is None or x in referenced or
+                    x in overridden)
+        ]
+
+    def _place_formula(self, formula_src, formula_loc):
+        # Move the formula next to its final location first, which is a copy
+        # when the working dir is on another filesystem, so that putting it in
+        # place is a rename
+        staging_dir = tempfile.mkdtemp(
+            prefix='.placing-', dir=self.salt_formula_root)
+        try:
+            staged_loc = os.sep.join((staging_dir, 'formula'))
+            shutil.move(formula_src, staged_loc)
+            if os.path.lexists(formula_loc):
+                os.rename(formula_loc, os.sep.join((staging_dir, 'previous')))
+            os.rename(staged_loc, formula_loc)
+        finally:
+            shutil.rmtree(staging_dir)
+
+    def _fetch_user_formula(self, formula_name, formula_url):
+        # Each formula gets its own working dir, so archives that share a
+        # filename (e.g. `master.zip`) do not collide when fetched together
+        formula_working_dir = self.create_working_dir(
+            self.working_dir,
+            '{0}-'.format(formula_name)
+        )
+        file_loc = os.sep.join((
+            formula_working_dir, os.path.basename(formula_url)))
+
+        # Download the formula
+        self.retrieve_file(formula_url, file_loc)
+
+        # Extract the formula
+        extract_dir = os.sep.join((formula_working_dir, 'extracted'))
+        self.extract_contents(
+            filepath=file_loc,
+            to_directory=extract_dir
+        )
+
+        # Get the first directory within the extracted directory
+        return os.path.join(extract_dir, next(os.walk(extract_dir))[1][0])
+
+    def _consolidate_file_roots(self, file_roots, srv):
+        # Salt serves a file from the first root that has it, so the overlay
+        # keeps the first copy of every path and records the others
+        overlay = os.sep.join((srv, 'file_root'))
+        index, conflicts = watchmaker.utils.overlay.build_overlay(
+            file_roots, overlay,
+            'symlink' if self.staging_method == 'symlink' else 'hardlink')
+
+        for relpath in sorted(conflicts):
+            # Every formula has its own README, LICENSE, etc., which salt
+            # states do not use, so only conflicts in state trees are worth
+            # a warning
+            log = self.log.warning if (
+                '/' in relpath or relpath.endswith('.sls')
+            ) else self.log.debug
+            log(
+                'File root conflict, using the first root. path=%s, '
+                'roots=%s', relpath, conflicts[relpath])
+        self.log.info(
+            'Consolidated %s file roots into %s. files=%s, conflicts=%s',
+            len(file_roots), overlay, len(index), len(conflicts))
+
+        return overlay
+
+    def _stage_file_roots(self, srv):
+        # Formulas are staged once the salt content is in place, so the states
+        # it references are known
+        file_roots = self._get_file_roots(self._get_formulas_conf())
+        if self.consolidate_file_roots:
+            return [self._consolidate_file_roots(file_roots, srv)]
+        return file_roots
@@ -17,6 +17,9 @@ class Yum(WorkerBase, LinuxPlatformManager):
     """
     Install yum repos.
 
+    Also accepts the arguments of
+    :class:`watchmaker.workers.base.WorkerBase`.
+
     Args:
         repo_map: (:obj:`list`)
             List of dictionaries containing a map of yum repo files to systems.
@@ -140,7 +143,8 @@ class Yum(WorkerBase, LinuxPlatformManager):
 
     def before_install(self):
         """Validate configuration before starting install."""
-        pass
+        self._validate_non_negative(
+            'command_timeout', 'command_inactivity_timeout')
 
     def install(self):
         """Install yum repos defined in config file."""
@@ -0,0 +1,389 @@
+# -*- coding: utf-8 -*-
+# pylint: disable=redefined-outer-name,protected-access
+"""Platform manager main test module."""
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals, with_statement)
+
+import concurrent.futures
+import os
+import subprocess
+import sys
+import time
+import zipfile
+
+import pytest
+
+from watchmaker.exceptions import CommandTimeout, WatchmakerException
+from watchmaker.managers.platform import PlatformManagerBase
+from watchmaker.utils.process import RetryPolicy
+from watchmaker.utils.trash import TRASH_DIR_NAME
+
+try:
+    from unittest.mock import MagicMock, patch
+except ImportError:
+    from mock import MagicMock, patch
+
+
+@pytest.fixture
+def platform_manager():
+    """Return a base platform manager."""
+    return PlatformManagerBase({})
+
+
+@pytest.fixture
+def formula_archive(tmpdir):
+    """Return the path to a zip archive containing a small formula."""
+    archive = str(tmpdir.join('foo-formula.zip'))
+    with zipfile.ZipFile(archive, 'w') as zip_:
+        zip_.writestr('foo-formula/foo/init.sls', 'foo: {}\n')
+        zip_.writestr('foo-formula/foo/map.jinja', '{% set foo = {} %}\n')
+    return archive
+
+
+def test_extract_contents(platform_manager, formula_archive, tmpdir):
+    """Test that an archive is extracted to the target directory."""
+    dest = str(tmpdir.join('dest'))
+
+    platform_manager.extract_contents(formula_archive, dest)
+
+    assert os.path.isfile(os.path.join(dest, 'foo-formula', 'foo', 'init.sls'))
+
+
+def test_extract_contents_cache(platform_manager, formula_archive, tmpdir):
+    """Test that a cached archive is not decompressed a second time."""
+    platform_manager.extract_cache_dir = str(tmpdir.join('cache'))
+    first = str(tmpdir.join('first'))
+    second = str(tmpdir.join('second'))
+
+    platform_manager.extract_contents(formula_archive, first)
+    with patch.object(
+        PlatformManagerBase, '_extract_archive', autospec=True
+    ) as mock_extract:
+        platform_manager.extract_contents(formula_archive, second)
+
+    assert mock_extract.call_count == 0
+    assert len(os.listdir(platform_manager.extract_cache_dir)) == 1
+    with open(os.path.join(second, 'foo-formula', 'foo', 'init.sls')) as fh_:
+        assert fh_.read() == 'foo: {}\n'
+
+
+def test_extract_cache_not_written_through(platform_manager, tmpdir):
+    """Test that extracting over a cached tree leaves the cache intact."""
+    archives = []
+    for name in ('a', 'b'):
+        archive = str(tmpdir.join('{0}.zip'.format(name)))
+        with zipfile.ZipFile(archive, 'w') as zip_:
+            zip_.writestr('foo/init.sls', '{0}: {{}}\n'.format(name))
+        archives.append(archive)
+    cache_dir = str(tmpdir.join('cache'))
+    dest = str(tmpdir.join('dest'))
+
+    platform_manager.extract_cache_dir = cache_dir
+    platform_manager.extract_contents(archives[0], dest)
+    platform_manager.extract_cache_dir = None
+    platform_manager.extract_contents(archives[1], dest)
+
+    cached = os.path.join(cache_dir, os.listdir(cache_dir)[0])
+    with open(os.path.join(cached, 'foo', 'init.sls')) as fh_:
+        assert fh_.read() == 'a: {}\n'
+    with open(os.path.join(dest, 'foo', 'init.sls')) as fh_:
+        assert fh_.read() == 'b: {}\n'
+
+
+def test_extract_cache_eviction(platform_manager, tmpdir):
+    """Test that cleanup evicts cached archives by age and size."""
+    cache_dir = tmpdir.mkdir('cache')
+    for digest in ('a1', 'b2', 'c3'):
+        cache_dir.mkdir(digest).join('init.sls').write('x' * 512)
+    cache_dir.mkdir('d4-partial')
+    os.utime(str(cache_dir.join('a1')), (1, 1))
+    platform_manager.extract_cache_dir = str(cache_dir)
+
+    assert platform_manager._evict_extract_cache() is None
+    assert len(os.listdir(str(cache_dir))) == 4
+
+    platform_manager.extract_cache_max_age = 3600
+    platform_manager.extract_cache_max_size = 1024
+    platform_manager._evict_extract_cache().wait()
+
+    # The oldest is too old, the partial extraction is left alone
+    assert sorted(os.listdir(str(cache_dir))) == ['b2', 'c3', 'd4-partial']
+    assert platform_manager._evict_extract_cache() is None
+
+    platform_manager.extract_cache_max_size = 512
+    platform_manager._evict_extract_cache().wait()
+    assert len(os.listdir(str(cache_dir))) == 2
+
+
+def test_ram_working_dir(platform_manager, formula_archive, tmpdir):
+    """Test that files beyond the RAM budget are spilled to disk."""
+    platform_manager.ram_dir = str(tmpdir.join('ram'))
+    platform_manager.ram_budget = 64
+    disk = str(tmpdir.mkdir('disk'))
+    small = tmpdir.join('small.txt')
+    small.write('watchmaker\n')
+    large = tmpdir.join('large.txt')
+    large.write('watchmaker\n' * 16)
+
+    working_dir = platform_manager.create_working_dir(disk, 'salt-')
+    platform_manager.retrieve_file(str(small), os.path.join(
+        working_dir, 'small.txt'))
+    platform_manager.retrieve_file(str(large), os.path.join(
+        working_dir, 'large.txt'))
+    platform_manager.extract_contents(
+        formula_archive, os.path.join(working_dir, 'extracted'))
+
+    spill_dir = os.path.join(disk, os.path.basename(working_dir))
+    assert os.path.dirname(working_dir) == platform_manager.ram_dir
+    assert not os.path.islink(os.path.join(working_dir, 'small.txt'))
+    assert os.path.islink(os.path.join(working_dir, 'large.txt'))
+    assert os.path.isfile(os.path.join(spill_dir, 'large.txt'))
+    with open(os.path.join(working_dir, 'large.txt')) as fh_:
+        assert fh_.read() == 'watchmaker\n' * 16
+    assert not os.path.islink(os.path.join(working_dir, 'extracted'))
+
+    platform_manager.ram_budget = 16
+    platform_manager.extract_contents(
+        formula_archive, os.path.join(working_dir, 'spilled'))
+    assert os.path.islink(os.path.join(working_dir, 'spilled'))
+    assert os.path.isfile(os.path.join(
+        spill_dir, 'spilled', 'foo-formula', 'foo', 'init.sls'))
+
+    platform_manager.extract_cache_dir = str(tmpdir.join('cache'))
+    platform_manager.extract_contents(
+        formula_archive, os.path.join(working_dir, 'cached'))
+    assert os.path.islink(os.path.join(working_dir, 'cached'))
+    assert os.path.isfile(os.path.join(
+        spill_dir, 'cached', 'foo-formula', 'foo', 'init.sls'))
+
+    platform_manager.working_dir = working_dir
+    platform_manager.cleanup()
+    assert not os.path.exists(working_dir)
+    assert not os.path.exists(spill_dir)
+
+
+def test_ram_spill_unannounced_size(platform_manager, tmpdir):
+    """Test that a download of unannounced size is spilled once too large."""
+    platform_manager.ram_dir = str(tmpdir.mkdir('ram'))
+    platform_manager.ram_spill_dir = str(tmpdir.mkdir('disk'))
+    platform_manager.ram_budget = 16
+    response = MagicMock()
+    response.info.return_value.get.return_value = None
+    response.read.side_effect = [b'watchmaker\n'] * 4 + [b'']
+    filename = os.path.join(platform_manager.ram_dir, 'large.txt')
+
+    platform_manager._save_to_ram_dir(response, filename, blocksize=11)
+
+    assert os.path.islink(filename)
+    with open(filename, 'rb') as fh_:
+        assert fh_.read() == b'watchmaker\n' * 4
+    assert platform_manager._ram_available() == 16
+
+
+def test_ram_reservation(platform_manager, tmpdir):
+    """Test that concurrent writers never exceed the RAM budget together."""
+    platform_manager.ram_dir = str(tmpdir.mkdir('ram'))
+    platform_manager.ram_budget = 100
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=8) as executor:
+        reserved = list(executor.map(platform_manager._reserve_ram, [30] * 8))
+
+    assert reserved.count(True) == 3
+    assert platform_manager._ram_available() == 10
+
+
+@pytest.mark.skipif(os.name == 'nt', reason='RAM dir is Linux-only')
+def test_ram_dir_not_private(platform_manager, tmpdir):
+    """Test that a RAM dir open to other users is not used."""
+    platform_manager.ram_dir = str(tmpdir.mkdir('ram'))
+    os.chmod(platform_manager.ram_dir, 0o777)
+    platform_manager.ram_budget = 1024
+    disk = str(tmpdir.mkdir('disk'))
+
+    working_dir = platform_manager.create_working_dir(disk, 'salt-')
+
+    assert os.path.dirname(working_dir) == disk
+    assert platform_manager.ram_dir is None
+
+
+def test_cleanup_trash(platform_manager, tmpdir):
+    """Test that cleanup trashes the working dir and purges by policy."""
+    basedir = str(tmpdir.mkdir('workingfiles'))
+    trash_dir = os.path.join(basedir, TRASH_DIR_NAME)
+    platform_manager.trash_max_age = 3600
+    platform_manager.trash_max_size = 1024
+
+    for size in (512, 256, 512):
+        platform_manager.working_dir = platform_manager.create_working_dir(
+            basedir, 'salt-')
+        with open(os.path.join(
+            platform_manager.working_dir, 'archive.zip'
+        ), 'wb') as fh_:
+            fh_.write(b'\0' * size)
+        with patch.object(
+            PlatformManagerBase, '_purge_trash', autospec=True
+        ):
+            platform_manager.cleanup()
+        assert not os.path.exists(platform_manager.working_dir)
+
+    os.rename(
+        os.path.join(trash_dir, sorted(os.listdir(trash_dir))[0]),
+        os.path.join(trash_dir, '1-salt-old'))
+    platform_manager._purge_trash(trash_dir).wait()
+
+    # The oldest is too old, and only the two newest fit in the size limit
+    assert len(os.listdir(trash_dir)) == 2
+    assert '1-salt-old' not in os.listdir(trash_dir)
+    assert platform_manager._purge_trash(trash_dir) is None
+
+
+@pytest.mark.skipif(os.name == 'nt', reason='uses a posix shell')
+def test_cleanup_trash_outlives_exit(tmpdir):
+    """Test that the trash is purged after watchmaker exits."""
+    basedir = str(tmpdir.mkdir('workingfiles'))
+    script = (
+        'import os, sys\n'
+        'from watchmaker.managers.platform import PlatformManagerBase\n'
+        'manager = PlatformManagerBase({})\n'
+        'manager.working_dir = manager.create_working_dir(sys.argv[1], "s-")\n'
+        'with open(os.path.join(manager.working_dir, "a"), "wb") as fh_:\n'
+        '    fh_.write(b"0" * 1048576)\n'
+        'manager.cleanup()\n'
+        'os._exit(0)\n')
+    subprocess.check_call(
+        [sys.executable, '-c', script, basedir],
+        env=dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path)))
+
+    trash_dir = os.path.join(basedir, TRASH_DIR_NAME)
+    deadline = time.time() + 10
+    while os.listdir(trash_dir) and time.time() < deadline:
+        time.sleep(0.1)
+    assert os.listdir(trash_dir) == []
+
+
+def test_call_process(platform_manager):
+    """Test that call_process returns the output and return code."""
+    ret = platform_manager.call_process([
+        sys.executable, '-c',
+        'import sys; print("out"); sys.stderr.write("err\\n")'])
+
+    assert ret['retcode'] == 0
+    assert ret['stdout'].strip() == b'out'
+    assert ret['stderr'].strip() == b'err'
+
+    ret = platform_manager.call_process(
+        [sys.executable, '-c', 'print("out")'], output='buffer')
+    assert ret['stdout'].getvalue().strip() == b'out'
+
+    with pytest.raises(WatchmakerException):
+        platform_manager.call_process([sys.executable, '-c', 'exit(3)'])
+
+
+def test_call_processes(platform_manager):
+    """Test that commands run concurrently, with results in order."""
+    start = time.time()
+    rets = platform_manager.call_processes([
+        [sys.executable, '-c', 'import time; time.sleep(1); print(0)'],
+        [sys.executable, '-c', 'import time; time.sleep(1); print(1)'],
+        [sys.executable, '-c', 'exit(3)'],
+    ], raise_error=False)
+
+    assert time.time() - start < 2
+    assert [x['retcode'] for x in rets] == [0, 0, 3]
+    assert [x['stdout'].strip() for x in rets] == [b'0', b'1', b'']
+
+
+@pytest.mark.skipif(os.name == 'nt', reason='uses a posix shell')
+def test_call_process_timeout(platform_manager):
+    """Test that a command and its children are terminated on timeout."""
+    start = time.time()
+    with pytest.raises(CommandTimeout) as excinfo:
+        platform_manager.call_process(
+            ['sh', '-c', 'echo started; sleep 30 & wait'], timeout=0.5)
+
+    assert time.time() - start < 5
+    assert excinfo.value.result['stdout'].strip() == b'started'
+    assert 'timed_out' not in excinfo.value.result
+
+
+@pytest.mark.skipif(os.name == 'nt', reason='uses a posix shell')
+def test_call_process_inactivity_timeout(platform_manager):
+    """Test that a command is terminated once it stops writing output."""
+    platform_manager.command_inactivity_timeout = 0.5
+    assert platform_manager.call_process(
+        ['sh', '-c', 'for i in 1 2 3; do echo $i; sleep 0.2; done']
+    )['stdout'].split() == [b'1', b'2', b'3']
+
+    with patch('watchmaker.utils.process.KILL_GRACE', 0.5), \
+            pytest.raises(CommandTimeout) as excinfo:
+        platform_manager.call_process(
+            ['sh', '-c', 'trap "" TERM; echo started; sleep 30'],
+            raise_error=False)
+    assert excinfo.value.result['stdout'].strip() == b'started'
+
+
+def test_call_process_retry(platform_manager, tmpdir):
+    """Test that only failures matching the retry policy are retried."""
+    marker = str(tmpdir.join('attempts'))
+    cmd = [sys.executable, '-c', (
+        'import sys\n'
+        'with open({0!r}, "a") as fh_: fh_.write("x")\n'
+        'if len(open({0!r}).read()) < 3:\n'
+        '    sys.exit("Existing lock /var/run/yum.pid")\n'
+    ).format(marker)]
+    retry = RetryPolicy(stderr_pattern=r'yum\.pid', max_wait=0.1)
+
+    ret = platform_manager.call_process(cmd, retry=retry)
+
+    assert ret['retcode'] == 0
+    assert tmpdir.join('attempts').read() == 'xxx'
+
+    tmpdir.join('attempts').remove()
+    with pytest.raises(WatchmakerException):
+        platform_manager.call_process(
+            cmd, retry=RetryPolicy(retcodes=(2,), max_wait=0.1))
+    assert tmpdir.join('attempts').read() == 'x'
+
+
+def test_command_usage(platform_manager):
+    """Test that the resources used by each command are recorded."""
+    ret = platform_manager.call_process([
+        sys.executable, '-c',
+        'import time\nstart = time.time()\nwhile time.time() - start < 0.3: '
+        'pass'])
+
+    assert 'usage' not in ret
+    usage = platform_manager.command_usage[-1]
+    assert usage['worker'] == 'PlatformManagerBase'
+    assert usage['cmd'][0] == sys.executable
+    assert usage['wall'] >= 0.3
+    if os.name != 'nt':
+        assert usage['user'] + usage['system'] >= 0.2
+        assert usage['maxrss'] > 0
+
+
+def test_command_output_dir(platform_manager, tmpdir, caplog):
+    """Test that command output goes to files, with a summary logged."""
+    platform_manager.command_output_dir = str(tmpdir.join('commands'))
+    cmd = [sys.executable, '-c', (
+        'import sys\n'
+        'for i in range(100): print(i)\n'
+        'sys.stderr.write("ERROR: failed\\n")\n')]
+
+    with caplog.at_level('DEBUG'):
+        platform_manager.call_process(cmd)
+
+    paths = sorted(tmpdir.join('commands').listdir())
+    assert [x.basename.split('-', 2)[-1] for x in paths] == [
+        os.path.basename(sys.executable) + '.stderr.log',
+        os.path.basename(sys.executable) + '.stdout.log',
+    ]
+    assert paths[1].read().split() == [str(x) for x in range(100)]
+
+    stdout = [
+        x.getMessage() for x in caplog.records
+        if x.getMessage().startswith('Command stdout: ')]
+    assert len(stdout) == 21
+    assert stdout[10].startswith('Command stdout: ... 80 lines skipped, see ')
+    assert stdout[-1] == 'Command stdout: {0}'.format(b'99')
+    assert 'Command stderr: {0}'.format(b'ERROR: failed') in caplog.text
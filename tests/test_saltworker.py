@@ -4,12 +4,21 @@
 from __future__ import (absolute_import, division, print_function,
                         unicode_literals, with_statement)
 
+import json
 import os
 import sys
+import time
+import zipfile
+from collections import OrderedDict
 
 import pytest
+import yaml
 
-from watchmaker.exceptions import InvalidValue
+import watchmaker.utils
+import watchmaker.utils.manifest
+import watchmaker.utils.process
+import watchmaker.utils.salt_session
+from watchmaker.exceptions import InvalidValue, WatchmakerException
 from watchmaker.workers.salt import SaltBase, SaltLinux, SaltWindows
 
 try:
@@ -94,7 +103,8 @@ def test_process_states_highstate(
     states = 'highstate'
     exclude = None
 
-    saltworker_client.run_salt = MagicMock(return_value={'retcode': 0})
+    saltworker_client.run_salt = MagicMock(return_value={
+        'retcode': 0, 'stdout': watchmaker.utils.process.OutputBuffer()})
     saltworker_client.salt_state_args = saltworker_base_salt_args
 
     expected = saltworker_client.salt_state_args + ['state.highstate']
@@ -106,7 +116,8 @@ def test_process_states_highstate(
     saltworker_client.run_salt.assert_called_with(
         expected,
         log_pipe='stderr',
-        raise_error=False
+        raise_error=False,
+        output='buffer'
     )
     assert saltworker_client.run_salt.call_count == 1
 
@@ -126,7 +137,8 @@ def test_process_states_multiple_states(
     states = 'foo,bar'
     exclude = None
 
-    saltworker_client.run_salt = MagicMock(return_value={'retcode': 0})
+    saltworker_client.run_salt = MagicMock(return_value={
+        'retcode': 0, 'stdout': watchmaker.utils.process.OutputBuffer()})
     saltworker_client.salt_state_args = saltworker_base_salt_args
 
     expected = saltworker_client.salt_state_args + ['state.sls', 'foo,bar']
@@ -138,7 +150,8 @@ def test_process_states_multiple_states(
     saltworker_client.run_salt.assert_called_with(
         expected,
         log_pipe='stderr',
-        raise_error=False
+        raise_error=False,
+        output='buffer'
     )
     assert saltworker_client.run_salt.call_count == 1
 
@@ -158,7 +171,8 @@ def test_process_states_multiple_states_case_sensitive(
     states = 'Foo,bAR'
     exclude = None
 
-    saltworker_client.run_salt = MagicMock(return_value={'retcode': 0})
+    saltworker_client.run_salt = MagicMock(return_value={
+        'retcode': 0, 'stdout': watchmaker.utils.process.OutputBuffer()})
     saltworker_client.salt_state_args = saltworker_base_salt_args
 
     expected = saltworker_client.salt_state_args + ['state.sls', 'Foo,bAR']
@@ -170,7 +184,8 @@ def test_process_states_multiple_states_case_sensitive(
     saltworker_client.run_salt.assert_called_with(
         expected,
         log_pipe='stderr',
-        raise_error=False
+        raise_error=False,
+        output='buffer'
     )
     assert saltworker_client.run_salt.call_count == 1
 
@@ -190,15 +205,16 @@ def test_process_states_highstate_extra_states(
     states = 'highstate,foo,bar'
     exclude = None
 
-    saltworker_client.run_salt = MagicMock(return_value={'retcode': 0})
+    saltworker_client.run_salt = MagicMock(return_value={
+        'retcode': 0, 'stdout': watchmaker.utils.process.OutputBuffer()})
     saltworker_client.salt_state_args = saltworker_base_salt_args
 
     call_1 = saltworker_client.salt_state_args + ['state.highstate']
     call_2 = saltworker_client.salt_state_args + ['state.sls', 'foo,bar']
 
     calls = [
-        call(call_1, log_pipe='stderr', raise_error=False),
-        call(call_2, log_pipe='stderr', raise_error=False),
+        call(call_1, log_pipe='stderr', raise_error=False, output='buffer'),
+        call(call_2, log_pipe='stderr', raise_error=False, output='buffer'),
     ]
 
     # test
@@ -321,7 +337,6 @@ def test_windows_install():
     saltworker_win.service_stop = MagicMock(return_value=None)
     saltworker_win._build_salt_formula = MagicMock(return_value=None)
     saltworker_win.service_disable = MagicMock(return_value=True)
-    saltworker_win._set_grain = MagicMock(return_value=None)
     saltworker_win.process_grains = MagicMock(return_value=None)
     saltworker_win.run_salt = MagicMock(return_value=None)
     saltworker_win.working_dir = system_params["workingdir"]
@@ -336,9 +351,9 @@ def test_windows_install():
     saltworker_win._build_salt_formula.assert_called_with(
         saltworker_win.salt_srv)
     saltworker_win.service_disable.assert_called_with("salt-minion")
-    saltworker_win._set_grain.assert_called_with(
-        "ash-windows", {"lookup": {"role": salt_config["ash_role"]}}
-    )
+    assert saltworker_win._get_grains()["ash-windows"] == {
+        "lookup": {"role": salt_config["ash_role"]}
+    }
     assert saltworker_win.process_grains.call_count == 1
     saltworker_win.run_salt.assert_called_with("pkg.refresh_db")
     assert saltworker_win.cleanup.call_count == 1
@@ -397,7 +412,7 @@ def test_linux_computer_name_none():
     # execution ====================
     saltworker_lx = SaltLinux(system_params, **salt_config)
 
-    saltworker_lx._set_grain = MagicMock(return_value=None)
+    saltworker_lx._set_grains = MagicMock(return_value=None)
     saltworker_lx.run_salt = MagicMock(
         return_value={"retcode": 0, "stdout": b"", "stderr": b""}
     )
@@ -405,9 +420,11 @@ def test_linux_computer_name_none():
     saltworker_lx.process_grains()
 
     # assertions ===================
-    assert saltworker_lx._set_grain.call_count == 3
-    saltworker_lx._set_grain.assert_called_with(
-        'name-computer', {'computername': salt_config["computer_name"]})
+    assert saltworker_lx._set_grains.call_count == 1
+    grains = saltworker_lx._set_grains.call_args[0][0]
+    assert len(grains) == 3
+    assert grains['name-computer'] == {
+        'computername': salt_config["computer_name"]}
 
     # tried "normal" first, with a value, above. now, trying with none.
     salt_config["computer_name"] = None
@@ -415,7 +432,7 @@ def test_linux_computer_name_none():
     # execution ====================
     saltworker_lx = SaltLinux(system_params, **salt_config)
 
-    saltworker_lx._set_grain = MagicMock(return_value=None)
+    saltworker_lx._set_grains = MagicMock(return_value=None)
     saltworker_lx.run_salt = MagicMock(
         return_value={"retcode": 0, "stdout": b"", "stderr": b""}
     )
@@ -423,7 +440,8 @@ def test_linux_computer_name_none():
     saltworker_lx.process_grains()
 
     # assertions ===================
-    assert saltworker_lx._set_grain.call_count == 2
+    assert saltworker_lx._set_grains.call_count == 1
+    assert len(saltworker_lx._set_grains.call_args[0][0]) == 2
 
 
 @patch("codecs.open", autospec=True)
@@ -469,8 +487,11 @@ def test_linux_salt_debug_log_none(mock_safe, mock_makedirs, mock_codec):
 @patch("yaml.safe_dump", autospec=True)
 @patch("yaml.safe_load", autospec=True)
 @patch("watchmaker.utils.copytree", autospec=True)
+@patch("watchmaker.utils.manifest.load_manifest", autospec=True)
+@patch("watchmaker.utils.manifest.sync_tree", autospec=True)
 def test_linux_salt_content_none(
-        mock_copytree, mock_yload, mock_ydump, mock_os, mock_codec):
+        mock_sync, mock_load, mock_copytree, mock_yload, mock_ydump, mock_os,
+        mock_codec):
     """Test that Pythonic None can be used without error rather than 'None'."""
     # setup ========================
     system_params = {}
@@ -496,7 +517,7 @@ def test_linux_salt_content_none(
     assert mock_os.call_count == 2
     assert mock_ydump.call_count == 1
     assert mock_yload.call_count == 1
-    assert mock_copytree.call_count > 1
+    assert mock_sync.call_count == 1
 
 
 @pytest.mark.skipif(sys.version_info < (3, 4),
@@ -508,9 +529,11 @@ def test_linux_salt_content_none(
 @patch("watchmaker.utils.copytree", autospec=True)
 @patch("glob.glob", autospec=True)
 @patch("watchmaker.utils.copy_subdirectories", autospec=True)
+@patch("watchmaker.utils.manifest.load_manifest", autospec=True)
+@patch("watchmaker.utils.manifest.sync_tree", autospec=True)
 def test_linux_salt_content_path_none(
-        mock_copysubdirs, mock_glob, mock_copytree, mock_yload,
-        mock_ydump, mock_os, mock_codec):
+        mock_sync, mock_load, mock_copysubdirs, mock_glob, mock_copytree,
+        mock_yload, mock_ydump, mock_os, mock_codec):
     """Test that Pythonic None can be used without error rather than 'None'."""
     # setup ========================
     system_params = {}
@@ -539,7 +562,7 @@ def test_linux_salt_content_path_none(
     assert mock_os.call_count == 1
     assert mock_ydump.call_count == 1
     assert mock_yload.call_count == 1
-    assert mock_copytree.call_count > 1
+    assert mock_sync.call_count == 1
     assert mock_glob.call_count == 0
 
 
@@ -551,8 +574,10 @@ def test_linux_salt_content_path_none(
 @patch("yaml.safe_load", autospec=True)
 @patch("watchmaker.utils.copytree", autospec=True)
 @patch("glob.glob", autospec=True)
+@patch("watchmaker.utils.manifest.load_manifest", autospec=True)
+@patch("watchmaker.utils.manifest.sync_tree", autospec=True)
 def test_linux_salt_content_path(
-        mock_glob, mock_copytree, mock_yload,
+        mock_sync, mock_load, mock_glob, mock_copytree, mock_yload,
         mock_ydump, mock_os, mock_codec):
     """Ensure that files from salt_content_path are retrieved correctly."""
     # setup ========================
@@ -582,7 +607,7 @@ def test_linux_salt_content_path(
     assert mock_os.call_count == 3
     assert mock_ydump.call_count == 1
     assert mock_yload.call_count == 1
-    assert mock_copytree.call_count > 1
+    assert mock_sync.call_count == 1
     assert mock_glob.call_count == 1
 
 
@@ -601,7 +626,7 @@ def test_linux_ou_path_none():
     # execution ====================
     saltworker_lx = SaltLinux(system_params, **salt_config)
 
-    saltworker_lx._set_grain = MagicMock(return_value=None)
+    saltworker_lx._set_grains = MagicMock(return_value=None)
     saltworker_lx.run_salt = MagicMock(
         return_value={"retcode": 0, "stdout": b"", "stderr": b""}
     )
@@ -609,9 +634,10 @@ def test_linux_ou_path_none():
     saltworker_lx.process_grains()
 
     # assertions ===================
-    assert saltworker_lx._set_grain.call_count == 3
-    saltworker_lx._set_grain.assert_called_with(
-        'join-domain', {'oupath': salt_config["ou_path"]})
+    assert saltworker_lx._set_grains.call_count == 1
+    grains = saltworker_lx._set_grains.call_args[0][0]
+    assert len(grains) == 3
+    assert grains['join-domain'] == {'oupath': salt_config["ou_path"]}
 
     # tried "normal" first, with a value, above. now, trying with none.
     salt_config["ou_path"] = None
@@ -619,7 +645,7 @@ def test_linux_ou_path_none():
     # execution ====================
     saltworker_lx = SaltLinux(system_params, **salt_config)
 
-    saltworker_lx._set_grain = MagicMock(return_value=None)
+    saltworker_lx._set_grains = MagicMock(return_value=None)
     saltworker_lx.run_salt = MagicMock(
         return_value={"retcode": 0, "stdout": b"", "stderr": b""}
     )
@@ -627,7 +653,8 @@ def test_linux_ou_path_none():
     saltworker_lx.process_grains()
 
     # assertions ===================
-    assert saltworker_lx._set_grain.call_count == 2
+    assert saltworker_lx._set_grains.call_count == 1
+    assert len(saltworker_lx._set_grains.call_args[0][0]) == 2
 
 
 def test_linux_admin_groups_none():
@@ -645,7 +672,7 @@ def test_linux_admin_groups_none():
     # execution ====================
     saltworker_lx = SaltLinux(system_params, **salt_config)
 
-    saltworker_lx._set_grain = MagicMock(return_value=None)
+    saltworker_lx._set_grains = MagicMock(return_value=None)
     saltworker_lx.run_salt = MagicMock(
         return_value={"retcode": 0, "stdout": b"", "stderr": b""}
     )
@@ -653,9 +680,11 @@ def test_linux_admin_groups_none():
     saltworker_lx.process_grains()
 
     # assertions ===================
-    assert saltworker_lx._set_grain.call_count == 3
-    saltworker_lx._set_grain.assert_called_with(
-        'join-domain', {'admin_groups': [salt_config["admin_groups"]]})
+    assert saltworker_lx._set_grains.call_count == 1
+    grains = saltworker_lx._set_grains.call_args[0][0]
+    assert len(grains) == 3
+    assert grains['join-domain'] == {
+        'admin_groups': [salt_config["admin_groups"]]}
 
     # tried "normal" first, with a value, above. now, trying with none.
     salt_config["admin_groups"] = None
@@ -663,7 +692,7 @@ def test_linux_admin_groups_none():
     # execution ====================
     saltworker_lx = SaltLinux(system_params, **salt_config)
 
-    saltworker_lx._set_grain = MagicMock(return_value=None)
+    saltworker_lx._set_grains = MagicMock(return_value=None)
     saltworker_lx.run_salt = MagicMock(
         return_value={"retcode": 0, "stdout": b"", "stderr": b""}
     )
@@ -671,7 +700,8 @@ def test_linux_admin_groups_none():
     saltworker_lx.process_grains()
 
     # assertions ===================
-    assert saltworker_lx._set_grain.call_count == 2
+    assert saltworker_lx._set_grains.call_count == 1
+    assert len(saltworker_lx._set_grains.call_args[0][0]) == 2
 
 
 def test_linux_admin_users_none():
@@ -689,7 +719,7 @@ def test_linux_admin_users_none():
     # execution ====================
     saltworker_lx = SaltLinux(system_params, **salt_config)
 
-    saltworker_lx._set_grain = MagicMock(return_value=None)
+    saltworker_lx._set_grains = MagicMock(return_value=None)
     saltworker_lx.run_salt = MagicMock(
         return_value={"retcode": 0, "stdout": b"", "stderr": b""}
     )
@@ -697,9 +727,11 @@ def test_linux_admin_users_none():
     saltworker_lx.process_grains()
 
     # assertions ===================
-    assert saltworker_lx._set_grain.call_count == 3
-    saltworker_lx._set_grain.assert_called_with(
-        'join-domain', {'admin_users': [salt_config["admin_users"]]})
+    assert saltworker_lx._set_grains.call_count == 1
+    grains = saltworker_lx._set_grains.call_args[0][0]
+    assert len(grains) == 3
+    assert grains['join-domain'] == {
+        'admin_users': [salt_config["admin_users"]]}
 
     # tried "normal" first, with a value, above. now, trying with none.
     salt_config["admin_users"] = None
@@ -707,7 +739,7 @@ def test_linux_admin_users_none():
     # execution ====================
     saltworker_lx = SaltLinux(system_params, **salt_config)
 
-    saltworker_lx._set_grain = MagicMock(return_value=None)
+    saltworker_lx._set_grains = MagicMock(return_value=None)
     saltworker_lx.run_salt = MagicMock(
         return_value={"retcode": 0, "stdout": b"", "stderr": b""}
     )
@@ -715,7 +747,8 @@ def test_linux_admin_users_none():
     saltworker_lx.process_grains()
 
     # assertions ===================
-    assert saltworker_lx._set_grain.call_count == 2
+    assert saltworker_lx._set_grains.call_count == 1
+    assert len(saltworker_lx._set_grains.call_args[0][0]) == 2
 
 
 @patch.dict(os.environ, {"systemdrive": "C:"})
@@ -742,7 +775,6 @@ def test_win_ash_role_none():
     saltworker_win.service_enable = MagicMock(return_value=None)
     saltworker_win.service_disable = MagicMock(return_value=None)
     saltworker_win.service_start = MagicMock(return_value=None)
-    saltworker_win._set_grain = MagicMock(return_value=None)
     saltworker_win.process_grains = MagicMock(return_value=None)
     saltworker_win.run_salt = MagicMock(
         return_value={"retcode": 0, "stdout": b"", "stderr": b""}
@@ -754,9 +786,9 @@ def test_win_ash_role_none():
     saltworker_win.install()
 
     # assertions ===================
-    assert saltworker_win._set_grain.call_count == 1
-    saltworker_win._set_grain.assert_called_with(
-        'ash-windows', {'lookup': {'role': salt_config["ash_role"]}})
+    assert saltworker_win.process_grains.call_count == 1
+    assert saltworker_win._get_grains()['ash-windows'] == {
+        'lookup': {'role': salt_config["ash_role"]}}
 
     # tried "normal" first, with a value, above. now, trying with none.
     salt_config["ash_role"] = None
@@ -772,7 +804,6 @@ def test_win_ash_role_none():
     saltworker_win.service_enable = MagicMock(return_value=None)
     saltworker_win.service_disable = MagicMock(return_value=None)
     saltworker_win.service_start = MagicMock(return_value=None)
-    saltworker_win._set_grain = MagicMock(return_value=None)
     saltworker_win.process_grains = MagicMock(return_value=None)
     saltworker_win.run_salt = MagicMock(
         return_value={"retcode": 0, "stdout": b"", "stderr": b""}
@@ -784,4 +815,567 @@ def test_win_ash_role_none():
     saltworker_win.install()
 
     # assertions ===================
-    assert saltworker_win._set_grain.call_count == 0
+    assert saltworker_win.process_grains.call_count == 1
+    assert 'ash-windows' not in saltworker_win._get_grains()
+
+
+@patch("os.walk", autospec=True)
+@patch("watchmaker.utils.manifest.load_manifest", autospec=True)
+@patch("watchmaker.utils.manifest.sync_tree", autospec=True)
+def test_user_formulas_placed_in_order(mock_sync, mock_load, mock_os):
+    """Ensure user formulas are placed in the configured order."""
+    # setup ========================
+    system_params = {}
+    salt_config = {}
+    system_params["prepdir"] = "d5f3a3c4-4fb5-5d5e-a7a1-2a3d8fe0f2c4"
+    system_params["logdir"] = "7f5a0a63-2f55-5b3c-a6d6-1f5b5b0f4a1a"
+    system_params["workingdir"] = "2c1e6f5d-3b1c-5f44-8a1e-6e1e0c1d9b7e"
+
+    salt_config["user_formulas"] = OrderedDict([
+        ("foo-formula", "https://example.com/foo/master.zip"),
+        ("bar-formula", "https://example.com/bar/master.zip"),
+    ])
+
+    def fetch_user_formula(formula_name, formula_url):
+        if formula_name == "foo-formula":
+            # finish last, to make sure the placement order is not affected
+            time.sleep(0.1)
+        return "extracted-{0}".format(formula_name)
+
+    # execution ====================
+    saltworker_lx = SaltLinux(system_params, **salt_config)
+    saltworker_lx.working_dir = system_params["workingdir"]
+    saltworker_lx._fetch_user_formula = MagicMock(
+        side_effect=fetch_user_formula)
+    saltworker_lx._place_formula = MagicMock(return_value=None)
+
+    saltworker_lx._get_formulas_conf()
+
+    # assertions ===================
+    assert saltworker_lx._fetch_user_formula.call_count == 2
+    saltworker_lx._place_formula.assert_has_calls([
+        call(
+            "extracted-foo-formula",
+            os.sep.join((saltworker_lx.salt_formula_root, "foo-formula"))),
+        call(
+            "extracted-bar-formula",
+            os.sep.join((saltworker_lx.salt_formula_root, "bar-formula"))),
+    ])
+
+
+@patch("os.walk", autospec=True)
+@patch("watchmaker.utils.manifest.sync_tree", autospec=True)
+def test_overridden_formulas_not_staged(mock_sync, mock_os):
+    """Ensure bundled formulas overridden by user formulas are not staged."""
+    # setup ========================
+    system_params = {}
+    salt_config = {}
+    system_params["prepdir"] = "6d1e5b0a-8a5f-5f8e-b5e1-4c7b2a1f0e3d"
+    system_params["logdir"] = "0b6f1a2c-3d4e-5f60-8a7b-9c0d1e2f3a4b"
+    system_params["workingdir"] = "5a4b3c2d-1e0f-5a9b-8c7d-6e5f4a3b2c1d"
+
+    salt_config["user_formulas"] = {
+        "scap-formula": "https://example.com/scap-formula/master.zip",
+    }
+
+    # execution ====================
+    saltworker_lx = SaltLinux(system_params, **salt_config)
+    saltworker_lx.working_dir = system_params["workingdir"]
+    saltworker_lx.bundled_manifest = {
+        "formulas/scap-formula/scap/init.sls": {"size": 1, "sha256": "a"},
+        "formulas/ash-linux-formula/ash/init.sls": {"size": 1, "sha256": "b"},
+    }
+    saltworker_lx._fetch_user_formula = MagicMock(return_value="extracted")
+    saltworker_lx._place_formula = MagicMock(return_value=None)
+
+    saltworker_lx._get_formulas_conf()
+
+    # assertions ===================
+    assert mock_sync.call_count == 1
+    assert list(mock_sync.call_args[0][2]) == [
+        "ash-linux-formula/ash/init.sls"]
+    saltworker_lx._place_formula.assert_called_with(
+        "extracted",
+        os.sep.join((saltworker_lx.salt_formula_root, "scap-formula")))
+
+
+def test_place_formula(tmpdir):
+    """Ensure a formula replaces the previous one in the formula root."""
+    # setup ========================
+    system_params = {}
+    system_params["prepdir"] = "1c2d3e4f-5a6b-5c7d-8e9f-0a1b2c3d4e5f"
+    system_params["logdir"] = "2d3e4f5a-6b7c-5d8e-9f0a-1b2c3d4e5f6a"
+    system_params["workingdir"] = "3e4f5a6b-7c8d-5e9f-0a1b-2c3d4e5f6a7b"
+
+    formula_src = tmpdir.mkdir("extracted").mkdir("foo-formula-master")
+    formula_src.mkdir("foo").join("init.sls").write("foo: new\n")
+    formula_root = tmpdir.mkdir("formulas")
+    formula_root.mkdir("foo-formula").join("stale.sls").write("stale\n")
+
+    # execution ====================
+    saltworker_lx = SaltLinux(system_params)
+    saltworker_lx.salt_formula_root = str(formula_root)
+    saltworker_lx._place_formula(
+        str(formula_src), str(formula_root.join("foo-formula")))
+
+    # assertions ===================
+    assert formula_root.join("foo-formula", "foo", "init.sls").check()
+    assert not formula_root.join("foo-formula", "stale.sls").check()
+    assert os.listdir(str(formula_root)) == ["foo-formula"]
+
+
+def test_salt_content_over_symlink_staged_srv(tmpdir):
+    """Ensure salt content is never extracted into the installed package."""
+    # setup ========================
+    system_params = {}
+    system_params["prepdir"] = "4f5a6b7c-8d9e-5f0a-1b2c-3d4e5f6a7b8c"
+    system_params["logdir"] = "5a6b7c8d-9e0f-5a1b-2c3d-4e5f6a7b8c9d"
+    system_params["workingdir"] = "6b7c8d9e-0f1a-5b2c-3d4e-5f6a7b8c9d0e"
+
+    package = tmpdir.mkdir("static")
+    bundled = package.mkdir("salt").mkdir("content")
+    bundled.mkdir("pillar").join("top.sls").write("bundled\n")
+    package.join("salt").mkdir("formulas")
+    srv = tmpdir.mkdir("srv")
+    watchmaker.utils.copy_subdirectories(
+        str(bundled), str(srv), method="symlink")
+    assert os.path.islink(str(srv.join("pillar")))
+
+    archive = str(tmpdir.join("content.zip"))
+    with zipfile.ZipFile(archive, "w") as zip_:
+        zip_.writestr("pillar/top.sls", "content\n")
+
+    # execution ====================
+    saltworker_lx = SaltLinux(system_params)
+    saltworker_lx.extract_contents(archive, str(srv))
+
+    # assertions ===================
+    assert bundled.join("pillar", "top.sls").read() == "bundled\n"
+    assert srv.join("pillar", "top.sls").read() == "content\n"
+    assert not os.path.islink(str(srv.join("pillar")))
+
+
+def test_bogus_staging_method(saltworker_client):
+    """
+    Ensure a bogus staging method throws InvalidValue.
+
+    Args:
+        saltworker_client: (:obj:`src.workers.SaltBase`)
+
+    """
+    with pytest.raises(InvalidValue):
+        saltworker_client.staging_method = "bogus"
+        saltworker_client.before_install()
+
+
+def test_consolidate_file_roots(tmpdir):
+    """Ensure file roots are merged in order, with conflicts recorded."""
+    # setup ========================
+    system_params = {}
+    system_params["prepdir"] = "8a9b0c1d-2e3f-5a4b-9c5d-6e7f8a9b0c1d"
+    system_params["logdir"] = "9b0c1d2e-3f4a-5b5c-8d6e-7f8a9b0c1d2e"
+    system_params["workingdir"] = "0c1d2e3f-4a5b-5c6d-9e7f-8a9b0c1d2e3f"
+
+    srv = tmpdir.mkdir("srv")
+    states = srv.mkdir("states")
+    states.join("top.sls").write("base: {}\n")
+    formula = srv.mkdir("formulas").mkdir("foo-formula")
+    formula.mkdir("foo").join("init.sls").write("foo: {}\n")
+    formula.join("top.sls").write("conflict\n")
+    file_roots = [str(states), str(formula)]
+
+    # execution ====================
+    saltworker_lx = SaltLinux(system_params)
+    overlay = saltworker_lx._consolidate_file_roots(file_roots, str(srv))
+
+    # assertions ===================
+    assert overlay == os.sep.join((str(srv), "file_root"))
+    assert srv.join("file_root", "top.sls").read() == "base: {}\n"
+    assert srv.join("file_root", "foo", "init.sls").read() == "foo: {}\n"
+    index = watchmaker.utils.manifest.load_manifest(
+        str(srv.join("file_root.index.json")))
+    assert index["files"]["foo/init.sls"] == str(formula)
+    assert index["conflicts"] == {"top.sls": file_roots}
+
+
+def test_get_referenced_formulas(tmpdir):
+    """Ensure only the formulas reachable from the run are referenced."""
+    # setup ========================
+    system_params = {}
+    salt_config = {}
+    system_params["prepdir"] = "4f5a6b7c-8d9e-5f0a-1b2c-3d4e5f6a7b8c"
+    system_params["logdir"] = "5a6b7c8d-9e0f-5a1b-2c3d-4e5f6a7b8c9d"
+    system_params["workingdir"] = "6b7c8d9e-0f1a-5b2c-3d4e-5f6a7b8c9d0e"
+
+    salt_config["salt_states"] = "highstate"
+
+    salt = tmpdir.mkdir("salt")
+    formulas = salt.mkdir("formulas")
+    foo = formulas.mkdir("foo-formula")
+    foo.mkdir("foo").join("init.sls").write("include:\n  - bar\n")
+    formulas.mkdir("bar-formula").join("bar.sls").write("bar: {}\n")
+    formulas.mkdir("baz-formula").mkdir("baz").join("init.sls").write("{}\n")
+    formulas.mkdir("mod-formula").mkdir("_modules").join("mod.py").write("")
+    states = tmpdir.mkdir("states")
+    states.join("top.sls").write("base:\n  '*':\n    - foo\n")
+    user_formula = tmpdir.mkdir("user-formula")
+    user_formula.mkdir("user").join("init.sls").write(
+        "user:\n  file.managed:\n    - source: salt://baz/user.conf\n")
+
+    # execution ====================
+    saltworker_lx = SaltLinux(system_params, **salt_config)
+    saltworker_lx.salt_base_env = str(states)
+    saltworker_lx.bundled_manifest = (
+        watchmaker.utils.manifest.build_manifest(str(salt)))
+
+    # assertions ===================
+    assert saltworker_lx._get_referenced_formulas(str(formulas), []) == set([
+        "foo-formula", "bar-formula", "mod-formula"])
+    assert saltworker_lx._get_referenced_formulas(
+        str(formulas), [str(user_formula)]) == set([
+            "foo-formula", "bar-formula", "baz-formula", "mod-formula"])
+
+    saltworker_lx.exclude_states = "sls:baz.*"
+    assert saltworker_lx._get_referenced_formulas(str(formulas), []) == set([
+        "foo-formula", "bar-formula", "baz-formula", "mod-formula"])
+    saltworker_lx.exclude_states = ""
+
+    foo.join("foo", "roles.sls").write(
+        "include:\n  - {{ salt.pillar.get('role') }}\n")
+    assert saltworker_lx._get_referenced_formulas(str(formulas), []) is None
+    foo.join("foo", "roles.sls").remove()
+
+    states.join("top.sls").write("base:\n  '*':\n    - {{ role }}\n")
+    assert saltworker_lx._get_referenced_formulas(str(formulas), []) is None
+
+
+@pytest.mark.skipif(os.name == "nt", reason="Not supported on Windows.")
+def test_versioned_srv(tmpdir):
+    """Ensure each run is staged in a new version and swapped into place."""
+    # setup ========================
+    system_params = {}
+    salt_config = {}
+    system_params["prepdir"] = "7c8d9e0f-1a2b-5c3d-4e5f-6a7b8c9d0e1f"
+    system_params["logdir"] = "8d9e0f1a-2b3c-5d4e-5f6a-7b8c9d0e1f2a"
+    system_params["workingdir"] = "9e0f1a2b-3c4d-5e5f-6a7b-8c9d0e1f2a3b"
+
+    salt_config["versioned_srv"] = True
+    srv = tmpdir.mkdir("srv")
+
+    saltworker_lx = SaltLinux(system_params, **salt_config)
+    saltworker_lx.salt_srv = str(srv)
+    saltworker_lx.salt_formula_root = str(srv.join("formulas"))
+    versions = []
+
+    # execution ====================
+    for run in range(3):
+        saltworker_lx._create_srv_version()
+        if not run:
+            os.makedirs(saltworker_lx.salt_formula_root)
+        with open(os.path.join(
+            saltworker_lx.salt_formula_root, "run{0}.sls".format(run)
+        ), "w") as fh_:
+            fh_.write("run: {0}\n".format(run))
+        gc_thread = saltworker_lx._activate_srv_version()
+        gc_thread.join()
+        versions.append(os.path.basename(saltworker_lx.salt_srv_version))
+        saltworker_lx.salt_srv_version = None
+
+    # assertions ===================
+    assert saltworker_lx.salt_conf["pillar_roots"] == {
+        "base": [os.sep.join((str(srv), "current", "pillar"))]}
+    assert os.readlink(str(srv.join("current"))) == os.sep.join((
+        "versions", versions[-1]))
+    assert sorted(os.listdir(str(srv.join("versions")))) == sorted(
+        versions[1:])
+    assert sorted(os.listdir(str(srv.join("current", "formulas")))) == [
+        "run0.sls", "run1.sls", "run2.sls"]
+
+
+@pytest.mark.skipif(os.name == "nt", reason="Not supported on Windows.")
+def test_versioned_srv_not_written_through(tmpdir):
+    """Ensure staging a version leaves the formulas it links to untouched."""
+    # setup ========================
+    system_params = {}
+    system_params["prepdir"] = "7c8d9e0f-1a2b-5c3d-4e5f-6a7b8c9d0e1f"
+    system_params["logdir"] = "8d9e0f1a-2b3c-5d4e-5f6a-7b8c9d0e1f2a"
+    system_params["workingdir"] = "9e0f1a2b-3c4d-5e5f-6a7b-8c9d0e1f2a3b"
+    srv = tmpdir.mkdir("srv")
+    current = srv.mkdir("versions").mkdir("1").mkdir("formulas")
+    current.mkdir("foo-formula").join("init.sls").write("old: true\n")
+    current.mkdir("bar-formula").join("init.sls").write("old: true\n")
+    srv.join("current").mksymlinkto(os.sep.join(("versions", "1")))
+
+    archive = str(tmpdir.join("foo-formula.zip"))
+    with zipfile.ZipFile(archive, "w") as zip_:
+        zip_.writestr("foo-formula/init.sls", "new: true\n")
+    bar = tmpdir.mkdir("bar").mkdir("bar-formula")
+    bar.join("init.sls").write("new: true\n")
+
+    saltworker_lx = SaltLinux(system_params, versioned_srv=True)
+    saltworker_lx.salt_srv = str(srv)
+
+    # execution ====================
+    saltworker_lx._create_srv_version()
+    formula_root = saltworker_lx.salt_formula_root
+    saltworker_lx._extract_archive(
+        zipfile.ZipFile, "r", archive, formula_root)
+    watchmaker.utils.copy_tree(
+        str(bar), os.path.join(formula_root, "bar-formula"))
+
+    # assertions ===================
+    for formula in ("foo-formula", "bar-formula"):
+        assert current.join(formula, "init.sls").read() == "old: true\n"
+        with open(os.path.join(formula_root, formula, "init.sls")) as fh_:
+            assert fh_.read() == "new: true\n"
+
+
+@patch("watchmaker.utils.process.run_processes", autospec=True)
+def test_install_from_yum_timeout(mock_run):
+    """Ensure the salt package install is bounded by the command timeouts."""
+    mock_run.return_value = [{
+        'retcode': 0, 'stdout': MagicMock(), 'stderr': MagicMock(),
+        'timed_out': None,
+        'usage': dict.fromkeys(watchmaker.utils.process.USAGE_FIELDS, 0)}]
+    system_params = {}
+    system_params["prepdir"] = "7c8d9e0f-1a2b-5c3d-4e5f-6a7b8c9d0e1f"
+    system_params["logdir"] = "8d9e0f1a-2b3c-5d4e-5f6a-7b8c9d0e1f2a"
+    system_params["workingdir"] = "9e0f1a2b-3c4d-5e5f-6a7b-8c9d0e1f2a3b"
+    saltworker_lx = SaltLinux(
+        system_params, command_timeout=600, command_inactivity_timeout=120)
+
+    saltworker_lx._install_from_yum(['salt-minion'])
+
+    command = mock_run.call_args[0][0][0]
+    assert command.cmd[-1] == 'salt-minion'
+    assert command.timeouts.total == 600
+    assert command.timeouts.inactivity == 120
+
+
+def test_salt_session(saltworker_client):
+    """Test that supported salt commands run in the salt session."""
+    session = MagicMock()
+    session.call.return_value = {
+        'retcode': 0, 'stdout': b'True\n', 'stderr': b'', 'wall': 0.1}
+    saltworker_client._session = session
+    saltworker_client.call_process = MagicMock()
+    saltworker_client.command_timeout = 60
+    saltworker_client.command_inactivity_timeout = 30
+
+    assert saltworker_client.service_stop('salt-minion')
+    session.call.assert_called_once_with(
+        ['service.stop', 'salt-minion', '--out', 'newline_values_only'],
+        timeout=30.0)
+    assert saltworker_client.command_usage[-1]['cmd'][0] == 'salt-session'
+    assert saltworker_client.command_usage[-1]['wall'] == 0.1
+
+    saltworker_client.run_salt(['state.apply', 'foo'], raise_error=False)
+    saltworker_client.run_salt(['--log-level', 'debug', 'test.ping'])
+    assert saltworker_client.call_process.call_count == 2
+    assert session.call.call_count == 1
+
+    session.call.side_effect = (
+        watchmaker.utils.salt_session.SessionError('boom'))
+    saltworker_client.run_salt('saltutil.sync_all')
+    assert saltworker_client._session is None
+    assert saltworker_client.call_process.call_count == 3
+    session.close.assert_called_once_with()
+
+
+def test_get_salt_python(saltworker_client, tmpdir):
+    """Test that the salt Python is read from salt-call, without salt."""
+    python = tmpdir.join('python3')
+    python.write('')
+    salt_call = tmpdir.join('salt-call')
+    salt_call.write('#!{0} -s\nimport salt\n'.format(python))
+    saltworker_client.salt_call = str(salt_call)
+    saltworker_client._get_grain = MagicMock(return_value='/usr/bin/python')
+
+    assert saltworker_client._get_salt_python() == str(python)
+    assert saltworker_client._get_grain.call_count == 0
+
+    salt_call.write('#!/usr/bin/env python3\nimport salt\n')
+    assert saltworker_client._get_salt_python() == '/usr/bin/python'
+    saltworker_client._get_grain.assert_called_once_with('pythonexecutable')
+
+
+def test_set_grains(saltworker_client, tmpdir):
+    """Test that grains are merged into the grains file."""
+    saltworker_client.salt_conf_path = str(tmpdir)
+    tmpdir.join('grains').write(
+        'kept: 1\nsystemprep:\n  enterprise_environment: old\n')
+
+    saltworker_client._set_grains({
+        'systemprep': {'enterprise_environment': 'dev'},
+        'join-domain': {'admin_users': ['user1']},
+    })
+
+    assert yaml.safe_load(tmpdir.join('grains').read()) == {
+        'kept': 1,
+        'systemprep': {'enterprise_environment': 'dev'},
+        'join-domain': {'admin_users': ['user1']},
+    }
+    assert [x.basename for x in tmpdir.listdir()] == ['grains']
+
+
+def test_linux_service_systemd():
+    """Test that services are managed with systemd when it is running."""
+    system_params = {
+        "prepdir": "b3c1b1a3-3c6b-5b44-9b4c-2b5ea6b9c2f1",
+        "logdir": "logdir",
+        "workingdir": "workingdir",
+    }
+    saltworker_lx = SaltLinux(system_params)
+    saltworker_lx._has_systemd = MagicMock(return_value=True)
+    saltworker_lx.run_salt = MagicMock()
+    saltworker_lx.call_process = MagicMock(return_value={
+        "retcode": 0,
+        "stdout": b"ActiveState=active\nUnitFileState=enabled\n",
+        "stderr": b"",
+    })
+
+    assert saltworker_lx.service_status("salt-minion") == (True, True)
+    saltworker_lx.call_process.assert_called_once_with(
+        ["systemctl", "show", "--property", "ActiveState,UnitFileState",
+         "salt-minion"], raise_error=False)
+
+    saltworker_lx.call_process.return_value = {
+        "retcode": 5, "stdout": b"", "stderr": b""}
+    assert not saltworker_lx.service_start("salt-minion")
+    saltworker_lx.call_process.assert_called_with(
+        ["systemctl", "start", "salt-minion"], raise_error=False)
+    assert saltworker_lx.run_salt.call_count == 0
+
+    saltworker_lx._has_systemd.return_value = False
+    saltworker_lx.run_salt.return_value = {
+        "retcode": 0, "stdout": b"True\n", "stderr": b""}
+    assert saltworker_lx.service_stop("salt-minion")
+    assert saltworker_lx.run_salt.call_count == 1
+
+
+def test_report_states(saltworker_client, tmpdir):
+    """Test the timing report of the salt states."""
+    saltworker_client.salt_log_dir = str(tmpdir)
+    stdout = watchmaker.utils.process.OutputBuffer()
+    stdout.write(repr({'return': {
+        'pkg_|-vim_|-vim_|-installed': {
+            '__sls__': 'tools.vim', '__id__': 'vim', 'result': True,
+            'duration': 2500.0, 'changes': {'vim': {'new': '9'}}},
+        'file_|-motd_|-/etc/motd_|-managed': {
+            '__sls__': 'tools', '__id__': 'motd', 'result': True,
+            'duration': '500 ms', 'changes': {}},
+        'service_|-sshd_|-sshd_|-running': {
+            '__sls__': 'ssh', '__id__': 'sshd', 'result': True,
+            'duration': 1000.0, 'changes': {}},
+    }}).encode('utf-8'))
+    saltworker_client.salt_state_args = []
+    saltworker_client.run_salt = MagicMock(
+        return_value={'retcode': 0, 'stdout': stdout})
+
+    # Without a report, a successful return is never read
+    saltworker_client.process_states('highstate', None)
+    assert not tmpdir.join('salt_state_report.highstate.json').check()
+
+    saltworker_client.salt_state_report = True
+    saltworker_client.process_states('highstate', None)
+
+    report = json.loads(
+        tmpdir.join('salt_state_report.highstate.json').read())
+    assert (report['states'], report['changed'], report['unchanged']) == (
+        3, 1, 2)
+    assert report['duration'] == 4.0
+    assert [x['id'] for x in report['slowest']] == ['vim', 'sshd', 'motd']
+    assert report['slowest'][0]['function'] == 'pkg.installed'
+    assert [(x['formula'], x['duration']) for x in report['formulas']] == [
+        ('tools', 3.0), ('ssh', 1.0)]
+    assert [x['sls'] for x in report['sls']] == ['tools.vim', 'ssh', 'tools']
+
+
+def test_unchanged_states(saltworker_client, tmpdir):
+    """Test that unchanged salt state inputs skip or test the states."""
+    states_dir = tmpdir.mkdir('states')
+    states_dir.join('top.sls').write('base: {}\n')
+    conf_dir = tmpdir.mkdir('conf')
+    conf_dir.join('minion').write(
+        yaml.safe_dump({'file_roots': {'base': [str(states_dir)]}}))
+    saltworker_client.salt_conf_path = str(conf_dir)
+    saltworker_client.salt_state_args = []
+    saltworker_client._report_states = MagicMock()
+    saltworker_client._get_grain = MagicMock(return_value='3004.2')
+    saltworker_client.run_salt = MagicMock(return_value={
+        'retcode': 0, 'stdout': watchmaker.utils.process.OutputBuffer()})
+
+    saltworker_client.unchanged_states = 'skip'
+    saltworker_client.process_states('highstate', None)
+    saltworker_client.process_states('highstate', None)
+    assert saltworker_client.run_salt.call_count == 1
+
+    saltworker_client.force_states = True
+    saltworker_client.process_states('highstate', None)
+    assert saltworker_client.run_salt.call_count == 2
+
+    saltworker_client.force_states = False
+    saltworker_client.unchanged_states = 'test'
+    saltworker_client.process_states('highstate', None)
+    assert saltworker_client.run_salt.call_args[0][0] == [
+        'state.highstate', 'test=True']
+
+    saltworker_client._get_grain.return_value = '3005.1'
+    saltworker_client.process_states('highstate', None)
+    assert saltworker_client.run_salt.call_args[0][0] == ['state.highstate']
+
+    states_dir.join('top.sls').write('base: {"*": [foo]}\n')
+    saltworker_client.process_states('highstate', None)
+    assert saltworker_client.run_salt.call_args[0][0] == ['state.highstate']
+    saltworker_client._get_grain.assert_called_with('saltversion')
+
+
+def test_parallel_states(saltworker_client):
+    """Test that independent SLS groups of the highstate run concurrently."""
+    def buffer(data):
+        output = watchmaker.utils.process.OutputBuffer()
+        output.write(data)
+        return output
+
+    lowstate = [
+        {'__sls__': 'scap', '__id__': 'scap', 'name': 'scap',
+         'state': 'pkg'},
+        {'__sls__': 'splunk', '__id__': 'splunk', 'name': 'splunk',
+         'state': 'pkg', 'require': [{'sls': 'splunk.config'}]},
+        {'__sls__': 'splunk.config', '__id__': 'conf', 'name': '/etc/s',
+         'state': 'file'},
+    ]
+    saltworker_client.parallel_states = True
+    saltworker_client.salt_state_report = True
+    saltworker_client.salt_state_args = []
+    saltworker_client._report_states = MagicMock()
+    saltworker_client.run_salt = MagicMock(return_value={
+        'retcode': 0,
+        'stdout': buffer(json.dumps({'local': lowstate}).encode('utf-8'))})
+    saltworker_client.run_salts = MagicMock(return_value=[
+        {'retcode': 0, 'stdout': buffer(
+            b"{'return': {'pkg_|-scap_|-scap_|-installed': {}}}")},
+        {'retcode': 0, 'stdout': buffer(
+            b"{'return': {'pkg_|-splunk_|-splunk_|-installed': {}}}")},
+    ])
+
+    saltworker_client.process_states('highstate', 'foo')
+
+    assert saltworker_client.run_salts.call_args[0][0] == [
+        ['state.highstate', 'exclude=splunk,splunk.config,foo',
+         'concurrent=True'],
+        ['state.highstate', 'exclude=scap,foo', 'concurrent=True'],
+    ]
+    assert sorted(
+        saltworker_client._report_states.call_args[0][1]['return']) == [
+        'pkg_|-scap_|-scap_|-installed', 'pkg_|-splunk_|-splunk_|-installed']
+
+    # A shard killed by a signal fails the run, whatever the others return
+    saltworker_client.salt_state_report = False
+    saltworker_client.run_salts.return_value = [
+        {'retcode': 0, 'stdout': buffer(b"{'return': {}}")},
+        {'retcode': -9, 'stdout': buffer(b'')},
+    ]
+    with pytest.raises(WatchmakerException) as excinfo:
+        saltworker_client.process_states('highstate', None)
+    assert 'retcode -9' in str(excinfo.value)
@@ -4,7 +4,16 @@
 from __future__ import (absolute_import, division, print_function,
                         unicode_literals, with_statement)
 
+import os
+
+import pytest
+
 import watchmaker.utils
+import watchmaker.utils.manifest
+import watchmaker.utils.process
+import watchmaker.utils.salt_progress
+import watchmaker.utils.salt_session
+import watchmaker.utils.sls
 
 try:
     from unittest.mock import patch
@@ -14,7 +23,7 @@ except ImportError:
 
 @patch('os.path.exists', autospec=True)
 @patch('shutil.rmtree', autospec=True)
-@patch('shutil.copytree', autospec=True)
+@patch('watchmaker.utils.copy_tree', autospec=True)
 def test_copytree_no_force(mock_copy, mock_rm, mock_exists):
     """Test that copytree results in correct calls without force option."""
     random_src = 'aba51e65-afd2-5020-8117-195f75e64258'
@@ -33,7 +42,7 @@ def test_copytree_no_force(mock_copy, mock_rm, mock_exists):
 
 @patch('os.path.exists', autospec=True)
 @patch('shutil.rmtree', autospec=True)
-@patch('shutil.copytree', autospec=True)
+@patch('watchmaker.utils.copy_tree', autospec=True)
 def test_copytree_force(mock_copy, mock_rm, mock_exists):
     """Test that copytree results in correct calls with force option."""
     random_src = '44b6df59-db6f-57cb-a570-ccd55d782561'
@@ -45,6 +54,38 @@ def test_copytree_force(mock_copy, mock_rm, mock_exists):
     mock_exists.assert_called_with(random_dst)
 
 
+@patch('shutil.copytree', autospec=True)
+def test_copytree_kwargs(mock_copy):
+    """Test that copytree uses shutil for options of shutil.copytree."""
+    random_src = 'c1d9f3a2-6b8e-5f4d-9a7c-2e1b0d3f5a6c'
+    random_dst = 'd2e0a4b3-7c9f-5a5e-8b8d-3f2c1e4a6b7d'
+
+    assert watchmaker.utils.copytree(
+        random_src, random_dst, symlinks=True) is None
+    mock_copy.assert_called_with(random_src, random_dst, symlinks=True)
+
+
+def test_copy_tree(tmpdir):
+    """Test that copy_tree copies files, dirs, and links with metrics."""
+    src = tmpdir.mkdir('src')
+    src.mkdir('foo').join('init.sls').write('foo: {}\n')
+    src.mkdir('bar').mkdir('files').join('bar.conf').write('bar\n')
+    src.join('foo', 'init.sls').chmod(0o640)
+    os.symlink('init.sls', str(src.join('foo', 'link.sls')))
+    dst = tmpdir.join('dst')
+
+    stats = watchmaker.utils.copy_tree(str(src), str(dst), max_workers=2)
+
+    assert stats['dirs'] == 4
+    assert stats['files'] == 2
+    assert stats['links'] == 1
+    assert stats['bytes'] == 12
+    assert dst.join('foo', 'init.sls').read() == 'foo: {}\n'
+    assert dst.join('bar', 'files', 'bar.conf').read() == 'bar\n'
+    assert os.readlink(str(dst.join('foo', 'link.sls'))) == 'init.sls'
+    assert dst.join('foo', 'init.sls').stat().mode & 0o777 == 0o640
+
+
 def test_clean_none():
     """Check string 'None' conversion to None."""
     assert not watchmaker.utils.clean_none('None')
@@ -69,3 +110,387 @@ def test_copy_subdirectories(mock_os, mock_copy, mock_exists):
 
     watchmaker.utils.copy_subdirectories(random_src, random_dst, None)
     assert mock_copy.call_count == 1
+
+
+def test_file_digest(tmpdir):
+    """Test that file_digest returns the digest of the file contents."""
+    random_file = tmpdir.join('4b1f0c1e-0d7e-5b4b-9d9b-6cfa3e2b6a91')
+    random_file.write_binary(b'watchmaker')
+
+    assert watchmaker.utils.file_digest(str(random_file)) == (
+        '99e694731f640ca086ca074489e00932793914eff41125293d187caafed94def')
+
+
+def test_stage_tree_hardlink(tmpdir):
+    """Test that stage_tree replicates the tree without modifying src."""
+    src = tmpdir.mkdir('src')
+    src.mkdir('foo').join('init.sls').write('foo: {}\n')
+    dst = tmpdir.mkdir('dst')
+    dst.mkdir('foo').join('init.sls').write('stale\n')
+
+    watchmaker.utils.stage_tree(str(src), str(dst), 'hardlink')
+
+    assert dst.join('foo', 'init.sls').read() == 'foo: {}\n'
+    assert src.join('foo', 'init.sls').read() == 'foo: {}\n'
+
+
+def test_clear_destinations(tmpdir):
+    """Test that links an extraction would write through are removed."""
+    src = tmpdir.mkdir('src')
+    src.mkdir('foo').join('init.sls').write('foo: {}\n')
+    src.mkdir('bar').join('init.sls').write('bar: {}\n')
+    dst = tmpdir.mkdir('dst')
+    watchmaker.utils.stage_tree(
+        str(src.join('foo')), str(dst.join('foo')), 'hardlink')
+    watchmaker.utils.stage_tree(
+        str(src.join('bar')), str(dst.join('bar')), 'symlink')
+    dst.join('foo', 'map.jinja').write('{}\n')
+
+    assert watchmaker.utils.clear_destinations(str(dst), [
+        'foo/', 'foo/init.sls', './bar/init.sls', 'baz/init.sls',
+        '../src/foo/init.sls']) == 2
+    assert not dst.join('foo', 'init.sls').check()
+    assert dst.join('foo', 'map.jinja').check()
+    assert not os.path.lexists(str(dst.join('bar')))
+    assert src.join('foo', 'init.sls').check()
+    assert src.join('bar', 'init.sls').check()
+
+
+def test_sync_tree_incremental(tmpdir):
+    """Test that sync_tree only copies what changed since the last sync."""
+    src = tmpdir.mkdir('src')
+    src.mkdir('foo-formula').mkdir('foo').join('init.sls').write('foo: {}\n')
+    src.join('foo-formula', 'foo', 'map.jinja').write('{% set foo = 1 %}\n')
+    dst = tmpdir.mkdir('dst')
+    dst.mkdir('bar-formula').join('init.sls').write('bar: {}\n')
+    state_file = str(dst.join('.state.json'))
+
+    manifest = watchmaker.utils.manifest.build_manifest(str(src))
+    stats = watchmaker.utils.manifest.sync_tree(
+        str(src), str(dst), manifest, state_file)
+    assert stats == {'added': 2, 'replaced': 0, 'deleted': 0, 'unchanged': 0}
+
+    stats = watchmaker.utils.manifest.sync_tree(
+        str(src), str(dst), manifest, state_file)
+    assert stats == {'added': 0, 'replaced': 0, 'deleted': 0, 'unchanged': 2}
+
+    src.join('foo-formula', 'foo', 'map.jinja').remove()
+    src.join('foo-formula', 'foo', 'init.sls').write('foo: changed\n')
+    dst.join('foo-formula', 'foo', 'stale.sls').write('stale: {}\n')
+    manifest = watchmaker.utils.manifest.build_manifest(str(src))
+    stats = watchmaker.utils.manifest.sync_tree(
+        str(src), str(dst), manifest, state_file)
+    assert stats == {'added': 0, 'replaced': 1, 'deleted': 2, 'unchanged': 0}
+    assert dst.join('foo-formula', 'foo', 'init.sls').read() == (
+        'foo: changed\n')
+    assert dst.join('bar-formula', 'init.sls').check()
+
+
+def test_update_manifest(tmpdir):
+    """Test that update_manifest only reads files changed since before."""
+    src = tmpdir.mkdir('src')
+    src.join('init.sls').write('foo: {}\n')
+    src.join('map.jinja').write('{% set foo = 1 %}\n')
+
+    previous = watchmaker.utils.manifest.update_manifest(str(src))
+    assert previous['init.sls']['sha256'] == (
+        watchmaker.utils.manifest.build_manifest(str(src))['init.sls'][
+            'sha256'])
+
+    src.join('map.jinja').write('{% set foo = 2 %}\n')
+    src.join('map.jinja').setmtime(1)
+    with patch(
+        'watchmaker.utils.manifest._hash_file', return_value='changed'
+    ) as hash_file:
+        manifest = watchmaker.utils.manifest.update_manifest(
+            str(src), previous)
+
+    hash_file.assert_called_once_with(str(src.join('map.jinja')))
+    assert manifest['init.sls'] == previous['init.sls']
+    assert manifest['map.jinja']['sha256'] == 'changed'
+
+
+def test_stage_file(tmpdir):
+    """Test that stage_file places files with each staging method."""
+    src = tmpdir.join('9f3c1c4e-5cfb-5a3e-9e1f-0c7c4d6ad1b2')
+    src.write('foo: {}\n')
+
+    for method in watchmaker.utils.STAGING_METHODS:
+        dst = tmpdir.join(method)
+        dst.write('stale\n')
+
+        used = watchmaker.utils.stage_file(str(src), str(dst), method)
+
+        assert used in (method, 'copy')
+        assert dst.read() == 'foo: {}\n'
+        assert src.read() == 'foo: {}\n'
+
+    assert os.path.samefile(str(src), str(tmpdir.join('hardlink')))
+    assert os.path.islink(str(tmpdir.join('symlink')))
+
+
+def test_top_file_states():
+    """Test that top file states are found, unless templated."""
+    top = (
+        'base:\n'
+        '  \'G@os_family:RedHat\':\n'
+        '    - match: compound\n'
+        '    - ash-linux.stig\n'
+        '  \'*\':\n'
+        '    - name-computer\n'
+        '{% if salt.grains.get("foo") %}\n'
+        '    - scap.content\n'
+        '{% endif %}\n'
+    )
+    assert watchmaker.utils.sls.top_file_states(top) == set([
+        'ash-linux.stig', 'name-computer', 'scap.content'])
+    assert watchmaker.utils.sls.top_file_states(top, 'dev') == set()
+
+    top = 'base:\n  \'*\':\n    - {{ salt.grains.get("role") }}\n'
+    assert watchmaker.utils.sls.top_file_states(top) is None
+
+
+def test_referenced_namespaces():
+    """Test that references are found, unless an include is templated."""
+    sls = (
+        '{% from "foo/map.jinja" import foo with context %}\n'
+        'include:\n'
+        '  - bar.baz\n'
+        '  - .relative\n'
+        '\n'
+        'qux:\n'
+        '  file.managed:\n'
+        '    - source: salt://qux/files/qux.conf\n'
+        '    - require:\n'
+        '      - sls: quux\n'
+    )
+    assert watchmaker.utils.sls.referenced_namespaces(sls) == set([
+        'foo', 'bar', 'qux', 'quux'])
+
+    sls = (
+        '{%- from tplroot ~ "/map.jinja" import foo with context %}\n'
+        'include:\n'
+        '  - {{ tplroot }}.config\n'
+        '  - bar\n'
+    )
+    assert watchmaker.utils.sls.referenced_namespaces(sls) == set(['bar'])
+
+    sls = (
+        'include:\n'
+        '{% for role in salt.pillar.get("roles", []) %}\n'
+        '  - {{ role }}\n'
+        '{% endfor %}\n'
+    )
+    assert watchmaker.utils.sls.referenced_namespaces(sls) is None
+
+
+def test_reachable_formulas(tmpdir):
+    """Test that formulas are reached through the formulas they include."""
+    formulas = tmpdir.mkdir('formulas')
+    formulas.mkdir('foo-formula').mkdir('foo').join('init.sls').write(
+        'include:\n  - bar\n')
+    formulas.mkdir('bar-formula').join('bar.sls').write('bar: {}\n')
+    formulas.mkdir('baz-formula').mkdir('_modules').join('baz.py').write('')
+    formulas.mkdir('qux-formula').mkdir('qux').join('init.sls').write('')
+    providers, with_modules = watchmaker.utils.sls.formula_providers([
+        'foo-formula/foo/init.sls', 'bar-formula/bar.sls',
+        'baz-formula/_modules/baz.py', 'qux-formula/qux/init.sls',
+        'qux-formula/README.md'])
+    assert providers == {
+        'foo': 'foo-formula', 'bar': 'bar-formula', 'qux': 'qux-formula'}
+    assert with_modules == set(['baz-formula'])
+
+    states = tmpdir.mkdir('states')
+    assert watchmaker.utils.sls.reachable_formulas(
+        providers, set(['foo']), [str(states)], str(formulas),
+        with_modules) == set(['foo-formula', 'bar-formula', 'baz-formula'])
+
+    states.join('init.sls').write(
+        'include:\n{% for x in pillar.roles %}\n  - {{ x }}\n'
+        '{% endfor %}\n')
+    assert watchmaker.utils.sls.reachable_formulas(
+        providers, set(['foo']), [str(states)], str(formulas)) is None
+
+
+def test_warm_page_cache(tmpdir):
+    """Test that warm_page_cache reads files and skips unreadable ones."""
+    tree = tmpdir.mkdir('salt')
+    tree.mkdir('states').join('init.sls').write('foo: {}\n')
+    tree.join('grains').write('bar\n')
+    single = tmpdir.join('Packages')
+    single.write('rpmdb\n')
+
+    stats = watchmaker.utils.warm_page_cache([
+        str(tree), str(single), str(tmpdir.join('missing'))])
+
+    assert stats['files'] == 3
+    assert stats['bytes'] == 18
+
+
+def test_output_buffer():
+    """Test that OutputBuffer spills to a file beyond its memory limit."""
+    buffer_ = watchmaker.utils.process.OutputBuffer(spill_size=8)
+
+    buffer_.write(b'salt\n')
+    assert not buffer_.spilled
+    assert bytes(buffer_.view()) == b'salt\n'
+
+    buffer_.write(b'call\n')
+    buffer_.write(b'done\n')
+    assert buffer_.spilled
+    assert len(buffer_) == 15
+    assert buffer_.getvalue() == b'salt\ncall\ndone\n'
+    assert buffer_.tail(5) == b'done\n'
+    assert buffer_.view()[:5] == b'salt\n'
+    buffer_.close()
+
+
+def test_summarize_usage():
+    """Test totalling the resources used by commands."""
+    records = [
+        {'worker': 'SaltLinux', 'cmd': ['/usr/bin/salt-call', 'a'],
+         'wall': 1.0, 'user': 0.5, 'system': 0.25, 'maxrss': 100,
+         'inblock': 1, 'oublock': 2},
+        {'worker': 'SaltLinux', 'cmd': ['/usr/bin/salt-call', 'b'],
+         'wall': 2.0, 'user': 1.0, 'system': 0.25, 'maxrss': 300,
+         'inblock': 3, 'oublock': 4},
+        {'worker': 'SaltLinux', 'cmd': ['getenforce'],
+         'wall': 0.5, 'user': None, 'system': None, 'maxrss': None,
+         'inblock': None, 'oublock': None},
+    ]
+
+    summary = watchmaker.utils.process.summarize_usage(records)
+
+    assert summary == [
+        {'worker': 'SaltLinux', 'command': 'salt-call', 'count': 2,
+         'wall': 3.0, 'user': 1.5, 'system': 0.5, 'maxrss': 300,
+         'inblock': 4, 'oublock': 6},
+        {'worker': 'SaltLinux', 'command': 'getenforce', 'count': 1,
+         'wall': 0.5, 'user': None, 'system': None, 'maxrss': None,
+         'inblock': None, 'oublock': None},
+    ]
+
+
+def test_salt_session_is_supported():
+    """Test which salt commands may run in a salt session."""
+    is_supported = watchmaker.utils.salt_session.is_supported
+    assert is_supported(['grains.get', 'pythonexecutable'])
+    assert is_supported(['service.status', 'foo', '--out', 'txt'])
+    assert is_supported(['--out=txt', 'test.ping'])
+    assert not is_supported(['state.highstate'])
+    assert not is_supported(['--log-level', 'debug', 'test.ping'])
+    assert not is_supported([])
+
+
+@pytest.mark.skipif(os.name == 'nt', reason='uses a posix shell')
+def test_salt_session_timeout(tmpdir):
+    """Test that a salt session call that runs out of time is killed."""
+    python = tmpdir.join('python')
+    python.write('#!/bin/sh\nexec sleep 30\n')
+    python.chmod(0o755)
+    session = watchmaker.utils.salt_session.SaltSession(
+        str(python), str(tmpdir))
+
+    with pytest.raises(watchmaker.utils.salt_session.SessionError):
+        session.call(['test.ping'], timeout=0.5)
+    assert session.process.poll() is not None
+    session.close()
+
+
+def test_salt_state_progress(tmpdir):
+    """Test following the progress of salt states in the salt log."""
+    log = tmpdir.join('salt_call.debug.log')
+    log.write('old [salt.state:1][INFO    ][1] Executing state a for [b]\n')
+    prefix = '2024-01-01 00:00:00,000 [salt.state       :2188]'
+    messages = []
+    progress = watchmaker.utils.salt_progress.StateProgress(
+        str(log), lambda msg, *args: messages.append(msg % args),
+        interval=0.01)
+
+    progress.start()
+    log.write(''.join([
+        prefix + '[INFO    ][42] Executing state pkg.installed for [vim]\n',
+        prefix + '[INFO    ][42] Completed state [vim] at time 00:00:01 '
+        '(duration_in_ms=1500.5)\n',
+        prefix + '[INFO    ][42] Executing state file.managed for [/etc/x]\n',
+        prefix + '[ERROR   ][42] Unable to manage file\n',
+        prefix + '[INFO    ][42] Completed state [/etc/x] at time 00:00:02 '
+        '(duration_in_ms=20)\n',
+    ]),
+        mode='a')
+    progress.stop()
+
+    assert messages == [
+        'Salt state started: pkg.installed vim',
+        'Salt state completed in 1.5s: pkg.installed vim '
+        '(1 completed, 0 failed)',
+        'Salt state started: file.managed /etc/x',
+        'Salt state failed in 0.0s: file.managed /etc/x '
+        '(2 completed, 1 failed)',
+    ]
+
+
+def test_salt_state_progress_concurrent(tmpdir):
+    """Test following salt states of concurrent salt processes."""
+    log = tmpdir.join('salt_call.debug.log')
+    log.write('')
+    prefix = '2024-01-01 00:00:00,000 [salt.state       :2188]'
+    messages = []
+    progress = watchmaker.utils.salt_progress.StateProgress(
+        str(log), lambda msg, *args: messages.append(msg % args),
+        interval=0.01)
+
+    progress.start()
+    log.write(''.join([
+        prefix + '[INFO    ][42] Executing state pkg.installed for [vim]\n',
+        prefix + '[INFO    ][43] Executing state file.managed for [/etc/x]\n',
+        prefix + '[ERROR   ][43] Unable to manage file\n',
+        prefix + '[INFO    ][42] Completed state [vim] at time 00:00:01 '
+        '(duration_in_ms=1500.5)\n',
+        prefix + '[INFO    ][43] Completed state [/etc/x] at time 00:00:02 '
+        '(duration_in_ms=20)\n',
+    ]),
+        mode='a')
+    progress.stop()
+
+    assert messages[2:] == [
+        'Salt state completed in 1.5s: pkg.installed vim '
+        '(1 completed, 0 failed)',
+        'Salt state failed in 0.0s: file.managed /etc/x '
+        '(2 completed, 1 failed)',
+    ]
+
+
+def test_independent_sls_groups():
+    """Test partitioning a lowstate into SLS groups without requisites."""
+    lowstate = [
+        {'__sls__': 'scap', '__id__': 'scap', 'name': 'scap',
+         'state': 'pkg', 'fun': 'installed'},
+        {'__sls__': 'splunk', '__id__': 'splunk', 'name': 'splunk',
+         'state': 'pkg', 'fun': 'installed'},
+        {'__sls__': 'splunk.config', '__id__': 'conf', 'name': '/etc/s',
+         'state': 'file', 'fun': 'managed', 'require': [{'pkg': 'splunk'}]},
+        {'__sls__': 'nessus', '__id__': 'nessus', 'name': 'nessus',
+         'state': 'service', 'fun': 'running', 'use_vt': True},
+        {'__sls__': 'inspector', '__id__': 'agent', 'name': 'agent',
+         'state': 'cmd', 'fun': 'run', 'watch_in': [{'sls': 'nessus'}]},
+    ]
+
+    assert watchmaker.utils.sls.independent_sls_groups(lowstate) == [
+        ['scap'], ['splunk', 'splunk.config'], ['inspector', 'nessus']]
+
+    lowstate[0]['require'] = [{'pkg': 'vim*'}]
+    assert watchmaker.utils.sls.independent_sls_groups(lowstate) is None
+
+
+def test_shard_commands():
+    """Test that each shard excludes the SLS files of the other shards."""
+    cmd = ['--out', 'quiet', 'state.highstate', 'exclude=id:foo']
+
+    assert watchmaker.utils.sls.shard_commands(
+        cmd, [['scap'], ['splunk', 'splunk.config']]) == [
+        ['--out', 'quiet', 'state.highstate',
+         'exclude=splunk,splunk.config,id:foo', 'concurrent=True'],
+        ['--out', 'quiet', 'state.highstate',
+         'exclude=scap,id:foo', 'concurrent=True'],
+    ]
@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+# pylint: disable=redefined-outer-name,protected-access
+"""Yum worker main test module."""
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals, with_statement)
+
+import os
+import sys
+
+import pytest
+
+from watchmaker.exceptions import CommandTimeout, InvalidValue
+from watchmaker.workers.yum import Yum
+
+try:
+    from unittest.mock import patch
+except ImportError:
+    from mock import patch
+
+
+@pytest.fixture
+def yum_worker():
+    """Return a yum worker on a supported distribution."""
+    with patch.object(Yum, 'get_dist_info', autospec=True) as mock_dist:
+        mock_dist.return_value = {'dist': 'centos', 'el_version': '7'}
+        yield Yum({}, command_timeout=0.5, command_inactivity_timeout='5')
+
+
+def test_bogus_command_timeout(yum_worker):
+    """Ensure a negative command timeout throws InvalidValue."""
+    yum_worker.before_install()
+
+    yum_worker.command_inactivity_timeout = -1
+    with pytest.raises(InvalidValue):
+        yum_worker.before_install()
+
+
+@pytest.mark.skipif(os.name == 'nt', reason='Linux-only worker')
+def test_command_timeout(yum_worker):
+    """Ensure commands of the yum worker are terminated on timeout."""
+    with pytest.raises(CommandTimeout):
+        yum_worker.call_process(
+            [sys.executable, '-c', 'import time; time.sleep(30)'])